@@ -12,13 +12,15 @@
 
 
 import pathlib
-import pandas as pd
 import re
 
 import sys
 
 sys.path.append("../utils")
 import loaddata_utils as ld_utils
+import image_index
+import loaddata_store
+import zarr_store
 
 
 # ## Set paths
@@ -32,8 +34,17 @@ config_dir_path = pathlib.Path("./config_files").absolute()
 output_csv_dir = pathlib.Path("./loaddata_csvs")
 output_csv_dir.mkdir(parents=True, exist_ok=True)
 
-# Find all 'Images' folders within the directory
-images_folders = list(index_directory.rglob('Images'))
+# Pack the images of each plate into a Zarr store for the Python passes (QC, IC functions and thumbnails)
+convert_to_zarr = False
+zarr_dir = pathlib.Path("./zarr_stores")
+
+# Index of the folders and images under the raw data directory (kept with the outputs of this module, not tracked by git)
+image_index_path = pathlib.Path("./image_index.sqlite").absolute()
+
+# Find all 'Images' folders within the directory using the image index (only changed folders are listed again)
+images_folders = image_index.find_directories(
+    root_dir=index_directory, index_path=image_index_path, name="Images"
+)
 
 
 # ## Create LoadData CSVs for all data
@@ -41,7 +52,8 @@ images_folders = list(index_directory.rglob('Images'))
 # In[3]:
 
 
-# Loop through each folder and create a LoadData CSV
+# Loop through each folder and collect the inputs to create a LoadData CSV
+loaddata_jobs = []
 for folder in images_folders:
     # Get the first folder directly under the index_directory
     relative_path = folder.relative_to(index_directory)
@@ -79,137 +91,73 @@ for folder in images_folders:
     # Create LoadData output path per plate
     path_to_output_csv = (output_csv_dir / f"{plate_name}_loaddata_original.csv").absolute()
 
-    # Call the function to create the LoadData CSV
-    ld_utils.create_loaddata_csv(
-        index_directory=folder,
-        config_path=config_path,  # Use the matched config file
-        path_to_output=path_to_output_csv,
+    # Add the inputs to create the LoadData CSV
+    loaddata_jobs.append(
+        {
+            "index_directory": folder,
+            "config_path": config_path,  # Use the matched config file
+            "path_to_output": path_to_output_csv,
+            "image_index_path": image_index_path,
+        }
     )
 
+# Create all LoadData CSVs in parallel (one process per Images folder)
+ld_utils.create_loaddata_csvs_parallel(loaddata_jobs=loaddata_jobs)
 
-# ## Concat the re-imaged data back to their original plate and remove the original poor quality data paths
 
-# ### Collect a list of original CSVs and identify unique plate IDs
+# ## Concat the re-imaged data back to their original plate and remove the original poor quality data paths
+# 
+# Rows from the original plate are replaced by the re-imaged rows from the same well and site, since the original images are of poor quality. We add a `Metadata_Reimaged` column for if a row is re-imaged or not. Each plate is merged in its own process, and plates whose LoadData CSVs have the same contents as at their last merge (checked with the hash saved next to the concatenated CSV) are skipped. Plates with only re-imaged CSVs are reported and not merged.
 
-# In[4]:
+# In[ ]:
 
 
-# Step 1: Find all CSV files in the output directory
+# Find all CSV files in the output directory
 csv_files = list(output_csv_dir.glob("*.csv"))
 
-# Step 2: Extract unique BR00 IDs from filenames
-br00_pattern = re.compile(r"(BR00\d+)")  # Regex to match 'BR00' followed by digits
-
-# Collect all matching BR00 IDs from filenames
-br00_ids = {br00_pattern.search(csv_file.stem).group(1) 
-            for csv_file in csv_files 
-            if br00_pattern.search(csv_file.stem)}
-
-# Sort BR00 IDs numerically to be consistent in ordering
-br00_ids = sorted(br00_ids, key=lambda x: int(x[4:]))  # Convert digits part to integer for numerical sorting
-
-print(f"Found {len(br00_ids)} BR00 IDs: {br00_ids}")
-
-
-# ### Track/store files and add a metadata column for if a row is re-imaged or not
-
-# In[5]:
-
-
-# Step 3: Initialize storage to track used files and find proper column order 
-br00_dataframes = {br_id: [] for br_id in br00_ids}
-used_files = set()  # Store filenames used in the process
-concat_files = []  # Track new concatenated CSV files
-
-# Load one BR00 starting CSV that will have the correct column order
-column_order = pd.read_csv(pathlib.Path(f"{output_csv_dir}/{list(br00_ids)[0]}_loaddata_original.csv"), nrows=0).columns.tolist()
-
-# Step 4: Add 'Metadata_Reimaged' column and group by BR00 ID
-for csv_file in csv_files:
-    filename = csv_file.stem
-    match = br00_pattern.search(filename)
+# Concatenate the original and re-imaged CSVs per BR00 ID (CSVs without a BR00 ID are reported as not used)
+merged_plates = ld_utils.merge_reimaged_plates(loaddata_csvs=csv_files, output_dir=output_csv_dir)
+concat_files = list(merged_plates.values())
 
-    if match:
-        br_id = match.group(1)
 
-        # Read the CSV file into a DataFrame
-        loaddata_df = pd.read_csv(csv_file)
-
-        # Reorder DataFrame columns to match the correct column order
-        loaddata_df = loaddata_df[column_order]  # Ensure the columns are in the correct order
-
-        # Add 'Metadata_Reimaged' column based on filename
-        loaddata_df['Metadata_Reimaged'] = 'Re-imaged' in filename
-
-        # Append the DataFrame to the corresponding BR00 group
-        br00_dataframes[br_id].append(loaddata_df)
-
-        # Track this file as used
-        used_files.add(csv_file.name)
-
-# Print an example DataFrame (first BR00 group)
-example_id = next(iter(br00_dataframes))  # Get the first BR00 ID
-example_df = pd.concat(br00_dataframes[example_id], ignore_index=True)
-print(f"\nExample DataFrame for BR00 ID: {example_id}")
-example_df.iloc[:, [0, 1, -1]] # Display only the first two and last column
-
-
-# ### Concat the re-imaged and original data for the same plate and remove any duplicate wells that come from the original data
+# ### Save the concatenated LoadData as Parquet
 # 
-# We remove the duplicates that aren't re-imaged since they are of poor quality. We want to analyze the re-imaged data from those same wells.
-
-# In[6]:
+# The Parquet files store the repeated `PathName` columns as dictionaries and the metadata as types, and can be used in place of the CSVs for CellProfiler runs (the CSV is written when a CellProfiler process needs it).
 
+# In[ ]:
 
-# Step 5: Concatenate DataFrames, drop duplicates, and save per BR00 ID
-for br_id, dfs in br00_dataframes.items():
-    if dfs:  # Only process if there are matching files
-        concatenated_df = pd.concat(dfs, ignore_index=True)
 
-        # Drop duplicates, prioritizing rows with 'Metadata_Reimaged' == True
-        deduplicated_df = concatenated_df.sort_values(
-            'Metadata_Reimaged', ascending=False
-        ).drop_duplicates(subset=['Metadata_Well', 'Metadata_Site'], keep='first')
+for concat_file in concat_files:
+    print(f"Saved: {loaddata_store.loaddata_csv_to_parquet(concat_file)}")
 
-        # Sort by 'Metadata_Col', 'Metadata_Row', and 'Metadata_Site
-        sorted_df = deduplicated_df.sort_values(
-            ['Metadata_Col', 'Metadata_Row', "Metadata_Site"], ascending=True
-        )
 
-        # Save the cleaned, concatenated, and sorted DataFrame to a new CSV file
-        output_path = output_csv_dir / f"{br_id}_concatenated.csv"
-        sorted_df.to_csv(output_path, index=False)
-
-        print(f"Saved: {output_path}")
-        concat_files.append(output_path)  # Track new concatenated files
-    else:
-        print(f"No files found for {br_id}")
-
-
-# ### Confirm that all LoadData CSV files were included in previous concat (avoid data loss)
-
-# In[7]:
+# ### Pack the images of each plate into a Zarr store
+# 
+# Each plate's TIFFs are written into a compressed, chunked OME-Zarr store (`<plate>.zarr/<row>/<column>/<site>`, with one chunk per channel) and a LoadData CSV pointing to the store is saved as `<plate>_zarr.csv` (see [zarr_store.py](../utils/zarr_store.py)).
+# This CSV is used in place of the concatenated CSV by the Python passes when `use_zarr_loaddata = True` (in `1.extract_image_quality`, `2.evaluate_qc` and `3.cp_illum_correction`), which read one compressed chunk per image instead of a TIFF from the raw image drive.
+# CellProfiler can not load images from Zarr stores, so the CellProfiler pipelines still use the concatenated CSVs.
+# Sites that are already in a store with the same TIFF paths are skipped, so only re-imaged sites are written again.
 
+# In[ ]:
 
-# Step 6: Verify all files were used
-unused_files = set(csv_file.name for csv_file in csv_files) - used_files
 
-if unused_files:
-    print("Warning: Some files were not used in the concatenation!")
-    for file in unused_files:
-        print(f"Unused: {file}")
-else:
-    print("All files were successfully used.")
+if convert_to_zarr:
+    for concat_file in concat_files:
+        zarr_store.convert_plate_to_zarr(path_to_loaddata=concat_file, zarr_dir=zarr_dir)
 
 
-# ### Remove the original CSV files to prevent CellProfiler from using them
+# ### Remove the original CSV files of the merged plates to prevent CellProfiler from using them
+# 
+# The CSVs of plates that were not merged (e.g., plates with only re-imaged CSVs) are kept.
 
 # In[8]:
 
 
-# Step 7: Remove all non-concatenated CSVs to avoid confusion
+# Remove the non-concatenated CSVs of the merged plates to avoid confusion
 for csv_file in csv_files:
-    if csv_file not in concat_files:  # Keep only new concatenated files
+    plate_id = re.search(r"(BR00\d+)", csv_file.stem)
+    # Keep the new concatenated files and the CSVs of plates that were not merged
+    if csv_file not in concat_files and plate_id is not None and plate_id.group(1) in merged_plates:
         csv_file.unlink()  # Delete the file
         print(f"Removed: {csv_file}")
 
@@ -15,6 +15,7 @@ import sys
 
 sys.path.append("../utils")
 import cp_parallel
+import image_qc
 
 
 # ## Set paths and variables
@@ -25,6 +26,13 @@ import cp_parallel
 # set the run type for the parallelization
 run_name = "whole_img_qc"
 
+# calculate the blur and saturation metrics in Python (True) or run the whole_img_qc.cppipe pipeline (False)
+use_python_qc = True
+
+# read the images from the Zarr stores of 0.create_loaddata_csvs (with `convert_to_zarr = True`) instead of the TIFFs
+use_zarr_loaddata = False
+zarr_dir = pathlib.Path("./zarr_stores")
+
 # set path for CellProfiler pipeline
 path_to_pipeline = pathlib.Path("./whole_img_qc.cppipe").resolve(strict=True)
 
@@ -63,18 +71,30 @@ plate_info_dictionary = {
     for name in plate_names if next(loaddata_dir.glob(f"{name}*.csv"), None)
 }
 
+# the Python QC reads the images with the LoadData CSVs that point to the Zarr stores (CellProfiler can not read them)
+if use_python_qc and use_zarr_loaddata:
+    for name, info in plate_info_dictionary.items():
+        info["path_to_loaddata"] = (zarr_dir / f"{name}_zarr.csv").resolve(strict=True)
+
 # view the dictionary to assess that all info is added correctly
 pprint.pprint(plate_info_dictionary, indent=4)
 
 
-# ## Calculate IC functions and extract image quality features on data
+# ## Extract image quality features on data
+# 
+# By default, the blur (`PowerLogLogSlope`) and saturation (`PercentMaximal`) metrics are calculated for the non-brightfield channels directly from the images with the same methods as the CellProfiler MeasureImageQuality module, which saves an `Image.csv` per plate with the same columns for these metrics and does not need CellProfiler.
+# Set `use_zarr_loaddata = True` to calculate them from the Zarr stores of `0.create_loaddata_csvs` (with `convert_to_zarr = True`) instead of the TIFFs.
+# Set `use_python_qc = False` to run the `whole_img_qc.cppipe` pipeline instead.
 # 
-# Note: This code cell was not ran as we prefer to perform CellProfiler processing tasks via `sh` file (bash script) which is more stable.
+# Note: The CellProfiler processing was not ran in this notebook as we prefer to perform CellProfiler processing tasks via `sh` file (bash script) which is more stable.
 
 # In[ ]:
 
 
-cp_parallel.run_cellprofiler_parallel(
-    plate_info_dictionary=plate_info_dictionary, run_name=run_name
-)
+if use_python_qc:
+    image_qc.measure_image_quality(plate_info_dictionary=plate_info_dictionary)
+else:
+    cp_parallel.run_cellprofiler_parallel(
+        plate_info_dictionary=plate_info_dictionary, run_name=run_name
+    )
 
@@ -18,12 +18,20 @@ import pathlib
 import pandas as pd
 import numpy as np
 
-from scipy.stats import zscore
-import matplotlib.pyplot as plt
-import seaborn as sns
+from IPython.display import Image, display
 
+import sys
 
-# ## Set paths and load in data frame
+sys.path.append("../utils")
+import qc_density
+import qc_thresholds
+import thumbnail_cache
+
+
+# ## Set paths and update the QC statistics
+# 
+# The QC metrics of each plate are read in chunks, with only the metric columns, to update running statistics (count, mean, standard deviation and a quantile sketch) per plate, channel and metric.
+# The statistics are saved to `qc_statistics.json` in the QC output folder, so only new plates or plates with a changed `Image.csv` are read when the notebook is run again, and the statistics across plates are merged from the saved statistics.
 
 # In[2]:
 
@@ -32,87 +40,52 @@ import seaborn as sns
 figure_dir = pathlib.Path("./qc_figures")
 figure_dir.mkdir(exist_ok=True)
 
-# Directory with QC CellProfiler outputs per plate
+# Directory with QC outputs per plate
 illum_dir = pathlib.Path("./whole_img_qc_output")
 
-# Create an empty dictionary to store data frames for each plate
-all_qc_data_frames = {}
-
-# List all plate directories within the illum_dir
-plates = [plate.name for plate in illum_dir.iterdir() if plate.is_dir()]
-
-# Loop through each plate
-for plate in plates:
-    # Read in CSV with all image quality metrics per image for the current plate
-    qc_df = pd.read_csv(illum_dir / plate / "Image.csv")
+# List of channels (excluding Brightfield since the metrics are not robust to this type of channel)
+channels = ["OrigDNA", "OrigER", "OrigAGP", "OrigMito", "OrigRNA"]
 
-    # Store the data frame for the current plate in the dictionary
-    all_qc_data_frames[plate] = qc_df
+# Update the running statistics per plate, channel and metric (only new or changed plates are read)
+qc_statistics = qc_thresholds.update_qc_statistics(
+    qc_dir=illum_dir,
+    path_to_statistics=illum_dir / "qc_statistics.json",
+    channels=channels,
+)
 
-# Print the plate names to ensure they were loaded correctly
-print(all_qc_data_frames.keys())
+# List the plates with QC outputs
+plates = list(qc_statistics["plates"])
+print(plates)
 
 # Select the first plate in the list
 first_plate = plates[0]
 print(f"Showing example for the first plate: {first_plate}")
 
-# Access the dataframe for the first plate
-example_df = all_qc_data_frames[first_plate]
+# Load the dataframe for the first plate only
+example_df = pd.read_csv(illum_dir / first_plate / "Image.csv")
 
 # Show the shape and the first few rows of the dataframe for the first plate
 print(example_df.shape)
 example_df.head()
 
 
-# ## Create concat data frames combining blur and saturation metrics from all channels for all plates
+# ## Calculate the densities of the blur and saturation metrics from all channels for all plates for plotting
+# 
+# The metrics of each plate are counted in fixed-grid histograms per channel (only the metric columns are read), and the densities are calculated from the histograms with an FFT, using the same bandwidth as seaborn `kdeplot` (see [qc_density.py](../utils/qc_density.py)).
+# The histograms and densities are cached per plate, so only new plates or plates with a changed `Image.csv` are read when the notebook is run again.
 
 # In[3]:
 
 
-# List of channels (excluding Brightfield since the metrics are not robust to this type of channel)
-channels = ["OrigDNA", "OrigER", "OrigAGP", "OrigMito", "OrigRNA"]
-
-# Create an empty dictionary to store data frames for each channel
-all_combined_dfs = {}
-
-# Iterate through each channel
-for channel in channels:
-    # Create an empty list to store data frames for each plate
-    plate_dfs = []
-
-    # Iterate through each plate and create the specified data frame for the channel
-    for plate, qc_df in all_qc_data_frames.items():
-        plate_df = qc_df.filter(like="Metadata_").copy()
-
-        # Add PowerLogLogSlope column (blur metric)
-        plate_df["ImageQuality_PowerLogLogSlope"] = qc_df[
-            f"ImageQuality_PowerLogLogSlope_{channel}"
-        ]
-
-        # Add PercentMaximal column (saturation metric)
-        plate_df["ImageQuality_PercentMaximal"] = qc_df[
-            f"ImageQuality_PercentMaximal_{channel}"
-        ]
+# Directory for the cached histograms and densities per plate
+density_cache_dir = pathlib.Path("./qc_density_cache")
 
-        # Add "Channel" column
-        plate_df["Channel"] = channel
-
-        # Add "Metadata_Plate" column
-        plate_df["Metadata_Plate"] = plate
-
-        # Append the data frame to the list
-        plate_dfs.append(plate_df)
-
-    # Concatenate data frames for each plate for the current channel
-    all_combined_dfs[channel] = pd.concat(
-        plate_dfs, keys=list(all_qc_data_frames.keys()), names=["Metadata_Plate", None]
-    )
-
-# Concatenate the channel data frames together for plotting
-df = pd.concat(list(all_combined_dfs.values()), ignore_index=True)
+# Update the cached densities per plate and channel (only new or changed plates are read)
+density_cache = qc_density.update_density_cache(
+    qc_dir=illum_dir, cache_dir=density_cache_dir, channels=channels
+)
 
-print(df.shape)
-df.head()
+print(list(density_cache))
 
 
 # ## Blur metric
@@ -126,7 +99,11 @@ df.head()
 # In[4]:
 
 
-summary_statistics = df["ImageQuality_PowerLogLogSlope"].describe()
+# Merge the statistics of the blur metric across plates and channels
+blur_statistics = qc_thresholds.combine_statistics(qc_statistics, "PowerLogLogSlope")
+
+# Quartiles are estimated from the quantile sketch (within 1% of the value)
+summary_statistics = qc_thresholds.describe_statistics(blur_statistics)
 print(summary_statistics)
 
 
@@ -135,14 +112,20 @@ print(summary_statistics)
 # In[5]:
 
 
-# Calculate Z-scores for the column with all plates
-z_scores = zscore(df["ImageQuality_PowerLogLogSlope"])
-
 # Set a threshold for Z-scores (adjust as needed for number of standard deviations away from the mean)
 blur_threshold_z = 2.5
 
-# Identify outlier rows based on Z-scores above and below the mean (using absolute values of the z-scores)
-blur_outliers = df[abs(z_scores) > blur_threshold_z]
+# Calculate the values at the Z-score threshold for all plates (using the population standard deviation as in Z-scores)
+lower_z_value, upper_z_value = qc_thresholds.get_thresholds(blur_statistics, blur_threshold_z, ddof=0)
+
+# Identify outlier rows based on Z-scores above and below the mean (each plate is read in chunks)
+blur_outliers = qc_thresholds.find_outliers(
+    qc_dir=illum_dir,
+    statistics=qc_statistics,
+    metric="PowerLogLogSlope",
+    lower_threshold=lower_z_value,
+    upper_threshold=upper_z_value,
+)
 
 # Filter the outliers to only include rows where Metadata_Reimaged is False to easily find images to check if threshold worked
 blur_outliers_filtered = blur_outliers[~blur_outliers["Metadata_Reimaged"]]
@@ -160,14 +143,11 @@ blur_outliers_filtered = blur_outliers_filtered[
     ]
 ]
 
-# Identify unique well + site combos before filtering
-total_unique_combos = df[["Metadata_Plate", "Metadata_Well", "Metadata_Site"]].drop_duplicates()
-
 # Identify unique well + site combos among filtered outliers
 removed_unique_combos = blur_outliers[["Metadata_Plate", "Metadata_Well", "Metadata_Site"]].drop_duplicates()
 
-# Calculate the percentages
-total_count = len(total_unique_combos)
+# Calculate the percentages (there is one unique well + site combo per image set)
+total_count = qc_thresholds.count_image_sets(qc_statistics)
 removed_count = len(removed_unique_combos)
 percentage_removed = (removed_count / total_count) * 100 if total_count > 0 else 0
 
@@ -186,13 +166,10 @@ blur_outliers_filtered.sort_values(by="ImageQuality_PowerLogLogSlope", ascending
 # In[6]:
 
 
-# Calculate the mean and standard deviation
-mean_value = df["ImageQuality_PowerLogLogSlope"].mean()
-std_dev = df["ImageQuality_PowerLogLogSlope"].std()
-
-# Calculate the threshold values
-threshold_value_above_mean = mean_value + blur_threshold_z * std_dev
-threshold_value_below_mean = mean_value - blur_threshold_z * std_dev
+# Calculate the threshold values from the mean and standard deviation
+threshold_value_below_mean, threshold_value_above_mean = qc_thresholds.get_thresholds(
+    blur_statistics, blur_threshold_z
+)
 
 # Print the calculated threshold values
 print("Threshold for outliers above the mean:", threshold_value_above_mean)
@@ -200,35 +177,33 @@ print("Threshold for outliers below the mean:", threshold_value_below_mean)
 
 
 # ### Generate individual density plots per plate and save
+# 
+# The figures are rendered in parallel from the cached densities.
 
 # In[7]:
 
 
-# Set the style
-sns.set_style("whitegrid")
-
-# Iterate through each plate
-for plate in df["Metadata_Plate"].unique():
-    plate_df = df[df["Metadata_Plate"] == plate]
-
-    sns.kdeplot(
-        data=plate_df,
-        x="ImageQuality_PowerLogLogSlope",
-        hue="Channel",
-        palette=["b", "g", "r", "magenta", "orange"],
-        fill=True,
-        common_norm=False,
-    )
-
-    plt.title(f"Density plots per channel for {plate}")
-    plt.xlabel("ImageQuality_PowerLogLogSlope")
-    plt.ylabel("Density")
+# Create a figure per plate with the density of each channel
+plate_figure_specs = [
+    {
+        "path": figure_dir / f"{plate}_channels_blur_density.png",
+        "panels": [
+            {
+                "metric": "PowerLogLogSlope",
+                "densities": qc_density.get_channel_densities(density_cache, plate, "PowerLogLogSlope"),
+                "colors": qc_density.CHANNEL_COLORS,
+                "title": f"Density plots per channel for {plate}",
+                "xlabel": "ImageQuality_PowerLogLogSlope",
+                "legend_title": "Channel",
+            }
+        ],
+        "dpi": 500,
+    }
+    for plate in plates
+]
 
-    plt.tight_layout()
-    plt.savefig(
-        pathlib.Path(f"{figure_dir}/{plate}_channels_blur_density.png"), dpi=500
-    )
-    plt.close()  # Close the plot to prevent it from being displayed
+# Render the figures in parallel
+qc_density.render_density_figures(plate_figure_specs)
 
 
 # ### Generate density plot with all plates together and save
@@ -237,58 +212,36 @@ for plate in df["Metadata_Plate"].unique():
 
 
 # Number of plates
-num_plates = len(df["Metadata_Plate"].unique())
+num_plates = len(plates)
 
 # Calculate the number of rows and columns for the subplots
 num_rows = 2  # You want 2 rows for the quad order
 num_cols = (num_plates + 1) // num_rows  # +1 to round up
 
-# Set the style
-sns.set_style("whitegrid")
-
-# Create subplots with custom layout
-fig, axes = plt.subplots(nrows=num_rows, ncols=num_cols, figsize=(15, 5 * num_rows))
-
-# Flatten the axes array for easier indexing
-axes = axes.flatten()
-
-# Iterate through each plate
-for idx, plate in enumerate(df["Metadata_Plate"].unique()):
-    # Plot all channels in the same subplot
-    ax = axes[idx]
-    plate_df = df[df["Metadata_Plate"] == plate]
-    sns.kdeplot(
-        data=plate_df,
-        x="ImageQuality_PowerLogLogSlope",
-        hue="Channel",
-        palette=["b", "g", "r", "magenta", "orange"],
-        fill=True,
-        common_norm=False,
-        ax=ax,
-    )
-
-    # Set vertical lines at thresholds above and below mean
-    ax.axvline(x=threshold_value_above_mean, color="red", linestyle="--")
-    ax.axvline(x=threshold_value_below_mean, color="red", linestyle="--")
-
-    ax.set_title(f"Density plots for {plate}")
-    ax.set_xlabel("ImageQuality_PowerLogLogSlope")
-    ax.set_ylabel("Density")
-
-    # Set the x-axis range for the current subplot
-    ax.set_xlim(-4.0, 0)
-
-# Remove empty subplots
-for i in range(num_plates, len(axes)):
-    fig.delaxes(axes[i])
-
-# Adjust layout
-plt.tight_layout()
-
-# Save the plot
-plt.savefig(figure_dir / "all_channels_combined_density.png", dpi=500)
-
-plt.close()  # Close the plot to prevent it from being displayed
+# Plot all channels in the same subplot per plate, with vertical lines at thresholds above and below mean
+qc_density.render_density_figure(
+    {
+        "path": figure_dir / "all_channels_combined_density.png",
+        "figsize": (15, 5 * num_rows),
+        "num_rows": num_rows,
+        "num_cols": num_cols,
+        "panels": [
+            {
+                "metric": "PowerLogLogSlope",
+                "densities": qc_density.get_channel_densities(density_cache, plate, "PowerLogLogSlope"),
+                "colors": qc_density.CHANNEL_COLORS,
+                "title": f"Density plots for {plate}",
+                "xlabel": "ImageQuality_PowerLogLogSlope",
+                "legend_title": "Channel",
+                "vlines": [threshold_value_above_mean, threshold_value_below_mean],
+                # Set the x-axis range for the current subplot
+                "xlim": (-4.0, 0),
+            }
+            for plate in plates
+        ],
+        "dpi": 500,
+    }
+)
 
 
 # ### Visualize the distribution of the identified outliers
@@ -297,31 +250,29 @@ plt.close()  # Close the plot to prevent it from being displayed
 
 
 # Plot outliers as a distribution plot with hue as 'Metadata_Plate'
-sns.set_style("whitegrid")
-plt.figure(figsize=(12, 8))
-
-# Using kdeplot (you can also use distplot)
-sns.kdeplot(
-    data=blur_outliers,
-    x="ImageQuality_PowerLogLogSlope",
-    hue="Metadata_Plate",
-    palette="viridis", 
-    fill=True,
-    common_norm=False,
-)
+blur_outlier_densities = qc_density.get_outlier_densities(blur_outliers, "PowerLogLogSlope")
 
 # Set vertical lines for outlier thresolds
-plt.axvline(x=threshold_value_above_mean, color="red", linestyle="--")
-plt.axvline(x=threshold_value_below_mean, color="red", linestyle="--")
-
-plt.title("Distribution of Outliers per Plate")
-plt.xlabel("ImageQuality_PowerLogLogSlope")
-
-plt.tight_layout()
-
-plt.savefig(figure_dir / "blur_outliers_per_plate.png", dpi=500)
+blur_outliers_figure = qc_density.render_density_figure(
+    {
+        "path": figure_dir / "blur_outliers_per_plate.png",
+        "figsize": (12, 8),
+        "panels": [
+            {
+                "metric": "PowerLogLogSlope",
+                "densities": blur_outlier_densities,
+                "colors": qc_density.get_colors(list(blur_outlier_densities), palette="viridis"),
+                "title": "Distribution of Outliers per Plate",
+                "xlabel": "ImageQuality_PowerLogLogSlope",
+                "legend_title": "Metadata_Plate",
+                "vlines": [threshold_value_above_mean, threshold_value_below_mean],
+            }
+        ],
+        "dpi": 500,
+    }
+)
 
-plt.show()
+display(Image(filename=blur_outliers_figure))
 
 
 # ## Saturation metric
@@ -336,7 +287,11 @@ plt.show()
 # In[10]:
 
 
-summary_statistics = df["ImageQuality_PercentMaximal"].describe()
+# Merge the statistics of the saturation metric across plates and channels
+saturation_statistics = qc_thresholds.combine_statistics(qc_statistics, "PercentMaximal")
+
+# Quartiles are estimated from the quantile sketch (within 1% of the value)
+summary_statistics = qc_thresholds.describe_statistics(saturation_statistics)
 print(summary_statistics)
 
 
@@ -345,23 +300,26 @@ print(summary_statistics)
 # In[11]:
 
 
-# Calculate Z-scores for the column
-z_scores = zscore(df["ImageQuality_PercentMaximal"])
-
 # Set a threshold for Z-scores (adjust as needed for number of standard deviations away from the mean)
 saturation_threshold_z = 2
 
-# Identify outlier rows based on Z-scores greater than as to identify whole images with abnormally high saturated pixels
-saturation_outliers = df[abs(z_scores) > saturation_threshold_z]
+# Calculate the values at the Z-score threshold for all plates (using the population standard deviation as in Z-scores)
+lower_z_value, upper_z_value = qc_thresholds.get_thresholds(saturation_statistics, saturation_threshold_z, ddof=0)
 
-# Identify unique well + site combos before filtering
-total_unique_combos = df[["Metadata_Plate", "Metadata_Well", "Metadata_Site"]].drop_duplicates()
+# Identify outlier rows based on Z-scores greater than as to identify whole images with abnormally high saturated pixels
+saturation_outliers = qc_thresholds.find_outliers(
+    qc_dir=illum_dir,
+    statistics=qc_statistics,
+    metric="PercentMaximal",
+    lower_threshold=lower_z_value,
+    upper_threshold=upper_z_value,
+)
 
 # Identify unique well + site combos among filtered outliers
 removed_unique_combos = saturation_outliers[["Metadata_Plate", "Metadata_Well", "Metadata_Site"]].drop_duplicates()
 
-# Calculate the percentages
-total_count = len(total_unique_combos)
+# Calculate the percentages (there is one unique well + site combo per image set)
+total_count = qc_thresholds.count_image_sets(qc_statistics)
 removed_count = len(removed_unique_combos)
 percentage_removed = (removed_count / total_count) * 100 if total_count > 0 else 0
 
@@ -396,12 +354,8 @@ saturation_outliers_filtered.sort_values(by="ImageQuality_PercentMaximal", ascen
 # In[12]:
 
 
-# Calculate the mean and standard deviation
-mean_value = df["ImageQuality_PercentMaximal"].mean()
-std_dev = df["ImageQuality_PercentMaximal"].std()
-
-# Calculate the threshold values
-threshold_value_above_mean = mean_value + saturation_threshold_z * std_dev
+# Calculate the threshold value from the mean and standard deviation
+_, threshold_value_above_mean = qc_thresholds.get_thresholds(saturation_statistics, saturation_threshold_z)
 
 # Print the calculated threshold values
 print("Threshold for outliers above the mean:", threshold_value_above_mean)
@@ -412,23 +366,75 @@ print("Threshold for outliers above the mean:", threshold_value_above_mean)
 # In[13]:
 
 
-# Create a KDE plot with separate lines for each Metadata_Plate
-plt.figure(figsize=(10, 6))
-sns.kdeplot(
-    x=np.log1p(df["ImageQuality_PercentMaximal"]), hue=df["Metadata_Plate"], fill=True
-)
+# Create a KDE plot with separate lines for each Metadata_Plate (scaled by the number of images per plate)
+saturation_densities = qc_density.get_plate_densities(density_cache, "PercentMaximal", common_norm=True)
 
 # Add a vertical line at the log-transformed value of the threshold for saturation
-plt.axvline(x=np.log1p(threshold_value_above_mean), color='red', linestyle='--', label='Log-transformed 1.4')
+saturation_figure = qc_density.render_density_figure(
+    {
+        "path": figure_dir / "saturation_outliers_per_plate.png",
+        "figsize": (10, 6),
+        "panels": [
+            {
+                "metric": "PercentMaximal",
+                "densities": saturation_densities,
+                "colors": qc_density.get_colors(list(saturation_densities)),
+                "title": "KDE Plot of Log-transformed Percent Maximal by Plate",
+                "xlabel": "Log-transformed Percent Maximal",
+                "legend_title": "Metadata_Plate",
+                "vlines": [np.log1p(threshold_value_above_mean)],
+            }
+        ],
+        "dpi": 500,
+    }
+)
 
-# Set labels and title
-plt.ylabel("Density")
-plt.xlabel("Log-transformed Percent Maximal")
-plt.title("KDE Plot of Log-transformed Percent Maximal by Plate")
-plt.tight_layout()
+# Show the plot
+display(Image(filename=saturation_figure))
 
-plt.savefig(figure_dir / "saturation_outliers_per_plate.png", dpi=500)
 
-# Show the plot
-plt.show()
+# ## Review outlier images with contact sheets
+# 
+# To review the outliers without opening the full resolution images in FIJI, we build a cache of downsampled images (thumbnails) for every plate, well, site and channel in one pass over the LoadData CSVs. The contact sheets of the blur and saturation outliers are rendered from the cache, which only reads the thumbnails that are shown. The cache is only rebuilt for plates with a LoadData CSV that is newer than the cache. Set `use_zarr_loaddata = True` to read the images from the Zarr stores of `0.create_loaddata_csvs` (with `convert_to_zarr = True`) instead of the TIFFs.
+
+# In[ ]:
+
+
+# Directory for the thumbnail cache and contact sheets
+thumbnail_dir = pathlib.Path("./qc_thumbnails")
+contact_sheet_dir = figure_dir / "contact_sheets"
+
+# Read the images from the Zarr stores (True) or the TIFFs (False)
+use_zarr_loaddata = False
+zarr_dir = pathlib.Path("./zarr_stores")
+
+# Build (or update) the thumbnail cache from the LoadData CSVs of each plate
+loaddata_dir = pathlib.Path("./loaddata_csvs")
+thumbnail_cache.build_thumbnail_cache(
+    plate_info_dictionary={
+        plate: {
+            "path_to_loaddata": zarr_dir / f"{plate}_zarr.csv"
+            if use_zarr_loaddata
+            else loaddata_dir / f"{plate}_concatenated.csv"
+        }
+        for plate in plates
+    },
+    thumbnail_dir=thumbnail_dir,
+)
+
+# Render contact sheets of the outliers that were not re-imaged, with the QC metric of each image
+thumbnail_cache.render_contact_sheets(
+    outliers_df=blur_outliers_filtered,
+    thumbnail_dir=thumbnail_dir,
+    output_dir=contact_sheet_dir,
+    sheet_name="blur_outliers",
+    value_column="ImageQuality_PowerLogLogSlope",
+)
+thumbnail_cache.render_contact_sheets(
+    outliers_df=saturation_outliers_filtered,
+    thumbnail_dir=thumbnail_dir,
+    output_dir=contact_sheet_dir,
+    sheet_name="saturation_outliers",
+    value_column="ImageQuality_PercentMaximal",
+)
 
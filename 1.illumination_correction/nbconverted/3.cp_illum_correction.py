@@ -15,6 +15,8 @@ import sys
 
 sys.path.append("../utils")
 import cp_parallel
+import illum_calculate
+import illum_fanout
 
 
 # ## Set paths and variables
@@ -28,6 +30,20 @@ run_name = "illum_correction"
 # set path for CellProfiler pipeline
 path_to_pipeline = pathlib.Path("./illum.cppipe").resolve(strict=True)
 
+# calculate the IC functions in Python (True) or with CellProfiler (False)
+use_python_illum = True
+
+# read the images from the Zarr stores of 0.create_loaddata_csvs (with `convert_to_zarr = True`) instead of the TIFFs
+use_zarr_loaddata = False
+zarr_dir = pathlib.Path("./zarr_stores")
+
+# directory with the whole image QC outputs, used to skip the image sets flagged in the pipeline without measuring them again
+qc_dir = pathlib.Path("./whole_img_qc_output")
+
+# run one CellProfiler process per plate and channel instead of one per plate with all channels
+fan_out_channels = True
+channels = ["DNA", "ER", "AGP", "Mito", "RNA", "Brightfield"]
+
 # set main output dir for all plates if it doesn't exist
 output_dir = pathlib.Path("./illum_directory")
 output_dir.mkdir(exist_ok=True)
@@ -63,18 +79,57 @@ plate_info_dictionary = {
     for name in plate_names if next(loaddata_dir.glob(f"{name}*.csv"), None)
 }
 
+# the Python IC functions read the images with the LoadData CSVs that point to the Zarr stores (CellProfiler can not read them)
+if use_python_illum and use_zarr_loaddata:
+    plate_info_dictionary = {
+        name: {**info, "path_to_loaddata": (zarr_dir / f"{name}_zarr.csv").resolve(strict=True)}
+        for name, info in plate_info_dictionary.items()
+    }
+
+# split each plate into one process per channel with a channel-subset LoadData CSV and pipeline (the image sets
+# flagged with the whole image QC measurements are removed once per plate, so each process only loads its channel)
+if fan_out_channels and not use_python_illum:
+    run_dictionary = illum_fanout.create_channel_plate_info_dictionary(
+        plate_info_dictionary=plate_info_dictionary, channels=channels, qc_dir=qc_dir
+    )
+else:
+    run_dictionary = plate_info_dictionary
+
 # view the dictionary to assess that all info is added correctly
-pprint.pprint(plate_info_dictionary, indent=4)
+pprint.pprint(run_dictionary, indent=4)
 
 
 # ## Calculate IC functions and extract image quality features on data
 # 
-# Note: This code cell was not ran as we prefer to perform CellProfiler processing tasks via `sh` file (bash script) which is more stable.
+# By default, the IC functions are calculated in Python with the same settings as the CorrectIlluminationCalculate modules in `illum.cppipe`, skipping the image sets that the FlagImage module flags, and saved as the same `.npy` files.
+# The images of each plate and channel are read in chunks in parallel and added to a running sum, so the images are never all in memory.
+# The running sums are saved in `illum_directory/<plate>/illum_state`, so when wells are re-imaged only the re-imaged image sets are read (the images they replace are subtracted and the new images are added) and plates with no changes are skipped.
+# Set `use_zarr_loaddata = True` to read the images from the Zarr stores instead of the TIFFs (image sets are compared by image path, so the running sums are recalculated once after switching).
+# Set `use_python_illum = False` to run the pipeline with CellProfiler instead.
+# 
+# Note: The CellProfiler processing was not ran in this notebook as we prefer to perform CellProfiler processing tasks via `sh` file (bash script) which is more stable.
+
+# In[ ]:
+
+
+if use_python_illum:
+    illum_calculate.calculate_illum_functions(
+        plate_info_dictionary=plate_info_dictionary, channels=channels, qc_dir=qc_dir
+    )
+else:
+    cp_parallel.run_cellprofiler_parallel(
+        plate_info_dictionary=run_dictionary, run_name=run_name
+    )
+
+
+# ## Copy the per-channel IC functions into the plate folders
+# 
+# When running per channel, each process saves its `.npy` file in its own folder, so we copy them to `illum_directory/<plate>` where the LoadData CSVs with illumination functions expect them.
 
 # In[ ]:
 
 
-cp_parallel.run_cellprofiler_parallel(
-    plate_info_dictionary=plate_info_dictionary, run_name=run_name
-)
+if fan_out_channels and not use_python_illum:
+    for name in plate_info_dictionary:
+        illum_fanout.collect_channel_illum_functions(plate_output_dir=output_dir / name)
 
@@ -14,7 +14,10 @@ import pprint
 import sys
 
 sys.path.append("../utils")
+import cost_model
 import cp_parallel
+import runtime_report
+import sqlite_merge
 
 
 # ## Set paths and variables
@@ -32,6 +35,13 @@ path_to_pipeline = pathlib.Path("./analysis.cppipe").resolve(strict=True)
 output_dir = pathlib.Path("./sqlite_outputs")
 output_dir.mkdir(exist_ok=True)
 
+# platemaps with the cell line of each well, and the folder for the runtime report of the run
+platemap_dir = pathlib.Path("../0.download_data/metadata/platemaps").resolve(strict=True)
+runtime_report_dir = pathlib.Path("./runtime_report")
+
+# cost model (expected seconds per image set by well, cell line and seeding density) built from the previous run
+cost_model_path = pathlib.Path("./cost_model.json")
+
 # directory where loaddata CSVs are located within the folder
 loaddata_dir = pathlib.Path("./loaddata_csvs").resolve(strict=True)
 
@@ -69,12 +79,63 @@ pprint.pprint(plate_info_dictionary, indent=4)
 
 # ## Perform segmentation and feature extraction (analysis)
 # 
+# Each plate is split into shards of whole wells so all CPUs on the machine are used, even when there are fewer plates than CPUs. When a cost model from a previous run exists (`cost_model.json`), the shards are balanced by the predicted processing time of their wells instead of the number of image sets, and the longest shards are started first. All images (and IC functions) in the LoadData CSVs are checked before any CellProfiler process starts, and the run stops if any are missing or corrupt.
+# 
 # Note: This code cell was not ran as we prefer to perform CellProfiler processing tasks via `sh` file (bash script) which is more stable.
 
 # In[ ]:
 
 
 cp_parallel.run_cellprofiler_parallel(
-    plate_info_dictionary=plate_info_dictionary, run_name=run_name
+    plate_info_dictionary=plate_info_dictionary,
+    run_name=run_name,
+    shard_by="well",
+    rows_per_shard=100,
+    validate_images=True,
+    cost_model_path=cost_model_path if cost_model_path.exists() else None,
+)
+
+
+# ## Merge the SQLite outputs from each shard into one SQLite file per plate
+# 
+# The image numbers are updated to not overlap across shards, so the merged SQLite file can be converted with CytoTable in the same way as a whole plate run. A plate is only merged once all of its shards have completed according to the run manifest (`logs/analysis_manifest.json`). The shard SQLite files are kept so a restarted run can skip the shards that completed and the plate can be merged again.
+
+# In[ ]:
+
+
+# the manifest of the run with which shards have completed
+manifest_path = pathlib.Path(f"./logs/{run_name}_manifest.json")
+
+for name in plate_info_dictionary:
+    sqlite_merge.merge_plate_shards(
+        plate_output_dir=output_dir / name, manifest_path=manifest_path
+    )
+
+
+# ## Report the time taken by each CellProfiler module
+# 
+# The `ExecutionTime_*` columns of every merged plate SQLite file are summarized by module, plate and cell line and saved to `runtime_report/` (`runtime_by_module.parquet` and the ranked tables in `runtime_report.txt`), to find which modules to optimize.
+
+# In[ ]:
+
+
+runtime_summaries = runtime_report.create_runtime_report(
+    sqlite_dir=output_dir, platemap_dir=platemap_dir, output_dir=runtime_report_dir
+)
+runtime_summaries["module"].head(10)
+
+
+# ## Build the cost model for the next run
+# 
+# The execution time of every image set in the merged plate SQLite files is saved as a cost model (`cost_model.json`) with the median time per image set by well, by cell line and seeding density, and by seeding density (see [cost_model.py](../utils/cost_model.py)), which the next run uses to balance the shards.
+
+# In[ ]:
+
+
+cost_model.build_cost_model(
+    sqlite_paths=sorted(output_dir.glob("*/alsf_morphology_features.sqlite")),
+    platemap_dir=platemap_dir,
+    output_path=cost_model_path,
 )
+print(f"The cost model has been saved to {cost_model_path}!")
 
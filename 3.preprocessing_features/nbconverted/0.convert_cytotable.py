@@ -65,9 +65,10 @@ for file_path in sqlite_dir.iterdir():
         f"{output_dir}/converted_profiles/{file_path.stem}_converted.parquet"
     )
     print("Starting conversion with cytotable for plate:", file_path.stem)
-    # Merge single cells and output as parquet file
+    # Merge single cells and output as parquet file (only the plate SQLite file, as sharded plates also keep the
+    # SQLite file of each shard in the plate folder)
     convert(
-        source_path=str(file_path),
+        source_path=str(file_path / "alsf_morphology_features.sqlite"),
         dest_path=str(output_path),
         dest_datatype=dest_datatype,
         preset=preset,
@@ -0,0 +1,52 @@
+import pathlib
+import sys
+
+import pandas as pd
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "utils"))
+
+import image_staging  # noqa: E402
+
+
+def _write_job(tmp_path: pathlib.Path, num_files: int, file_bytes: int) -> pathlib.Path:
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    file_names = []
+    for index in range(num_files):
+        (image_dir / f"image_{index}.tiff").write_bytes(b"\0" * file_bytes)
+        file_names.append(f"image_{index}.tiff")
+
+    path_to_loaddata = tmp_path / "job.csv"
+    pd.DataFrame({"FileName_OrigDNA": file_names, "PathName_OrigDNA": str(image_dir)}).to_csv(
+        path_to_loaddata, index=False
+    )
+    return path_to_loaddata
+
+
+def test_job_larger_than_cache_is_not_staged(tmp_path):
+    path_to_loaddata = _write_job(tmp_path, num_files=5, file_bytes=1000)
+    cache = image_staging.create_staging_cache(tmp_path / "scratch", max_bytes=3000)
+
+    staged_jobs = image_staging.start_staging(cache, [("job", path_to_loaddata)])
+    staged = image_staging.wait_for_job(cache, staged_jobs["job"], timeout=10)
+    image_staging.stop_staging(cache)
+
+    assert not staged
+    assert isinstance(staged_jobs["job"]["error"], ValueError)
+    assert cache["used_bytes"] == 0
+
+
+def test_job_that_fits_is_staged(tmp_path):
+    path_to_loaddata = _write_job(tmp_path, num_files=3, file_bytes=1000)
+    cache = image_staging.create_staging_cache(tmp_path / "scratch", max_bytes=3000)
+
+    staged_jobs = image_staging.start_staging(cache, [("job", path_to_loaddata)])
+    staged = image_staging.wait_for_job(cache, staged_jobs["job"], timeout=10)
+
+    assert staged
+    staged_df = pd.read_csv(staged_jobs["job"]["path_to_loaddata"])
+    assert all(
+        (pathlib.Path(path_name) / file_name).exists()
+        for path_name, file_name in zip(staged_df["PathName_OrigDNA"], staged_df["FileName_OrigDNA"])
+    )
+    image_staging.stop_staging(cache)
@@ -0,0 +1,172 @@
+"""
+This collection of functions builds a model of how long CellProfiler takes to process each image set, from the
+`ExecutionTime_*` columns that ExportToDatabase writes to the Per_Image table, and uses it to predict the cost of the
+rows in a LoadData CSV so shards can be balanced and the longest ones started first.
+"""
+
+import json
+import pathlib
+import sqlite3
+from typing import List, Optional
+
+import pandas as pd
+
+# columns used to join the execution times to the platemaps and LoadData CSVs
+METADATA_COLUMNS = ["Image_Metadata_Plate", "Image_Metadata_Well", "Image_Metadata_Site"]
+
+
+def load_execution_times(sqlite_path: pathlib.Path) -> pd.DataFrame:
+    """
+    This function loads the total execution time of each image set from a CellProfiler SQLite file, reading only the
+    metadata and `ExecutionTime_*` columns of the Per_Image table.
+
+    Args:
+        sqlite_path (pathlib.Path): path to the SQLite file for a plate
+
+    Returns:
+        pd.DataFrame: one row per image set with plate, well, site and the total execution time in seconds
+    """
+    with sqlite3.connect(sqlite_path) as connection:
+        columns = [row[1] for row in connection.execute('PRAGMA table_info("Per_Image")')]
+        time_columns = [col for col in columns if col.startswith("Image_ExecutionTime_")]
+
+        query = "SELECT {} FROM Per_Image".format(
+            ", ".join(f'"{col}"' for col in METADATA_COLUMNS + time_columns)
+        )
+        times_df = pd.read_sql_query(query, connection)
+
+    times_df["ExecutionTime_Total"] = times_df[time_columns].sum(axis=1)
+
+    return times_df[METADATA_COLUMNS + ["ExecutionTime_Total"]].rename(
+        columns=lambda col: col.replace("Image_", "")
+    )
+
+
+def load_platemap_metadata(platemap_dir: pathlib.Path) -> pd.DataFrame:
+    """
+    This function loads the cell line and seeding density of each well of each plate, using the barcode platemap
+    to find the platemap layout of each plate.
+
+    Args:
+        platemap_dir (pathlib.Path): path to the platemaps folder (e.g., 0.download_data/metadata/platemaps)
+
+    Returns:
+        pd.DataFrame: one row per plate and well with the cell line and seeding density
+    """
+    barcode_df = pd.read_csv(platemap_dir / "Barcode_platemap_pilot_data.csv")
+
+    platemap_dfs = []
+    for platemap_file, plates_df in barcode_df.groupby("platemap_file"):
+        platemap_df = pd.read_csv(platemap_dir / f"{platemap_file}.csv")
+        for plate in plates_df["barcode"]:
+            platemap_dfs.append(platemap_df[["well", "cell_line", "seeding_density"]].assign(Metadata_Plate=plate))
+
+    return pd.concat(platemap_dfs, ignore_index=True).rename(
+        columns={
+            "well": "Metadata_Well",
+            "cell_line": "Metadata_cell_line",
+            "seeding_density": "Metadata_seeding_density",
+        }
+    )
+
+
+def build_cost_model(
+    sqlite_paths: List[pathlib.Path],
+    platemap_dir: pathlib.Path,
+    output_path: Optional[pathlib.Path] = None,
+) -> dict:
+    """
+    This function builds a cost model (expected seconds per image set) from the execution times of previous runs.
+    The model has lookups from most to least specific, so a prediction can always be made:
+
+    - by_well: median time per image set for each plate and well that was processed before
+    - by_cell_line_density: median time per image set for each cell line and seeding density
+    - by_density: median time per image set for each seeding density
+    - global: median time per image set across all runs
+
+    The platemap metadata of every plate in the barcode platemap is included so wells that were never processed
+    can be predicted from their cell line and seeding density.
+
+    Args:
+        sqlite_paths (List[pathlib.Path]): paths to the SQLite files from previous runs
+        platemap_dir (pathlib.Path): path to the platemaps folder
+        output_path (Optional[pathlib.Path], optional): path to save the model as JSON. Defaults to None (not saved).
+
+    Returns:
+        dict: cost model
+    """
+    platemap_df = load_platemap_metadata(platemap_dir)
+
+    times_df = pd.concat(
+        [load_execution_times(sqlite_path) for sqlite_path in sqlite_paths], ignore_index=True
+    ).merge(platemap_df, on=["Metadata_Plate", "Metadata_Well"], how="left")
+
+    by_well = times_df.groupby(["Metadata_Plate", "Metadata_Well"])["ExecutionTime_Total"].median()
+    by_cell_line_density = times_df.groupby(
+        ["Metadata_cell_line", "Metadata_seeding_density"]
+    )["ExecutionTime_Total"].median()
+    by_density = times_df.groupby("Metadata_seeding_density")["ExecutionTime_Total"].median()
+
+    cost_model = {
+        "by_well": {f"{plate}|{well}": cost for (plate, well), cost in by_well.items()},
+        "by_cell_line_density": {
+            f"{cell_line}|{int(density)}": cost
+            for (cell_line, density), cost in by_cell_line_density.items()
+        },
+        "by_density": {str(int(density)): cost for density, cost in by_density.items()},
+        "global": float(times_df["ExecutionTime_Total"].median()),
+        "platemaps": {
+            f"{row.Metadata_Plate}|{row.Metadata_Well}": [row.Metadata_cell_line, int(row.Metadata_seeding_density)]
+            for row in platemap_df.itertuples()
+        },
+    }
+
+    if output_path is not None:
+        with open(output_path, "w") as model_file:
+            json.dump(cost_model, model_file, indent=4)
+
+    return cost_model
+
+
+def load_cost_model(model_path: pathlib.Path) -> dict:
+    """
+    This function loads a cost model saved by `build_cost_model`.
+
+    Args:
+        model_path (pathlib.Path): path to the cost model JSON file
+
+    Returns:
+        dict: cost model
+    """
+    with open(model_path) as model_file:
+        return json.load(model_file)
+
+
+def predict_loaddata_costs(loaddata_df: pd.DataFrame, cost_model: dict) -> pd.Series:
+    """
+    This function predicts the time CellProfiler will take to process each row (image set) of a LoadData CSV,
+    using the most specific lookup in the cost model that has a value for the row.
+
+    Args:
+        loaddata_df (pd.DataFrame): LoadData rows with `Metadata_Plate` and `Metadata_Well`
+        cost_model (dict): cost model from `build_cost_model`
+
+    Returns:
+        pd.Series: predicted seconds per row
+    """
+    plate_wells = loaddata_df["Metadata_Plate"].astype(str) + "|" + loaddata_df["Metadata_Well"].astype(str)
+
+    # find the cell line and seeding density of each well from the platemaps
+    platemap_info = plate_wells.map(cost_model["platemaps"])
+    cell_line_density = platemap_info.map(
+        lambda info: f"{info[0]}|{info[1]}" if isinstance(info, list) else None
+    )
+    density = platemap_info.map(lambda info: str(info[1]) if isinstance(info, list) else None)
+
+    return (
+        plate_wells.map(cost_model["by_well"])
+        .fillna(cell_line_density.map(cost_model["by_cell_line_density"]))
+        .fillna(density.map(cost_model["by_density"]))
+        .fillna(cost_model["global"])
+        .astype(float)
+    )
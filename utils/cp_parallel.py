@@ -5,79 +5,589 @@ for each process.
 
 import logging
 import multiprocessing
+import os
 import pathlib
+import shutil
+import signal
 import subprocess
-from concurrent.futures import ProcessPoolExecutor, Future
-from typing import List
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, Future, wait
+from logging.handlers import RotatingFileHandler
+from typing import List, Optional, Tuple
 
-from errors.exceptions import MaxWorkerError
+import pandas as pd
 
+import cost_model as cost_model_utils
+import image_staging
+import job_telemetry
+import loaddata_store
+import memory_admission
+import preflight
+import run_manifest
+from errors.exceptions import ImageValidationError, MaxWorkerError
 
-import logging
-import pathlib
-from typing import List
-import subprocess
 
-
-def results_to_log(
-    results: List[subprocess.CompletedProcess], log_dir: pathlib.Path, run_name: str
-) -> None:
+def job_log_path(log_dir: pathlib.Path, run_name: str, job_name: str) -> pathlib.Path:
     """
-    This function converts the list of subprocess results from a CellProfiler parallelization run
-    into a single log file for the entire run.
+    This function returns the path to the log file for one CellProfiler process (plate or shard).
 
     Args:
-        results (List[subprocess.CompletedProcess]): Outputs from subprocess.run
         log_dir (pathlib.Path): Directory for log files
         run_name (str): Name for the type of CellProfiler run (e.g., whole image features)
+        job_name (str): Name of the plate or shard being processed
+
+    Returns:
+        pathlib.Path: path to the log file (e.g., logs/analysis/BR00143976.log)
     """
-    # Create a logger instance specific to this run name
-    logger = logging.getLogger(run_name)
+    return log_dir / run_name / f"{job_name}.log"
+
+
+def create_job_logger(
+    log_path: pathlib.Path,
+    max_log_bytes: int = 50_000_000,
+    log_backup_count: int = 5,
+    mode: str = "w",
+) -> logging.Logger:
+    """
+    This function creates a logger for one CellProfiler process that only writes to its own rotating log file.
+
+    Args:
+        log_path (pathlib.Path): path to the log file for this process
+        max_log_bytes (int, optional): size of the log file before it is rotated. Defaults to 50_000_000.
+        log_backup_count (int, optional): number of rotated log files to keep. Defaults to 5.
+        mode (str, optional): "w" to start a new log file or "a" to add to an existing one. Defaults to "w".
+
+    Returns:
+        logging.Logger: logger for the process
+    """
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Create a logger instance specific to this process and clear any existing handlers to prevent duplicate logging
+    logger = logging.getLogger(f"cellprofiler.{log_path.parent.name}.{log_path.stem}")
     logger.setLevel(logging.INFO)
+    logger.propagate = False
+    close_job_logger(logger)
+
+    handler = RotatingFileHandler(
+        log_path, mode=mode, maxBytes=max_log_bytes, backupCount=log_backup_count
+    )
+    handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s"))
+    logger.addHandler(handler)
+
+    return logger
+
+
+def close_job_logger(logger: logging.Logger) -> None:
+    """
+    This function closes and removes all handlers from a logger created with `create_job_logger`.
 
-    # Clear any existing handlers to prevent duplicate logging
+    Args:
+        logger (logging.Logger): logger for the process
+    """
     for handler in logger.handlers[:]:
+        handler.close()
         logger.removeHandler(handler)
 
+
+def stop_process_group(pid: int, stopped: threading.Event) -> None:
+    """
+    Stop a process and any processes it started (its process group), if they have not already exited.
+    """
+    stopped.set()
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_cellprofiler_command(
+    command: List[str],
+    log_path: pathlib.Path,
+    max_log_bytes: int = 50_000_000,
+    log_backup_count: int = 5,
+    timeout_seconds: Optional[float] = None,
+    log_mode: str = "w",
+) -> Tuple[subprocess.CompletedProcess, dict]:
+    """
+    This function runs one CellProfiler command and streams its output (stdout and stderr) line by line into a
+    rotating log file, so the output can be followed while the process runs and memory use does not grow with the
+    amount of output. The resources used by the process are collected when it exits (see `job_telemetry`).
+
+    Args:
+        command (List[str]): CellProfiler CLI command
+        log_path (pathlib.Path): path to the log file for this process
+        max_log_bytes (int, optional): size of the log file before it is rotated. Defaults to 50_000_000.
+        log_backup_count (int, optional): number of rotated log files to keep. Defaults to 5.
+        timeout_seconds (Optional[float], optional): maximum wall time of the process, after which it is stopped with
+            any processes it started (the return code is then negative). Defaults to None (no limit).
+        log_mode (str, optional): "w" to start a new log file or "a" to add to it (e.g., for a retry). Defaults to "w".
+
+    Returns:
+        Tuple[subprocess.CompletedProcess, dict]: the command and return code of the process (the output is only in
+            the log file) and the resource usage of the process
+    """
+    logger = create_job_logger(log_path, max_log_bytes, log_backup_count, mode=log_mode)
+
+    # CellProfiler writes its progress to stderr, so both streams are merged into one pipe
+    start_time = time.perf_counter()
+    stopped = threading.Event()
+    timer = None
+    with subprocess.Popen(
+        args=command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        bufsize=1,
+        # with a timeout, run in its own process group so the processes it starts are also stopped
+        start_new_session=timeout_seconds is not None,
+    ) as process:
+        if timeout_seconds is not None:
+            timer = threading.Timer(timeout_seconds, stop_process_group, args=(process.pid, stopped))
+            timer.daemon = True
+            timer.start()
+        for line in process.stdout:
+            logger.info(line.rstrip("\n"))
+        returncode, usage = job_telemetry.wait_with_usage(process, start_time)
+        if timer is not None:
+            timer.cancel()
+
+    if stopped.is_set() and returncode < 0:
+        logger.info(f"CellProfiler did not finish within {timeout_seconds} seconds and was stopped")
+    logger.info(f"CellProfiler exited with return code {returncode}")
+
+    close_job_logger(logger)
+
+    return subprocess.CompletedProcess(args=command, returncode=returncode), usage
+
+
+def results_to_log(
+    results: List[subprocess.CompletedProcess], log_dir: pathlib.Path, run_name: str
+) -> None:
+    """
+    This function combines the log files from each process of a CellProfiler parallelization run
+    into a single log file for the entire run.
+
+    Args:
+        results (List[subprocess.CompletedProcess]): Outputs from `run_cellprofiler_command`
+        log_dir (pathlib.Path): Directory for log files
+        run_name (str): Name for the type of CellProfiler run (e.g., whole image features)
+    """
     # Set up the log file path
     log_file_path = log_dir / f"{run_name}_combined_run.log"
-    handler = logging.FileHandler(
-        log_file_path, mode="w"
-    )  # Overwrite each time with 'w'
-    formatter = logging.Formatter(
-        "[%(asctime)s] %(message)s"
-    )  # Simple format without process ID
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
 
-    # Log each result's output
-    for result in results:
-        plate_name = result.args[6].name
-        output_string = result.stderr.decode("utf-8")
+    # Overwrite each time with 'w' and copy each process log in chunks so the logs are never fully loaded in memory
+    with open(log_file_path, mode="w") as combined_log:
+        for result in results:
+            plate_name = result.args[6].name
+            process_log_path = job_log_path(log_dir, run_name, plate_name)
+
+            combined_log.write(f"Plate Name: {plate_name}\n")
+            combined_log.write(f"Return Code: {result.returncode}\n")
+
+            # rotated files hold older output (highest suffix is oldest) so they are copied first
+            rotated_paths = sorted(
+                process_log_path.parent.glob(f"{process_log_path.name}.*"),
+                key=lambda path: int(path.suffix[1:]) if path.suffix[1:].isdigit() else 0,
+                reverse=True,
+            )
+            for path in rotated_paths + [process_log_path]:
+                if path.exists():
+                    with open(path) as process_log:
+                        shutil.copyfileobj(process_log, combined_log)
+
+
+def shard_loaddata_csv(
+    path_to_loaddata: pathlib.Path,
+    shard_dir: pathlib.Path,
+    shard_prefix: str,
+    shard_by: str = "well",
+    rows_per_shard: int = 100,
+    cost_model: Optional[dict] = None,
+) -> List[pathlib.Path]:
+    """
+    This function splits a LoadData CSV into smaller LoadData CSVs (shards) that can each be processed by
+    an independent CellProfiler process. Row order from the original CSV is kept within and across shards.
+
+    When a cost model is given (see `cost_model.build_cost_model`), shards are packed by predicted processing time
+    instead of by number of rows, so a shard of dense wells has fewer image sets than a shard of sparse wells and
+    all shards take about as long as `rows_per_shard` image sets of average cost.
+
+    Args:
+        path_to_loaddata (pathlib.Path): path to the LoadData CSV (or Parquet file) for the plate
+        shard_dir (pathlib.Path): directory where the shard LoadData CSVs are saved
+        shard_prefix (str): prefix for the shard file names (normally the plate name)
+        shard_by (str, optional): "well" to keep all sites of a well in the same shard or "site" to split
+            on any image set. Defaults to "well".
+        rows_per_shard (int, optional): target number of image sets (rows) per shard. When sharding by
+            well, a shard is closed once it reaches this number so a shard can be slightly larger. Defaults to 100.
+        cost_model (Optional[dict], optional): cost model to balance shards by predicted time. Defaults to None.
+
+    Raises:
+        ValueError: if `shard_by` is not "well" or "site" or `rows_per_shard` is less than 1
+
+    Returns:
+        List[pathlib.Path]: paths to the shard LoadData CSVs in order
+    """
+    if shard_by not in ("well", "site"):
+        raise ValueError(f"shard_by must be 'well' or 'site', not '{shard_by}'")
+    if rows_per_shard < 1:
+        raise ValueError("rows_per_shard must be at least 1")
+
+    loaddata_df = loaddata_store.read_loaddata(path_to_loaddata)
+
+    # weight each row by its predicted cost (or 1 per row) and aim for the weight of `rows_per_shard` average rows
+    if cost_model is not None:
+        row_weights = cost_model_utils.predict_loaddata_costs(loaddata_df, cost_model)
+    else:
+        row_weights = pd.Series(1.0, index=loaddata_df.index)
+    target_weight = rows_per_shard * row_weights.mean()
+
+    if shard_by == "site":
+        # every row is an image set, so any row can start a new shard
+        units = pd.Series(range(len(loaddata_df)), index=loaddata_df.index)
+    else:
+        # give each contiguous run of the same well its own number so wells are never split
+        units = (
+            loaddata_df["Metadata_Well"] != loaddata_df["Metadata_Well"].shift()
+        ).cumsum()
+    unit_weights = row_weights.groupby(units.values, sort=True).sum()
+
+    # greedily pack units into a shard until the shard reaches the target weight
+    unit_to_shard = {}
+    shard_id, shard_weight = 0, 0.0
+    for unit, unit_weight in unit_weights.items():
+        if shard_weight >= target_weight:
+            shard_id, shard_weight = shard_id + 1, 0.0
+        unit_to_shard[unit] = shard_id
+        shard_weight += unit_weight
+    shard_ids = units.map(unit_to_shard)
+
+    # remove shards from previous runs, which may have split the plate differently
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    for old_shard_path in shard_dir.glob(f"{shard_prefix}_shard*.csv"):
+        old_shard_path.unlink()
+
+    shard_paths = []
+    for shard_id, shard_df in loaddata_df.groupby(shard_ids.values, sort=True):
+        shard_path = shard_dir / f"{shard_prefix}_shard{shard_id:04d}.csv"
+        if loaddata_store.is_parquet(path_to_loaddata):
+            # stream the shard rows from the Parquet file so the CSV has the same values as the full LoadData CSV
+            loaddata_store.write_loaddata_csv(path_to_loaddata, shard_path, row_indices=shard_df.index)
+        else:
+            shard_df.to_csv(shard_path, index=False)
+        shard_paths.append(shard_path)
+
+    return shard_paths
+
+
+def create_sharded_plate_info_dictionary(
+    plate_info_dictionary: dict,
+    shard_by: str = "well",
+    rows_per_shard: int = 100,
+    cost_model: Optional[dict] = None,
+) -> dict:
+    """
+    This function converts a plate info dictionary (one entry per plate) into a dictionary with one entry per
+    shard of each plate's LoadData CSV. Each shard writes its outputs into its own folder within the plate output
+    folder (e.g., sqlite_outputs/<plate>/<plate>_shard0000).
+
+    Plates that use a path to images instead of a LoadData CSV can not be split and are kept as a single entry.
+
+    Note: Only use sharding for pipelines that process each image set independently (e.g., whole image QC and
+    analysis). Pipelines that aggregate across all image sets (e.g., illumination correction) must see the whole plate.
+
+    Args:
+        plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline per plate
+        shard_by (str, optional): "well" or "site", see `shard_loaddata_csv`. Defaults to "well".
+        rows_per_shard (int, optional): target number of image sets per shard. Defaults to 100.
+        cost_model (Optional[dict], optional): cost model to balance shards by predicted time. Defaults to None.
+
+    Returns:
+        dict: dictionary with all paths for CellProfiler to run a pipeline per shard
+    """
+    sharded_info_dictionary = {}
+
+    for plate_name, info in plate_info_dictionary.items():
+        if "path_to_loaddata" not in info:
+            sharded_info_dictionary[plate_name] = info
+            continue
+
+        plate_output = pathlib.Path(info["path_to_output"])
+
+        shard_paths = shard_loaddata_csv(
+            path_to_loaddata=pathlib.Path(info["path_to_loaddata"]),
+            shard_dir=plate_output / "loaddata_shards",
+            shard_prefix=plate_name,
+            shard_by=shard_by,
+            rows_per_shard=rows_per_shard,
+            cost_model=cost_model,
+        )
 
-        # Log plate name and output string
-        logger.info(f"Plate Name: {plate_name}")
-        logger.info(f"Output String: {output_string}")
+        for shard_path in shard_paths:
+            sharded_info_dictionary[shard_path.stem] = {
+                "path_to_loaddata": shard_path,
+                "path_to_output": plate_output / shard_path.stem,
+                "path_to_pipeline": info["path_to_pipeline"],
+                "plate_name": plate_name,
+            }
 
-    # Clean up by closing and removing the handler after all logs are written
-    handler.close()
-    logger.removeHandler(handler)
+    return sharded_info_dictionary
+
+
+def predict_job_cost(info: dict, cost_model: dict) -> float:
+    """
+    This function predicts how long a CellProfiler process (plate or shard) will take from its LoadData CSV.
+
+    Args:
+        info (dict): paths for CellProfiler to run a pipeline (one value from the plate info dictionary)
+        cost_model (dict): cost model from `cost_model.build_cost_model`
+
+    Returns:
+        float: predicted seconds, or 0 if the process uses a path to images instead of a LoadData CSV
+    """
+    if "path_to_loaddata" not in info:
+        return 0.0
+
+    loaddata_df = loaddata_store.read_loaddata(
+        info["path_to_loaddata"], columns=["Metadata_Plate", "Metadata_Well"]
+    )
+    return float(cost_model_utils.predict_loaddata_costs(loaddata_df, cost_model).sum())
+
+
+def create_cellprofiler_command(info: dict) -> List:
+    """
+    This function creates the CellProfiler CLI command for one plate (or shard) and makes its output folder.
+
+    Args:
+        info (dict): paths for CellProfiler to run a pipeline (one value from the plate info dictionary)
+
+    Raises:
+        FileNotFoundError: if paths to pipeline and images do not exist
+
+    Returns:
+        List: CellProfiler CLI command, where the output path is always at index 6
+    """
+    # set paths for CellProfiler
+    path_to_pipeline = info["path_to_pipeline"]
+    path_to_output = info["path_to_output"]
+
+    # make output directory if it is not already created
+    pathlib.Path(path_to_output).mkdir(parents=True, exist_ok=True)
+
+    # check to make sure paths to pipeline are correct before running the pipeline
+    if not pathlib.Path(path_to_pipeline).resolve(strict=True):
+        raise FileNotFoundError(
+            f"The file '{pathlib.Path(path_to_pipeline).name}' does not exist"
+        )
+
+    # set the correct CellProfiler command for if using images or a LoadData CSV
+    if "path_to_loaddata" in info:
+        # assign path to loaddata csv as variable (written from the Parquet file if LoadData is stored as Parquet)
+        path_to_loaddata = loaddata_store.get_loaddata_csv(info["path_to_loaddata"])
+
+        # set command up to use for a loaddata csv
+        command = [
+            "cellprofiler",
+            "-c",
+            "-r",
+            "-p",
+            path_to_pipeline,
+            "-o",
+            path_to_output,
+            "--data-file",
+            path_to_loaddata,
+        ]
+    else:
+        # assign path to images as variable
+        path_to_images = info["path_to_images"]
+
+        # check to make sure path to images is a directory and exists
+        if not pathlib.Path(path_to_images).is_dir():
+            raise FileNotFoundError(
+                f"Directory '{pathlib.Path(path_to_images).name}' does not exist or is not a directory"
+            )
+        # set command up to use for a path to images
+        command = [
+            "cellprofiler",
+            "-c",
+            "-r",
+            "-p",
+            path_to_pipeline,
+            "-o",
+            path_to_output,
+            "-i",
+            path_to_images,
+        ]
+
+    return command
+
+
+def format_seconds(seconds: float) -> str:
+    """
+    Format a number of seconds as HH:MM:SS (hours can be more than 24).
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def format_progress(
+    results: List[Optional[subprocess.CompletedProcess]],
+    pending: List[int],
+    running: dict,
+    job_image_sets: List[Optional[int]],
+    elapsed_seconds: float,
+) -> str:
+    """
+    This function summarizes the progress of a run: the finished and failed processes, the image sets of the finished
+    processes and the estimated time remaining from the image sets processed so far.
+
+    Args:
+        results (List[Optional[subprocess.CompletedProcess]]): result of the last attempt of each process (None if
+            it has not finished)
+        pending (List[int]): indexes of the processes waiting to start (or to be started again)
+        running (dict): indexes of the running processes
+        job_image_sets (List[Optional[int]]): number of image sets of each process
+        elapsed_seconds (float): time since the run started
+
+    Returns:
+        str: progress summary
+    """
+    finished = [
+        index
+        for index, result in enumerate(results)
+        if result is not None and index not in pending and index not in running.values()
+    ]
+    num_failed = sum(results[index].returncode != 0 for index in finished)
+    image_sets_done = sum(job_image_sets[index] or 0 for index in finished)
+    image_sets_total = sum(image_sets or 0 for image_sets in job_image_sets)
+
+    line = (
+        f"{len(finished)}/{len(results)} processes done ({num_failed} failed), "
+        f"{image_sets_done}/{image_sets_total} image sets, elapsed {format_seconds(elapsed_seconds)}"
+    )
+    if 0 < image_sets_done < image_sets_total:
+        remaining_seconds = (image_sets_total - image_sets_done) * elapsed_seconds / image_sets_done
+        line += f", ETA {format_seconds(remaining_seconds)}"
+
+    return line
 
 
 def run_cellprofiler_parallel(
     plate_info_dictionary: dict,
     run_name: str,
+    shard_by: Optional[str] = None,
+    rows_per_shard: int = 100,
+    max_workers: Optional[int] = None,
+    resume: bool = True,
+    memory_per_job_bytes: Optional[int] = None,
+    memory_budget_bytes: Optional[int] = None,
+    min_available_bytes: int = 4 * 1024**3,
+    cost_model_path: Optional[pathlib.Path] = None,
+    validate_images: bool = False,
+    scratch_dir: Optional[pathlib.Path] = None,
+    scratch_bytes: int = 100 * 1024**3,
+    staging_timeout: Optional[float] = 3600,
+    timeout_seconds: Optional[float] = None,
+    retries: int = 0,
+    backoff_seconds: float = 30.0,
+    progress_interval_seconds: Optional[float] = 60.0,
 ) -> None:
     """
     This function utilizes multi-processing to run CellProfiler pipelines in parallel.
 
+    By default, one CellProfiler process is run per plate. When `shard_by` is set, each plate's LoadData CSV
+    is split into shards (see `create_sharded_plate_info_dictionary`) and all shards are run through a worker
+    pool that is bounded by the number of CPUs, so wall time scales with the number of cores instead of plates.
+
+    The wall time, CPU time, peak memory, bytes read and image sets per second of every process are saved to
+    logs/<run_name>_metrics.json with the plate name of each process.
+
+    Every finished process is recorded in a manifest (logs/<run_name>_manifest.json) keyed by a hash of the pipeline,
+    the LoadData rows and the output path. When `resume` is True, processes that already completed with the same
+    inputs are skipped, so a restarted run only redoes the plates or shards that were incomplete or failed.
+
+    Processes are only started while their projected memory fits in `memory_budget_bytes` and the machine keeps
+    `min_available_bytes` available (see `memory_admission.can_start_job`). The memory per process is taken from
+    `memory_per_job_bytes`, or else the largest peak RSS of a previous run with the same run name, and is raised to
+    the largest peak RSS seen as processes finish.
+
+    With a cost model (see `cost_model.build_cost_model`), shards are balanced by predicted processing time and the
+    processes predicted to take longest are started first, so all workers finish at about the same time.
+
+    With a `scratch_dir` (on a local drive), the images of each process are copied there in LoadData row order by one
+    thread, ahead of the processes in the order they start (see `image_staging.start_staging`), and each process reads
+    them from there. This keeps the reads from the raw image drive sequential. The staged images are limited to
+    `scratch_bytes`, removing the least recently used images of finished processes first. Processes with more images
+    than fit in `scratch_bytes` read them from where they are.
+
+    Each process can be stopped after `timeout_seconds` (with any processes it started), and failed or stopped
+    processes are started again up to `retries` times, after a backoff that doubles for each retry. Retries wait in
+    the queue without holding a worker and add to the same log file. The number of finished processes and image sets
+    and the estimated time remaining are printed every `progress_interval_seconds`.
+
     Args:
         plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline
         run_name (str): a given name for the type of CellProfiler run being done on the plates (example: whole image features)
+        shard_by (Optional[str], optional): "well" or "site" to split each plate into shards. Defaults to None (one process per plate).
+        rows_per_shard (int, optional): target number of image sets per shard when sharding. Defaults to 100.
+        max_workers (Optional[int], optional): maximum number of CellProfiler processes to run at once.
+            Defaults to None (the number of CPUs on the machine).
+        resume (bool, optional): skip processes that already completed according to the manifest and whose output files
+            are still there and not empty. Defaults to True.
+        memory_per_job_bytes (Optional[int], optional): estimated peak memory of one CellProfiler process.
+            Defaults to None (learned from previous and current runs).
+        memory_budget_bytes (Optional[int], optional): maximum total memory for all CellProfiler processes.
+            Defaults to None (90% of the memory on the machine).
+        min_available_bytes (int, optional): memory that should always stay available on the machine. Defaults to 4 GiB.
+        cost_model_path (Optional[pathlib.Path], optional): path to a cost model JSON file from previous runs.
+            Defaults to None (shards are balanced by number of image sets and run in order).
+        validate_images (bool, optional): check every image in the LoadData of the processes to run before starting
+            (see `preflight.validate_loaddata_images`) and save the problems to logs/<run_name>_preflight.csv.
+            Defaults to False.
+        scratch_dir (Optional[pathlib.Path], optional): path to a local folder to stage the images of each process in.
+            Defaults to None (processes read the images from where they are).
+        scratch_bytes (int, optional): maximum size of the staged images. Defaults to 100 GiB.
+        staging_timeout (Optional[float], optional): maximum seconds to wait for the images of a process to be staged
+            when no other process is running, after which it reads them from where they are. Defaults to 3600.
+        timeout_seconds (Optional[float], optional): maximum wall time of one attempt of a process before it is
+            stopped. Defaults to None (no limit).
+        retries (int, optional): number of times to start a failed or stopped process again. Defaults to 0.
+        backoff_seconds (float, optional): wait before the first retry, which doubles for each retry after.
+            Defaults to 30.0.
+        progress_interval_seconds (Optional[float], optional): time between progress updates. Defaults to 60.0
+            (None to not print progress).
 
     Raises:
         FileNotFoundError: if paths to pipeline and images do not exist
+        MaxWorkerError: if `max_workers` is more than the number of CPUs on the machine
+        ImageValidationError: if `validate_images` is True and any image has a problem
     """
+    cost_model = (
+        cost_model_utils.load_cost_model(cost_model_path) if cost_model_path is not None else None
+    )
+
+    # split each plate into work units if requested
+    if shard_by is not None:
+        plate_info_dictionary = create_sharded_plate_info_dictionary(
+            plate_info_dictionary=plate_info_dictionary,
+            shard_by=shard_by,
+            rows_per_shard=rows_per_shard,
+            cost_model=cost_model,
+        )
+
+    # order the plates (or shards) from longest to shortest predicted time so the longest start first
+    if cost_model is not None:
+        plate_info_dictionary = dict(
+            sorted(
+                plate_info_dictionary.items(),
+                key=lambda item: predict_job_cost(item[1], cost_model),
+                reverse=True,
+            )
+        )
+
     # create a list of commands for each plate with their respective log file
     commands = []
 
@@ -85,99 +595,237 @@ def run_cellprofiler_parallel(
     log_dir = pathlib.Path("./logs")
     log_dir.mkdir(parents=True, exist_ok=True)
 
-    # iterate through each plate in the dictionary
-    for _, info in plate_info_dictionary.items():
-        # set paths for CellProfiler
-        path_to_pipeline = info["path_to_pipeline"]
-        path_to_output = info["path_to_output"]
+    # load the record of which processes already finished in previous runs
+    manifest_path = log_dir / f"{run_name}_manifest.json"
+    manifest = run_manifest.load_manifest(manifest_path)
+    job_keys = []
 
-        # make output directory if it is not already created
-        pathlib.Path(path_to_output).mkdir(exist_ok=True)
+    # files each process is expected to write (from the export modules of its pipeline) and its output folder
+    pipeline_outputs = {}
+    job_outputs = []
+    job_output_paths = []
 
-        # check to make sure paths to pipeline are correct before running the pipeline
-        if not pathlib.Path(path_to_pipeline).resolve(strict=True):
-            raise FileNotFoundError(
-                f"The file '{pathlib.Path(path_to_pipeline).name}' does not exist"
-            )
+    # plate name and number of image sets per process for the run metrics
+    job_plates = []
+    job_image_sets = []
+    job_loaddata_paths = []
 
-        # set the correct CellProfiler command for if using images or a LoadData CSV
-        if "path_to_loaddata" in info:
-            # assign path to loaddata csv as variable
-            path_to_loaddata = info["path_to_loaddata"]
-
-            # set command up to use for a loaddata csv
-            command = [
-                "cellprofiler",
-                "-c",
-                "-r",
-                "-p",
-                path_to_pipeline,
-                "-o",
-                path_to_output,
-                "--data-file",
-                path_to_loaddata,
-            ]
-        else:
-            # assign path to images as variable
-            path_to_images = info["path_to_images"]
+    # iterate through each plate in the dictionary
+    for name, info in plate_info_dictionary.items():
+        path_to_output = info["path_to_output"]
 
-            # check to make sure path to images is a directory and exists
-            if not pathlib.Path(path_to_images).is_dir():
-                raise FileNotFoundError(
-                    f"Directory '{pathlib.Path(path_to_images).name}' does not exist or is not a directory"
-                )
-            # set command up to use for a path to images
-            command = [
-                "cellprofiler",
-                "-c",
-                "-r",
-                "-p",
-                path_to_pipeline,
-                "-o",
-                path_to_output,
-                "-i",
-                path_to_images,
-            ]
+        # skip the plate if it already completed with the same pipeline, LoadData rows and output path
+        job_key = run_manifest.compute_job_key(
+            path_to_pipeline=info["path_to_pipeline"],
+            path_to_output=path_to_output,
+            path_to_loaddata=info.get("path_to_loaddata"),
+            path_to_images=info.get("path_to_images"),
+        )
+        path_to_pipeline = str(info["path_to_pipeline"])
+        if path_to_pipeline not in pipeline_outputs:
+            pipeline_outputs[path_to_pipeline] = run_manifest.get_pipeline_outputs(path_to_pipeline)
+        if resume and run_manifest.is_job_completed(
+            manifest, job_key, path_to_output, expected_outputs=pipeline_outputs[path_to_pipeline]
+        ):
+            print(f"{pathlib.Path(path_to_output).name} has already been completed, skipping.")
+            continue
+
+        # set the correct CellProfiler command for if using images or a LoadData CSV (only for processes that run, as
+        # it makes the output folder and writes the LoadData CSV from a Parquet file)
+        command = create_cellprofiler_command(info)
 
         # Append the commands for as many plates being processed
         commands.append(command)
+        job_keys.append(job_key)
+        job_outputs.append(pipeline_outputs[path_to_pipeline])
+        job_output_paths.append(path_to_output)
+        job_plates.append(info.get("plate_name", name))
+        job_image_sets.append(job_telemetry.count_loaddata_rows(info.get("path_to_loaddata")))
+        job_loaddata_paths.append(info.get("path_to_loaddata"))
+
+    if not commands:
+        print("All processes have already been completed!")
+        return
+
+    # check all images before starting so a missing or corrupt image does not fail a process hours into the run
+    if validate_images:
+        problems_df = preflight.validate_loaddata_images(
+            [path_to_loaddata for path_to_loaddata in job_loaddata_paths if path_to_loaddata is not None]
+        )
+        if not problems_df.empty:
+            problems_path = log_dir / f"{run_name}_preflight.csv"
+            problems_df.to_csv(problems_path, index=False)
+            raise ImageValidationError(
+                f"{len(problems_df)} images have problems, see {problems_path}. No CellProfiler processes were started."
+            )
 
-    # set the number of CPUs/workers as the number of commands
-    num_processes = len(commands)
+    # default to using every CPU on the machine
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
 
     # make sure that the number of workers does not exceed the maximum number of workers for the machine
-    if num_processes > multiprocessing.cpu_count():
+    if max_workers > multiprocessing.cpu_count():
         raise MaxWorkerError(
-            "Exception occurred: The number of commands exceeds the number of CPUs/workers. Please reduce the number of commands."
+            "Exception occurred: The number of workers exceeds the number of CPUs/workers. Please reduce max_workers."
+        )
+
+    # set the number of CPUs/workers as the number of commands, bounded by the maximum number of workers
+    num_processes = min(len(commands), max_workers)
+
+    # set the memory limits, using the peak memory of a previous run of the same pipeline if no estimate is given
+    metrics_path = log_dir / f"{run_name}_metrics.json"
+    if memory_budget_bytes is None:
+        memory_budget_bytes = int(0.9 * memory_admission.get_total_memory_bytes())
+    if memory_per_job_bytes is None:
+        memory_per_job_bytes = memory_admission.estimate_job_memory_from_metrics(metrics_path)
+
+    # stage the images of the processes in the order they will start
+    staging_cache = None
+    if scratch_dir is not None:
+        staging_cache = image_staging.create_staging_cache(scratch_dir, scratch_bytes)
+        staged_jobs = image_staging.start_staging(
+            staging_cache,
+            [(pathlib.Path(command[6]).name, job_loaddata_paths[index]) for index, command in enumerate(commands)],
         )
 
-    # set parallelization executer to the number of commands
+    # set parallelization executer to the number of workers
     executor = ProcessPoolExecutor(max_workers=num_processes)
 
-    # creates a list of futures that are each CellProfiler process for each plate
-    futures: List[Future] = [
-        executor.submit(
-            subprocess.run,
-            args=command,
-            capture_output=True,
-        )
-        for command in commands
-    ]
+    # commands are only submitted once there is a free worker and enough memory, so they wait here instead of
+    # in the pool queue (the index of each command is used to keep results in the same order as the commands)
+    pending = list(range(len(commands)))
+    running = {}
+    results: List[Optional[subprocess.CompletedProcess]] = [None] * len(commands)
+    metrics = []
+
+    # number of times each process was started, and when a failed process can be started again
+    attempts = [0] * len(commands)
+    retry_times = {}
+
+    start_time = time.perf_counter()
+    next_progress_time = start_time + (progress_interval_seconds or 0)
+
+    while pending or running:
+        # start as many processes as the workers and memory allow
+        while pending and memory_admission.can_start_job(
+            num_running=len(running),
+            max_workers=num_processes,
+            memory_per_job_bytes=memory_per_job_bytes,
+            memory_budget_bytes=memory_budget_bytes,
+            min_available_bytes=min_available_bytes,
+        ):
+            # the next process in order that is not waiting for its retry backoff
+            index = next((index for index in pending if retry_times.get(index, 0) <= time.perf_counter()), None)
+            if index is None:
+                break
+            command = commands[index]
+
+            # wait for the images of the next process to be staged (without waiting if other processes are running),
+            # and read them from where they are for a retry, as its staged images were released
+            if staging_cache is not None and attempts[index] == 0:
+                staged_job = staged_jobs[pathlib.Path(command[6]).name]
+                if not staged_job["event"].is_set():
+                    if running:
+                        break
+                    image_staging.wait_for_job(staging_cache, staged_job, timeout=staging_timeout)
+                if staged_job["error"] is not None:
+                    print(
+                        f"Images for {pathlib.Path(command[6]).name} could not be staged ({staged_job['error']}), "
+                        "reading them from where they are"
+                    )
+                elif staged_job["path_to_loaddata"] is not None:
+                    command = command[:8] + [staged_job["path_to_loaddata"]] + command[9:]
+
+            pending.remove(index)
+            attempts[index] += 1
+            # each CellProfiler process streams its output to a log file per process (retries add to it)
+            future: Future = executor.submit(
+                run_cellprofiler_command,
+                command=command,
+                log_path=job_log_path(log_dir, run_name, pathlib.Path(command[6]).name),
+                timeout_seconds=timeout_seconds,
+                log_mode="w" if attempts[index] == 1 else "a",
+            )
+            running[future] = index
+
+        # wait for a process to finish, checking the available memory (and staging) again after a short time if none do
+        if running:
+            done, _ = wait(running, timeout=1 if staging_cache is not None else 10, return_when=FIRST_COMPLETED)
+        else:
+            # only processes waiting for their retry backoff are left
+            time.sleep(1)
+            done = set()
+
+        # record each process in the manifest as soon as it finishes so a restart can skip it
+        for future in done:
+            index = running.pop(future)
+            result, usage = future.result()
+            results[index] = result
+            job_name = pathlib.Path(result.args[6]).name
+
+            # the staged images of the process can be removed when the cache is full
+            if staging_cache is not None:
+                image_staging.release_files(staging_cache, staged_jobs[job_name]["source_paths"])
+                staged_jobs[job_name]["source_paths"] = []
+
+            # learn the memory needed per process from the processes that have finished
+            memory_per_job_bytes = max(memory_per_job_bytes or 0, usage["peak_rss_bytes"])
+
+            # start a failed process again after a backoff that doubles for each retry
+            if result.returncode != 0 and attempts[index] <= retries:
+                backoff = backoff_seconds * 2 ** (attempts[index] - 1)
+                print(
+                    f"{job_name} failed with return code {result.returncode}, starting it again in {backoff:g} seconds "
+                    f"(attempt {attempts[index] + 1} of {retries + 1})"
+                )
+                retry_times[index] = time.perf_counter() + backoff
+                pending.append(index)
+                continue
+
+            # record the files the process wrote so it is only skipped on a restart while they are still there (all
+            # files in the output folder if the pipeline does not export data)
+            run_manifest.record_job(
+                manifest=manifest,
+                job_key=job_keys[index],
+                job_name=job_name,
+                returncode=result.returncode,
+                outputs=job_outputs[index] or run_manifest.list_output_files(job_output_paths[index]),
+            )
+            run_manifest.save_manifest(manifest, manifest_path)
+
+            metrics.append(
+                job_telemetry.create_job_metrics(
+                    job_name=job_name,
+                    plate_name=job_plates[index],
+                    returncode=result.returncode,
+                    usage=usage,
+                    image_sets=job_image_sets[index],
+                    attempts=attempts[index],
+                )
+            )
+
+        if progress_interval_seconds is not None and time.perf_counter() >= next_progress_time:
+            print(format_progress(results, pending, running, job_image_sets, time.perf_counter() - start_time))
+            next_progress_time += progress_interval_seconds
+
+    executor.shutdown()
+
+    if staging_cache is not None:
+        image_staging.stop_staging(staging_cache)
 
-    # the list of CompletedProcesses holds all the information from the CellProfiler run
-    results: List[subprocess.CompletedProcess] = [future.result() for future in futures]
+    # save the resource usage of each process for the run
+    job_telemetry.write_run_metrics(metrics, metrics_path)
 
     print("All processes have been completed!")
 
-    # for each process, confirm that the process completed successfully and return a log file
+    # for each process, confirm that the process completed successfully
     for result in results:
         plate_name = result.args[6].name
-        # convert the results into log files
-        results_to_log(results=results, log_dir=log_dir, run_name=run_name)
-        if result.returncode == 1:
+        if result.returncode != 0:
             print(
                 f"A return code of {result.returncode} was returned for {plate_name}, which means there was an error in the CellProfiler run."
             )
 
-    # to avoid having multiple print statements due to for loop, confirmation that logs are converted is printed here
+    # convert the results into one log file for the run once all processes are done
+    results_to_log(results=results, log_dir=log_dir, run_name=run_name)
     print("All results have been converted to log files!")
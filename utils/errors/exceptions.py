@@ -7,3 +7,10 @@ class MaxWorkerError(Exception):
     Raised when the number of workers assigned to `max_workers` exceeds the number of CPU/workers on the machine. 
     """
     pass
+
+
+class ImageValidationError(Exception):
+    """
+    Raised when images referenced by a LoadData CSV are missing, empty, truncated or corrupt, so CellProfiler is not started.
+    """
+    pass
@@ -0,0 +1,654 @@
+"""
+This collection of functions calculates the illumination correction functions per plate and channel without
+CellProfiler, with the same steps and settings as the CorrectIlluminationCalculate modules in the illumination
+correction pipeline. The images of a channel are streamed in chunks and folded into a running sum, so the image stack
+is never in memory, and image sets flagged by the FlagImage module are skipped. The `.npy` files are saved with the
+same names and values as the SaveImages modules, so the LoadData CSVs with illumination functions and the analysis
+pipeline use them unchanged.
+"""
+
+import json
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+
+import illum_fanout
+import image_qc
+import loaddata_store
+import zarr_store
+
+# image sets folded into the running sum by one process at a time
+CHUNK_SIZE = 64
+
+# folder in the plate output folder with the running sums, to update the illumination functions
+STATE_DIR_NAME = "illum_state"
+
+# settings of CorrectIlluminationCalculate that can be calculated here
+SUPPORTED_SETTINGS = {
+    "Select how the illumination function is calculated": ["Background", "Regular"],
+    "Dilate objects in the final averaged image?": ["No"],
+    "Calculate function for each image individually, or based on all images?": [
+        "All: Across cycles",
+        "All: First cycle",
+    ],
+    "Smoothing method": ["Fit Polynomial", "Gaussian Filter", "No smoothing"],
+    "Method to calculate smoothing filter size": ["Automatic", "Object size", "Manually"],
+    "Rescale the illumination function?": ["No", "Yes", "Median"],
+}
+
+
+def _parse_module_settings(module: str) -> Dict[str, str]:
+    """
+    Parse the settings of a pipeline module block into a dictionary (the last value is kept for repeated settings).
+    """
+    settings = {}
+    for line in module.splitlines()[1:]:
+        key, _, value = line.strip().partition(":")
+        settings[key] = value
+    return settings
+
+
+def get_illum_settings(path_to_pipeline: pathlib.Path, channel: str) -> Dict[str, str]:
+    """
+    This function gets the settings of the CorrectIlluminationCalculate module for a channel.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the illumination correction pipeline
+        channel (str): name of the channel (e.g., "DNA")
+
+    Raises:
+        ValueError: if the pipeline does not calculate an illumination function for the channel or uses settings that
+            are not supported here
+
+    Returns:
+        Dict[str, str]: settings of the module
+    """
+    _, *modules = illum_fanout.split_pipeline_modules(pathlib.Path(path_to_pipeline).read_text())
+
+    for module in modules:
+        if module.startswith("CorrectIlluminationCalculate") and (
+            f"    Select the input image:Orig{channel}" in module.splitlines()
+        ):
+            settings = _parse_module_settings(module)
+            break
+    else:
+        raise ValueError(f"The pipeline '{path_to_pipeline}' does not calculate an illumination function for {channel}")
+
+    for key, supported_values in SUPPORTED_SETTINGS.items():
+        if settings.get(key) not in supported_values:
+            raise ValueError(
+                f"CorrectIlluminationCalculate for {channel} uses '{key}:{settings.get(key)}', "
+                f"which is not supported (use one of {supported_values})"
+            )
+
+    return settings
+
+
+def get_flag_rules(path_to_pipeline: pathlib.Path) -> Tuple[List[dict], bool]:
+    """
+    This function gets the whole-image measurement thresholds of the FlagImage module in a pipeline.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the illumination correction pipeline
+
+    Returns:
+        Tuple[List[dict], bool]: one rule per measurement (measurement, minimum and maximum, None when the side is not
+            flagged) and if image sets are flagged when all (True) or any (False) of the rules fail
+    """
+    _, *modules = illum_fanout.split_pipeline_modules(pathlib.Path(path_to_pipeline).read_text())
+
+    rules = []
+    flag_if_all_fail = False
+    for module in modules:
+        if not module.startswith("FlagImage") or "Skip image set if flagged?:Yes" not in module:
+            continue
+
+        for line in module.splitlines()[1:]:
+            key, _, value = line.strip().partition(":")
+            if key == "How should measurements be linked?":
+                flag_if_all_fail = value == "Flag if all fail"
+            elif key == "Which measurement?":
+                rules.append({"measurement": value, "minimum": None, "maximum": None})
+            elif key == "Flag images based on low values?" and value == "Yes":
+                rules[-1]["minimum"] = True
+            elif key == "Flag images based on high values?" and value == "Yes":
+                rules[-1]["maximum"] = True
+            elif key == "Minimum value" and rules[-1]["minimum"] is True:
+                rules[-1]["minimum"] = float(value)
+            elif key == "Maximum value" and rules[-1]["maximum"] is True:
+                rules[-1]["maximum"] = float(value)
+
+    return rules, flag_if_all_fail
+
+
+def flag_image_sets(qc_df: pd.DataFrame, rules: List[dict], flag_if_all_fail: bool = False) -> pd.Series:
+    """
+    This function flags the image sets with measurements outside of the thresholds, the same as FlagImage.
+
+    Args:
+        qc_df (pd.DataFrame): image quality measurements per image set
+        rules (List[dict]): thresholds per measurement (see `get_flag_rules`)
+        flag_if_all_fail (bool, optional): flag image sets when all rules fail instead of any. Defaults to False.
+
+    Returns:
+        pd.Series: True for the image sets that are flagged (and skipped)
+    """
+    if not rules:
+        return pd.Series(False, index=qc_df.index)
+
+    fails = []
+    for rule in rules:
+        values = qc_df[rule["measurement"]]
+        fail = pd.Series(False, index=qc_df.index)
+        if rule["minimum"] is not None:
+            fail |= values < rule["minimum"]
+        if rule["maximum"] is not None:
+            fail |= values > rule["maximum"]
+        fails.append(fail)
+
+    fails_df = pd.concat(fails, axis=1)
+    return fails_df.all(axis=1) if flag_if_all_fail else fails_df.any(axis=1)
+
+
+def read_image(image_path: str) -> np.ndarray:
+    """
+    Read an image and rescale integer intensities to 0-1 by the maximum of the data type, as LoadData does.
+    """
+    image = zarr_store.read_image(image_path)
+    if np.issubdtype(image.dtype, np.integer):
+        return image / float(np.iinfo(image.dtype).max)
+    return image.astype(np.float64)
+
+
+def get_block_starts(shape: Tuple[int, int], block_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function gets the first row and column of every block that the minimum is taken in for the Background
+    method. As in CellProfiler, the image is split into floor(size / block size) blocks along each axis (at least
+    one), so blocks can be slightly bigger than the block size.
+
+    Args:
+        shape (Tuple[int, int]): height and width of the image
+        block_size (int): size of the blocks (1 gives one block per pixel)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: first row of each block row and first column of each block column
+    """
+    starts = []
+    for size in shape:
+        num_blocks = max(int(float(size) / float(block_size)), 1)
+        labels = (np.arange(size) * (float(num_blocks) / float(size))).astype(int)
+        starts.append(np.flatnonzero(np.diff(labels, prepend=-1)))
+    return starts[0], starts[1]
+
+
+def reduce_image(image: np.ndarray, block_starts: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    """
+    Get the minimum of every block of an image (one value per block).
+    """
+    row_starts, col_starts = block_starts
+    return np.minimum.reduceat(np.minimum.reduceat(image, row_starts, axis=0), col_starts, axis=1)
+
+
+def expand_blocks(
+    block_values: np.ndarray, shape: Tuple[int, int], block_starts: Tuple[np.ndarray, np.ndarray]
+) -> np.ndarray:
+    """
+    Expand one value per block into an image, setting every pixel of a block to the value of the block.
+    """
+    row_sizes = np.diff(np.append(block_starts[0], shape[0]))
+    col_sizes = np.diff(np.append(block_starts[1], shape[1]))
+    return np.repeat(np.repeat(block_values, row_sizes, axis=0), col_sizes, axis=1)
+
+
+def accumulate_images(image_paths: List[str], block_size: int) -> Tuple[Optional[np.ndarray], int, Optional[tuple]]:
+    """
+    This function folds images into a running sum, reading one image at a time. For the Background method, each
+    image is replaced by the minimum of every block before averaging, so the sum is kept per block.
+
+    Args:
+        image_paths (List[str]): paths to the images of one channel
+        block_size (int): size of the blocks to take the minimum in (1 for the Regular method)
+
+    Raises:
+        ValueError: if the images do not all have the same shape
+
+    Returns:
+        Tuple[Optional[np.ndarray], int, Optional[tuple]]: sum per block, number of images and the image shape
+    """
+    block_sum = None
+    shape = None
+    block_starts = None
+
+    for image_path in image_paths:
+        image = read_image(image_path)
+        if shape is None:
+            shape = image.shape
+            block_starts = get_block_starts(shape, block_size)
+            block_sum = np.zeros((len(block_starts[0]), len(block_starts[1])))
+        elif image.shape != shape:
+            raise ValueError(f"The image '{image_path}' has the shape {image.shape} instead of {shape}")
+
+        # the Regular method averages the pixels themselves
+        block_sum += image if block_size == 1 else reduce_image(image, block_starts)
+
+    return block_sum, len(image_paths), shape
+
+
+def fit_polynomial(pixel_data: np.ndarray) -> np.ndarray:
+    """
+    Fit the image to the polynomial Ax^2 + By^2 + Cxy + Dx + Ey + F using the pixels above 0, and clip the fitted
+    image to 0-1, as CellProfiler does.
+
+    Args:
+        pixel_data (np.ndarray): averaged image
+
+    Returns:
+        np.ndarray: fitted image
+    """
+    mask = pixel_data > 0
+    if not np.any(mask):
+        return pixel_data
+
+    x, y = np.mgrid[0 : pixel_data.shape[0], 0 : pixel_data.shape[1]]
+    terms = [x, y, x * x, y * y, x * y, np.ones(pixel_data.shape)]
+    design = np.column_stack([term[mask] for term in terms])
+    coeffs = np.linalg.lstsq(design, pixel_data[mask], rcond=None)[0]
+
+    output_pixels = np.sum([coeff * term for coeff, term in zip(coeffs, terms)], axis=0)
+    output_pixels[output_pixels > 1] = 1
+    output_pixels[output_pixels < 0] = 0
+
+    return output_pixels
+
+
+def get_smoothing_filter_size(settings: Dict[str, str], shape: Tuple[int, int]) -> float:
+    """
+    Get the smoothing filter size from the settings, where the automatic size is 1/40th of the largest dimension of
+    the image (at most 30 pixels), as in CellProfiler.
+    """
+    method = settings["Method to calculate smoothing filter size"]
+    if method == "Manually":
+        return float(settings["Smoothing filter size"])
+    if method == "Object size":
+        return float(settings["Approximate object diameter"]) * 2.35 / 3.5
+    return min(30, float(max(shape)) / 40.0)
+
+
+def gaussian_smooth(pixel_data: np.ndarray, sigma: float) -> np.ndarray:
+    """
+    Smooth the image with a Gaussian filter, dividing by the smoothed image of ones so the pixels at the edges are not
+    darkened by the zeros outside of the image, as CellProfiler does.
+
+    Args:
+        pixel_data (np.ndarray): averaged image
+        sigma (float): standard deviation of the Gaussian filter
+
+    Returns:
+        np.ndarray: smoothed image
+    """
+    bleed_over = scipy.ndimage.gaussian_filter(np.ones(pixel_data.shape), sigma, mode="constant", cval=0)
+    smoothed = scipy.ndimage.gaussian_filter(pixel_data, sigma, mode="constant", cval=0)
+    return smoothed / (bleed_over + np.finfo(float).eps)
+
+
+def rescale_illum_function(pixel_data: np.ndarray, rescale_option: str) -> np.ndarray:
+    """
+    Rescale the illumination function by the median ("Median") or by the robust minimum (2nd percentile, "Yes") of
+    the pixels above 0, with values below the robust minimum set to it, as CellProfiler does.
+    """
+    if rescale_option == "No":
+        return pixel_data
+
+    sorted_pixel_data = np.sort(pixel_data[pixel_data > 0])
+    if sorted_pixel_data.shape[0] == 0:
+        return pixel_data
+
+    if rescale_option == "Median":
+        rescale_value = sorted_pixel_data[int(sorted_pixel_data.shape[0] / 2)]
+    else:
+        rescale_value = sorted_pixel_data[int(sorted_pixel_data.shape[0] * 0.02)]
+        pixel_data = np.maximum(pixel_data, rescale_value)
+
+    if rescale_value == 0:
+        return pixel_data
+
+    return pixel_data / rescale_value
+
+
+def _get_block_size(settings: Dict[str, str]) -> int:
+    """
+    Get the size of the blocks to take the minimum in (the Regular method averages the pixels, which is a block size
+    of 1).
+    """
+    if settings["Select how the illumination function is calculated"] == "Background":
+        return int(settings["Block size"])
+    return 1
+
+
+def finalize_illum_function(
+    block_sum: np.ndarray, count: int, shape: Tuple[int, int], settings: Dict[str, str], path_to_npy: pathlib.Path
+) -> pathlib.Path:
+    """
+    This function averages the running sum, applies the smoothing and rescaling of the CorrectIlluminationCalculate
+    settings and saves the illumination function as a `.npy` file.
+
+    Args:
+        block_sum (np.ndarray): sum per block of all images
+        count (int): number of images in the sum
+        shape (Tuple[int, int]): shape of the images
+        settings (Dict[str, str]): CorrectIlluminationCalculate settings for the channel (see `get_illum_settings`)
+        path_to_npy (pathlib.Path): path to save the illumination function
+
+    Returns:
+        pathlib.Path: path to the illumination function
+    """
+    block_starts = get_block_starts(shape, _get_block_size(settings))
+    pixel_data = expand_blocks(block_sum / count, shape, block_starts)
+
+    if settings["Smoothing method"] == "Fit Polynomial":
+        pixel_data = fit_polynomial(pixel_data)
+    elif settings["Smoothing method"] == "Gaussian Filter":
+        pixel_data = gaussian_smooth(pixel_data, get_smoothing_filter_size(settings, shape) / 2.35)
+
+    pixel_data = rescale_illum_function(pixel_data, settings["Rescale the illumination function?"])
+
+    path_to_npy.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path_to_npy.with_name(f"{path_to_npy.stem}.tmp.npy")
+    np.save(temp_path, pixel_data)
+    os.replace(temp_path, path_to_npy)
+
+    return path_to_npy
+
+
+def get_unflagged_image_sets(
+    loaddata_df: pd.DataFrame,
+    path_to_pipeline: pathlib.Path,
+    path_to_qc: Optional[pathlib.Path] = None,
+    max_workers: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    This function removes the image sets that the FlagImage module of the pipeline would skip. The image quality
+    measurements are read from an `Image.csv` from the whole image QC when given, or else calculated.
+
+    Args:
+        loaddata_df (pd.DataFrame): LoadData for a plate
+        path_to_pipeline (pathlib.Path): path to the illumination correction pipeline
+        path_to_qc (Optional[pathlib.Path], optional): path to the `Image.csv` with the image quality measurements of
+            the plate. Defaults to None (calculate the measurements).
+        max_workers (Optional[int], optional): number of processes to calculate the measurements with. Defaults to
+            None (the number of CPUs).
+
+    Raises:
+        ValueError: if the `Image.csv` is missing image sets of the LoadData
+
+    Returns:
+        pd.DataFrame: LoadData without the flagged image sets
+    """
+    rules, flag_if_all_fail = get_flag_rules(path_to_pipeline)
+    if not rules:
+        return loaddata_df
+
+    measurements = [rule["measurement"] for rule in rules]
+    site_columns = ["Metadata_Well", "Metadata_Site"]
+
+    if path_to_qc is not None and pathlib.Path(path_to_qc).exists():
+        qc_df = loaddata_df[site_columns].astype(str).merge(
+            pd.read_csv(path_to_qc, usecols=site_columns + measurements).astype({col: str for col in site_columns}),
+            on=site_columns,
+            how="left",
+        )
+        if qc_df[measurements].isna().all(axis=1).any():
+            raise ValueError(f"The image quality measurements in '{path_to_qc}' are missing image sets of the LoadData")
+    else:
+        image_names = list(dict.fromkeys(measurement.rsplit("_", 1)[1] for measurement in measurements))
+        image_sets = pd.DataFrame(
+            {
+                name: loaddata_df[f"PathName_{name}"].astype(str) + os.sep + loaddata_df[f"FileName_{name}"].astype(str)
+                for name in image_names
+            }
+        ).to_dict(orient="records")
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            qc_df = pd.DataFrame(list(executor.map(image_qc.measure_image_set, image_sets, chunksize=CHUNK_SIZE)))
+
+    flagged = flag_image_sets(qc_df, rules, flag_if_all_fail).to_numpy()
+    print(f"Skipping {flagged.sum()} of {len(loaddata_df)} image sets flagged by FlagImage")
+
+    return loaddata_df[~flagged]
+
+
+def get_state_path(path_to_npy: pathlib.Path) -> pathlib.Path:
+    """
+    Get the path to the accumulator state of an illumination function, in an `illum_state` folder next to it.
+    """
+    return path_to_npy.parent / STATE_DIR_NAME / f"{path_to_npy.stem}.npz"
+
+
+def load_illum_state(path_to_state: pathlib.Path, settings: Dict[str, str]) -> Optional[dict]:
+    """
+    This function loads the accumulator state of an illumination function. The state is not used if it was saved
+    with other CorrectIlluminationCalculate settings.
+
+    Args:
+        path_to_state (pathlib.Path): path to the state file
+        settings (Dict[str, str]): current CorrectIlluminationCalculate settings for the channel
+
+    Returns:
+        Optional[dict]: running sum, number of images, image shape and the image path and if it was included (not
+            flagged) per image set, or None if there is no state to use
+    """
+    if not path_to_state.exists():
+        return None
+
+    with np.load(path_to_state) as state_file:
+        metadata = json.loads(str(state_file["metadata"]))
+        block_sum = state_file["block_sum"]
+
+    if metadata["settings"] != settings:
+        print(f"The settings changed since '{path_to_state}' was saved, so all images will be used")
+        return None
+
+    return {
+        "block_sum": block_sum if metadata["count"] > 0 else None,
+        "count": metadata["count"],
+        "shape": tuple(metadata["shape"]) if metadata["shape"] else None,
+        "image_sets": metadata["image_sets"],
+    }
+
+
+def save_illum_state(path_to_state: pathlib.Path, state: dict, settings: Dict[str, str]) -> None:
+    """
+    This function saves the accumulator state of an illumination function (as `.npz`), writing to a temporary file
+    that is renamed so a partial state is never loaded.
+
+    Args:
+        path_to_state (pathlib.Path): path to the state file
+        state (dict): running sum, number of images, image shape and image sets (see `load_illum_state`)
+        settings (Dict[str, str]): CorrectIlluminationCalculate settings for the channel
+    """
+    metadata = {
+        "settings": settings,
+        "count": state["count"],
+        "shape": list(state["shape"]) if state["shape"] else None,
+        "image_sets": state["image_sets"],
+    }
+    block_sum = state["block_sum"] if state["block_sum"] is not None else np.zeros((0, 0))
+
+    path_to_state.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path_to_state.with_name(f"{path_to_state.stem}.tmp.npz")
+    np.savez(temp_path, block_sum=block_sum, metadata=np.array(json.dumps(metadata)))
+    os.replace(temp_path, path_to_state)
+
+
+def calculate_illum_functions(
+    plate_info_dictionary: dict,
+    channels: List[str],
+    qc_dir: Optional[pathlib.Path] = None,
+    max_workers: Optional[int] = None,
+    incremental: bool = True,
+) -> Dict[str, List[pathlib.Path]]:
+    """
+    This function calculates the illumination functions for every plate and channel in parallel. The images of each
+    plate and channel are split into chunks that are folded into a running sum in a process pool (so all plates
+    and channels are processed at the same time), and the sums are averaged, smoothed and saved as
+    `<plate>_Illum<channel>.npy` in the plate output folder.
+
+    The running sum, number of images and the image path of every image set are saved per plate and channel in an
+    `illum_state` folder in the plate output folder. When the LoadData changes (e.g., wells are re-imaged and their
+    image sets point to the new images), only the image sets with new paths are measured for flagging and read:
+    the images they replace are subtracted from the sum and the new images are added. Plates with no changes are
+    skipped.
+
+    Note: Image sets are compared by image path, so use `incremental=False` if images are replaced with the same
+    paths. The images that are replaced must still exist to be subtracted.
+
+    Args:
+        plate_info_dictionary (dict): dictionary with the LoadData ("path_to_loaddata"), output folder
+            ("path_to_output") and illumination correction pipeline ("path_to_pipeline") per plate
+        channels (List[str]): names of the channels to calculate illumination functions for (e.g., "DNA")
+        qc_dir (Optional[pathlib.Path], optional): path to the whole image QC outputs with an `Image.csv` per plate
+            folder, to flag image sets without calculating the measurements again. Defaults to None.
+        max_workers (Optional[int], optional): number of processes. Defaults to None (the number of CPUs).
+        incremental (bool, optional): update the saved states instead of using all images. Defaults to True.
+
+    Returns:
+        Dict[str, List[pathlib.Path]]: paths to the illumination functions per plate
+    """
+    max_workers = max_workers or os.cpu_count()
+
+    jobs = {}
+    for plate_name, info in plate_info_dictionary.items():
+        loaddata_df = loaddata_store.read_loaddata(info["path_to_loaddata"])
+        plate_id = str(loaddata_df["Metadata_Plate"].iloc[0])
+        keys = loaddata_df["Metadata_Well"].astype(str) + "_" + loaddata_df["Metadata_Site"].astype(str)
+
+        channel_info = {}
+        for channel in channels:
+            settings = get_illum_settings(info["path_to_pipeline"], channel)
+            path_to_npy = pathlib.Path(info["path_to_output"]) / f"{plate_id}_Illum{channel}.npy"
+            channel_info[channel] = {
+                "settings": settings,
+                "path_to_npy": path_to_npy,
+                "paths": loaddata_df[f"PathName_Orig{channel}"].astype(str)
+                + os.sep
+                + loaddata_df[f"FileName_Orig{channel}"].astype(str),
+                "state": load_illum_state(get_state_path(path_to_npy), settings)
+                if incremental and path_to_npy.exists()
+                else None,
+            }
+
+        # all image sets are used when any channel has no saved state, since the flags are shared by the channels
+        if any(channel_job["state"] is None for channel_job in channel_info.values()):
+            for channel_job in channel_info.values():
+                channel_job["state"] = None
+
+        # only image sets that are new or have new images are flagged and added
+        changed = pd.Series(False, index=loaddata_df.index)
+        for channel_job in channel_info.values():
+            if channel_job["state"] is None:
+                changed[:] = True
+                break
+            recorded = channel_job["state"]["image_sets"]
+            changed |= keys.map(lambda key: recorded.get(key, [None])[0]) != channel_job["paths"]
+
+        if changed.any():
+            unflagged_index = get_unflagged_image_sets(
+                loaddata_df=loaddata_df[changed],
+                path_to_pipeline=info["path_to_pipeline"],
+                path_to_qc=None if qc_dir is None else pathlib.Path(qc_dir) / plate_name / "Image.csv",
+                max_workers=max_workers,
+            ).index
+        else:
+            unflagged_index = loaddata_df.index[:0]
+        added = loaddata_df.index.isin(unflagged_index)
+        current_keys = set(keys)
+        changed_keys = set(keys[changed])
+
+        for channel, channel_job in channel_info.items():
+            state = channel_job["state"] or {"block_sum": None, "count": 0, "shape": None, "image_sets": {}}
+            paths = channel_job["paths"]
+
+            # image sets that were included in the sum and are removed or replaced
+            removed_paths = [
+                path
+                for key, (path, included) in state["image_sets"].items()
+                if included and (key not in current_keys or key in changed_keys)
+            ]
+
+            image_sets = {
+                key: [path, bool(is_added) if is_changed else state["image_sets"][key][1]]
+                for key, path, is_changed, is_added in zip(keys, paths, changed, added)
+            }
+
+            jobs[(plate_name, channel)] = {
+                "settings": channel_job["settings"],
+                "path_to_npy": channel_job["path_to_npy"],
+                "state": state,
+                "image_sets": image_sets,
+                "chunks": [
+                    (sign, chunk_paths[start : start + CHUNK_SIZE])
+                    for sign, chunk_paths in ((1, paths[added].tolist()), (-1, removed_paths))
+                    for start in range(0, len(chunk_paths), CHUNK_SIZE)
+                ],
+            }
+
+        print(f"{plate_name}: {changed.sum()} of {len(loaddata_df)} image sets are new or changed")
+
+    jobs = {
+        key: job
+        for key, job in jobs.items()
+        if job["chunks"] or not job["path_to_npy"].exists() or job["image_sets"] != job["state"]["image_sets"]
+    }
+    print(f"Calculating {len(jobs)} illumination functions with {max_workers} processes")
+
+    illum_paths = {plate_name: [] for plate_name in plate_info_dictionary}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            key: [
+                (sign, executor.submit(accumulate_images, chunk_paths, _get_block_size(job["settings"])))
+                for sign, chunk_paths in job["chunks"]
+            ]
+            for key, job in jobs.items()
+        }
+
+        finalize_futures = {}
+        for key, chunk_futures in futures.items():
+            state = jobs[key]["state"]
+            block_sum, count, shape = state["block_sum"], state["count"], state["shape"]
+            for sign, future in chunk_futures:
+                chunk_sum, chunk_count, chunk_shape = future.result()
+                if chunk_sum is None:
+                    continue
+                if shape is not None and chunk_shape != shape:
+                    raise ValueError(f"Images of {key[1]} in {key[0]} have the shapes {shape} and {chunk_shape}")
+                block_sum = sign * chunk_sum if block_sum is None else block_sum + sign * chunk_sum
+                count += sign * chunk_count
+                shape = chunk_shape
+
+            jobs[key]["state"] = {
+                "block_sum": block_sum,
+                "count": count,
+                "shape": shape,
+                "image_sets": jobs[key]["image_sets"],
+            }
+
+            if count == 0:
+                print(f"No image sets to calculate the illumination function of {key[1]} in {key[0]}")
+                continue
+
+            finalize_futures[key] = executor.submit(
+                finalize_illum_function, block_sum, count, shape, jobs[key]["settings"], jobs[key]["path_to_npy"]
+            )
+
+        for key, future in finalize_futures.items():
+            illum_paths[key[0]].append(future.result())
+            # the state is saved after the illumination function so they always match
+            save_illum_state(get_state_path(jobs[key]["path_to_npy"]), jobs[key]["state"], jobs[key]["settings"])
+
+    print(f"The illumination functions have been saved for {len(illum_paths)} plates!")
+
+    return illum_paths
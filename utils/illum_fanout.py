@@ -0,0 +1,188 @@
+"""
+This collection of functions splits the illumination correction pipeline into one CellProfiler process per plate and
+channel. Each channel's illumination function only depends on that channel's images, so every process gets a
+LoadData CSV and pipeline with just the modules for its channel. The image sets that the FlagImage module would skip
+are found once per plate (from the whole image QC `Image.csv`) and left out of every channel's LoadData CSV, so each
+process only loads its own channel and the `.npy` files are identical to a run of the full pipeline.
+"""
+
+import pathlib
+import re
+import shutil
+from typing import List, Optional
+
+import pandas as pd
+
+import illum_calculate
+import loaddata_store
+
+# modules that calculate and save the illumination function of one channel
+CHANNEL_MODULES = {
+    "CorrectIlluminationCalculate": "Select the input image:Orig{channel}",
+    "SaveImages": "Select the image to save:Illum{channel}",
+}
+
+# modules that flag image sets, which are removed since the flagged image sets are not in the LoadData CSVs
+FLAG_MODULES = ("MeasureImageQuality", "FlagImage")
+
+
+def split_pipeline_modules(pipeline_text: str) -> List[str]:
+    """
+    Split a CellProfiler pipeline (.cppipe) into its header and module blocks, which are separated by blank lines.
+
+    Args:
+        pipeline_text (str): contents of the pipeline file
+
+    Returns:
+        List[str]: header block followed by one block per module
+    """
+    return [block for block in pipeline_text.strip("\n").split("\n\n") if block]
+
+
+def create_channel_pipeline(
+    path_to_pipeline: pathlib.Path, channel: str, path_to_channel_pipeline: pathlib.Path
+) -> pathlib.Path:
+    """
+    This function creates a pipeline for one channel by removing the CorrectIlluminationCalculate and SaveImages
+    modules of all other channels and the image quality flagging modules (MeasureImageQuality, FlagImage), since the
+    flagged image sets are removed from the LoadData CSV instead. All other modules are kept with their settings and
+    the modules are renumbered.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the illumination correction pipeline with all channels
+        channel (str): name of the channel to keep (e.g., "DNA")
+        path_to_channel_pipeline (pathlib.Path): path to save the pipeline for the channel
+
+    Raises:
+        ValueError: if the pipeline does not calculate an illumination function for the channel
+
+    Returns:
+        pathlib.Path: path to the pipeline for the channel
+    """
+    header, *modules = split_pipeline_modules(pathlib.Path(path_to_pipeline).read_text())
+
+    kept_modules = []
+    for module in modules:
+        module_name = module.split(":[", 1)[0]
+        if module_name in FLAG_MODULES:
+            continue
+        if module_name in CHANNEL_MODULES:
+            setting = CHANNEL_MODULES[module_name].format(channel=channel)
+            if f"    {setting}" not in module.splitlines():
+                continue
+        kept_modules.append(module)
+
+    if not any(module.startswith("CorrectIlluminationCalculate") for module in kept_modules):
+        raise ValueError(f"The pipeline '{path_to_pipeline}' does not calculate an illumination function for {channel}")
+
+    # renumber the modules in the order they are kept
+    kept_modules = [
+        re.sub(r"\[module_num:\d+\|", f"[module_num:{module_num}|", module, count=1)
+        for module_num, module in enumerate(kept_modules, start=1)
+    ]
+    header = re.sub(r"^ModuleCount:\d+$", f"ModuleCount:{len(kept_modules)}", header, flags=re.MULTILINE)
+
+    path_to_channel_pipeline.parent.mkdir(parents=True, exist_ok=True)
+    path_to_channel_pipeline.write_text("\n\n".join([header] + kept_modules) + "\n")
+
+    return path_to_channel_pipeline
+
+
+def create_channel_loaddata_csv(
+    loaddata_df: pd.DataFrame, channel: str, path_to_channel_loaddata: pathlib.Path
+) -> pathlib.Path:
+    """
+    This function creates a LoadData CSV for one channel with the file and path columns of that channel plus all
+    metadata columns, so other channels are never loaded.
+
+    Args:
+        loaddata_df (pd.DataFrame): LoadData of the plate with all channels (without the flagged image sets)
+        channel (str): name of the channel (e.g., "DNA")
+        path_to_channel_loaddata (pathlib.Path): path to save the LoadData CSV for the channel
+
+    Returns:
+        pathlib.Path: path to the LoadData CSV for the channel
+    """
+    columns = [
+        col
+        for col in loaddata_df.columns
+        if col.startswith("Metadata_") or col in (f"FileName_Orig{channel}", f"PathName_Orig{channel}")
+    ]
+
+    path_to_channel_loaddata.parent.mkdir(parents=True, exist_ok=True)
+    loaddata_df[columns].to_csv(path_to_channel_loaddata, index=False)
+
+    return path_to_channel_loaddata
+
+
+def create_channel_plate_info_dictionary(
+    plate_info_dictionary: dict, channels: List[str], qc_dir: Optional[pathlib.Path] = None
+) -> dict:
+    """
+    This function converts a plate info dictionary (one entry per plate) into a dictionary with one entry per plate
+    and channel. The image sets that FlagImage would skip are removed once per plate (see
+    `illum_calculate.get_unflagged_image_sets`). The LoadData CSV and pipeline for each channel are saved in a
+    `channel_jobs` folder within the plate output folder (e.g., illum_directory/<plate>/channel_jobs/<plate>_DNA.csv)
+    and each process writes its outputs into its own folder there. Use `collect_channel_illum_functions` after the
+    run to copy the `.npy` files to the plate output folder.
+
+    Args:
+        plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run the pipeline per plate
+        channels (List[str]): names of the channels to calculate illumination functions for (e.g., "DNA")
+        qc_dir (Optional[pathlib.Path], optional): path to the whole image QC outputs with an `Image.csv` per plate
+            (e.g., whole_img_qc_output/<plate>/Image.csv). Defaults to None (the measurements used by FlagImage are
+            calculated once per plate).
+
+    Returns:
+        dict: dictionary with all paths for CellProfiler to run the pipeline per plate and channel
+    """
+    channel_info_dictionary = {}
+
+    for plate_name, info in plate_info_dictionary.items():
+        path_to_pipeline = pathlib.Path(info["path_to_pipeline"])
+        channel_jobs_dir = pathlib.Path(info["path_to_output"]) / "channel_jobs"
+
+        # the image sets are flagged once for all channels of the plate
+        loaddata_df = illum_calculate.get_unflagged_image_sets(
+            loaddata_store.read_loaddata(info["path_to_loaddata"]),
+            path_to_pipeline=path_to_pipeline,
+            path_to_qc=None if qc_dir is None else pathlib.Path(qc_dir) / plate_name / "Image.csv",
+        )
+
+        for channel in channels:
+            job_name = f"{plate_name}_{channel}"
+            channel_info_dictionary[job_name] = {
+                "path_to_loaddata": create_channel_loaddata_csv(
+                    loaddata_df=loaddata_df,
+                    channel=channel,
+                    path_to_channel_loaddata=channel_jobs_dir / f"{job_name}.csv",
+                ),
+                "path_to_output": channel_jobs_dir / job_name,
+                "path_to_pipeline": create_channel_pipeline(
+                    path_to_pipeline=path_to_pipeline,
+                    channel=channel,
+                    path_to_channel_pipeline=channel_jobs_dir / f"{job_name}.cppipe",
+                ),
+                "plate_name": plate_name,
+            }
+
+    return channel_info_dictionary
+
+
+def collect_channel_illum_functions(plate_output_dir: pathlib.Path) -> List[pathlib.Path]:
+    """
+    This function copies the `.npy` illumination functions from the per-channel output folders into the plate output
+    folder, where they would have been saved by a run of the full pipeline. The per-channel folders are kept so a
+    resumed run can tell which channels are complete.
+
+    Args:
+        plate_output_dir (pathlib.Path): path to the output folder for the plate (e.g., illum_directory/<plate>)
+
+    Returns:
+        List[pathlib.Path]: paths to the copied `.npy` files
+    """
+    copied_paths = []
+    for npy_path in sorted((plate_output_dir / "channel_jobs").glob("*/*.npy")):
+        copied_paths.append(pathlib.Path(shutil.copy2(npy_path, plate_output_dir / npy_path.name)))
+
+    return copied_paths
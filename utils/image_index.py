@@ -0,0 +1,190 @@
+"""
+This collection of functions keeps an index (SQLite file) of the folders and TIFF images under the raw data
+directory, so finding the Images folders and image files does not walk the whole drive every time a notebook runs.
+The index is updated incrementally: the files of a folder are only listed again when the folder's modification time
+changed (e.g., images were added or removed). The index file is passed in by the notebook that uses it and is kept
+with that stage's outputs (it is not tracked by git).
+"""
+
+import os
+import pathlib
+import sqlite3
+from typing import Dict, List, Optional
+
+IMAGE_EXTENSIONS = (".tiff", ".tif")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE TABLE IF NOT EXISTS images (
+    directory TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (directory, file_name)
+);
+"""
+
+
+def _connect(index_path: pathlib.Path) -> sqlite3.Connection:
+    """
+    Open the index and create its tables if it is new.
+
+    Args:
+        index_path (pathlib.Path): path to the SQLite index file
+
+    Returns:
+        sqlite3.Connection: connection to the index
+    """
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(index_path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _remove_directory(connection: sqlite3.Connection, path: str) -> None:
+    """
+    Remove a folder, its subfolders and their images from the index.
+
+    Args:
+        connection (sqlite3.Connection): connection to the index
+        path (str): path of the folder that no longer exists
+    """
+    children = [row[0] for row in connection.execute("SELECT path FROM directories WHERE parent = ?", (path,))]
+    for child in children:
+        _remove_directory(connection, child)
+
+    connection.execute("DELETE FROM images WHERE directory = ?", (path,))
+    connection.execute("DELETE FROM directories WHERE path = ?", (path,))
+
+
+def update_image_index(root_dir: pathlib.Path, index_path: pathlib.Path) -> Dict[str, int]:
+    """
+    This function updates the index for all folders under the root directory. Every folder is checked with one
+    `stat` call, and only folders with a new modification time are listed again (with the size and modification
+    time of their images). Unchanged folders reuse the subfolders and images from the index.
+
+    Note: A folder's modification time changes when files are added, removed or renamed, but not when a file is
+    overwritten in place, so use a new index file if images are replaced with the same names.
+
+    Args:
+        root_dir (pathlib.Path): path to the raw data directory (e.g., /media/18tbdrive/ALSF_pilot_data/SN0313537/)
+        index_path (pathlib.Path): path to the SQLite index file
+
+    Returns:
+        Dict[str, int]: number of folders that were unchanged, listed again and removed
+    """
+    stats = {"unchanged": 0, "listed": 0, "removed": 0}
+    root_dir = pathlib.Path(root_dir).absolute()
+
+    connection = _connect(index_path)
+    cached_mtimes = dict(connection.execute("SELECT path, mtime_ns FROM directories"))
+
+    with connection:
+        pending = [(str(root_dir), None)]
+        while pending:
+            path, parent = pending.pop()
+
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                _remove_directory(connection, path)
+                stats["removed"] += 1
+                continue
+
+            if cached_mtimes.get(path) == mtime_ns:
+                stats["unchanged"] += 1
+                subdirectories = [
+                    row[0] for row in connection.execute("SELECT path FROM directories WHERE parent = ?", (path,))
+                ]
+                pending.extend((subdirectory, path) for subdirectory in subdirectories)
+                continue
+
+            # list the folder again and replace its images in the index
+            stats["listed"] += 1
+            subdirectories = []
+            images = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        entry_stat = entry.stat()
+                        images.append((path, entry.name, entry_stat.st_size, entry_stat.st_mtime_ns))
+
+            # remove subfolders that were deleted or renamed since the last update
+            for (old_subdirectory,) in connection.execute(
+                "SELECT path FROM directories WHERE parent = ?", (path,)
+            ).fetchall():
+                if old_subdirectory not in subdirectories:
+                    _remove_directory(connection, old_subdirectory)
+                    stats["removed"] += 1
+
+            connection.execute("DELETE FROM images WHERE directory = ?", (path,))
+            connection.executemany("INSERT INTO images VALUES (?, ?, ?, ?)", images)
+            connection.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (path, parent, mtime_ns)
+            )
+
+            pending.extend((subdirectory, path) for subdirectory in subdirectories)
+
+    connection.close()
+
+    return stats
+
+
+def find_directories(
+    root_dir: pathlib.Path,
+    index_path: pathlib.Path,
+    name: str = "Images",
+    update: bool = True,
+) -> List[pathlib.Path]:
+    """
+    This function finds all folders with a given name under the root directory from the index, the same as
+    `root_dir.rglob(name)` for folders.
+
+    Args:
+        root_dir (pathlib.Path): path to the raw data directory
+        index_path (pathlib.Path): path to the SQLite index file
+        name (str, optional): name of the folders to find. Defaults to "Images".
+        update (bool, optional): update the index before searching. Defaults to True.
+
+    Returns:
+        List[pathlib.Path]: paths to the folders, sorted
+    """
+    root_dir = pathlib.Path(root_dir).absolute()
+    if update:
+        update_image_index(root_dir, index_path)
+
+    connection = _connect(index_path)
+    paths = [pathlib.Path(row[0]) for row in connection.execute("SELECT path FROM directories ORDER BY path")]
+    connection.close()
+
+    return [path for path in paths if path.name == name and root_dir in path.parents]
+
+
+def get_image_files(directory: pathlib.Path, index_path: pathlib.Path) -> Optional[Dict[str, int]]:
+    """
+    This function gets the images in a folder from the index.
+
+    Args:
+        directory (pathlib.Path): path to the folder (e.g., an Images folder)
+        index_path (pathlib.Path): path to the SQLite index file
+
+    Returns:
+        Optional[Dict[str, int]]: file name to size in bytes, or None if the folder is not in the index
+    """
+    directory = str(pathlib.Path(directory).absolute())
+
+    connection = _connect(index_path)
+    indexed = connection.execute("SELECT 1 FROM directories WHERE path = ?", (directory,)).fetchone()
+    images = dict(
+        connection.execute("SELECT file_name, size FROM images WHERE directory = ?", (directory,))
+    )
+    connection.close()
+
+    return images if indexed else None
@@ -0,0 +1,242 @@
+"""
+This collection of functions calculates the whole image quality metrics used to find poor quality images
+(`ImageQuality_PowerLogLogSlope` for blur and `ImageQuality_PercentMaximal` for saturation) directly from the TIFFs,
+the same way as the CellProfiler MeasureImageQuality module, so QC does not need a CellProfiler environment.
+Image sets are measured in a process pool and an `Image.csv` is saved per plate with the same columns that
+`whole_img_qc.cppipe` exports for these metrics.
+"""
+
+import functools
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import loaddata_store
+import zarr_store
+
+# the metrics are not robust for the Brightfield channel, so it is not measured
+QC_CHANNELS = ["OrigDNA", "OrigER", "OrigAGP", "OrigMito", "OrigRNA"]
+
+
+@functools.lru_cache(maxsize=8)
+def _radial_bins(shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the radius bin of every frequency in an FFT of the given shape (distance to the nearest corner, as the
+    spectrum is not shifted) and the bins used to fit the slope, which skip the DC component and stop at an eighth of
+    the smallest dimension to avoid edge effects. The bins only depend on the shape, so they are cached.
+
+    Args:
+        shape (Tuple[int, int]): height and width of the image
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: radius bin of every frequency (flattened) and the bins to fit
+    """
+    radii2 = (np.arange(shape[0]).reshape((shape[0], 1)) ** 2) + (np.arange(shape[1]) ** 2)
+    radii2 = np.minimum(radii2, np.flipud(radii2))
+    radii2 = np.minimum(radii2, np.fliplr(radii2))
+    radii = np.floor(np.sqrt(radii2)).astype(np.int64) + 1
+
+    max_width = min(shape) / 8.0
+    labels = np.arange(2, np.floor(max_width)).astype(np.int64)
+
+    return radii.ravel(), labels
+
+
+def calculate_power_log_log_slope(images: np.ndarray) -> np.ndarray:
+    """
+    This function calculates the slope of the radial power spectrum against the frequency on a log-log scale
+    (`ImageQuality_PowerLogLogSlope`), the same as CellProfiler. Images are normalized by their median absolute
+    deviation so the slope does not depend on the intensity, and the power spectra of all images are calculated with
+    one FFT. More negative values mean a blurrier image and values close to 0 an empty image.
+
+    Args:
+        images (np.ndarray): stack of images with the same shape (images x height x width)
+
+    Returns:
+        np.ndarray: slope per image (0 for images with no variation)
+    """
+    images = images.astype(np.float64)
+    radii, labels = _radial_bins(images.shape[1:])
+    num_bins = int(radii.max()) + 1
+
+    means = images.mean(axis=(1, 2), keepdims=True)
+    has_range = images.max(axis=(1, 2)) > images.min(axis=(1, 2))
+
+    # normalize to be intensity invariant (images with a single value are not normalized)
+    deviations = np.median(np.abs(images - means).reshape(len(images), -1), axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = np.where(has_range, deviations, 1.0)[:, None, None]
+        images = images / scale
+        magnitudes = np.abs(np.fft.fft2(images - images.mean(axis=(1, 2), keepdims=True), axes=(1, 2)))
+
+    slopes = np.zeros(len(images))
+    if len(labels) == 0:
+        return slopes
+
+    for index, magnitude in enumerate(magnitudes):
+        magnitude = magnitude.ravel()
+        magnitude_sums = np.bincount(radii, weights=magnitude, minlength=num_bins)[labels]
+        power_sums = np.bincount(radii, weights=magnitude**2, minlength=num_bins)[labels]
+
+        # a slope is only fit if there is signal (a median absolute deviation of 0 gives no valid values)
+        if not has_range[index] or not np.sum(magnitude_sums) > 0:
+            continue
+
+        valid = magnitude_sums > 0
+        if np.count_nonzero(valid) <= 1:
+            continue
+
+        with np.errstate(divide="ignore"):
+            log_radii = np.log(labels[valid])
+            log_power = np.log(power_sums[valid])
+        finite = np.isfinite(log_power)
+        design = np.column_stack((log_radii[finite], np.ones(np.count_nonzero(finite))))
+        slopes[index] = np.linalg.lstsq(design, log_power[finite], rcond=None)[0][0]
+
+    return slopes
+
+
+def calculate_percent_maximal(images: np.ndarray) -> np.ndarray:
+    """
+    This function calculates the percent of pixels at the maximum intensity of each image
+    (`ImageQuality_PercentMaximal`), the same as CellProfiler. High values mean saturated regions (e.g., smudges).
+
+    Args:
+        images (np.ndarray): stack of images with the same shape (images x height x width)
+
+    Returns:
+        np.ndarray: percent of pixels at the maximum per image
+    """
+    pixels = images.reshape(len(images), -1)
+    if pixels.shape[1] == 0:
+        return np.zeros(len(images))
+
+    maximal_counts = np.count_nonzero(pixels == pixels.max(axis=1, keepdims=True), axis=1)
+    return 100.0 * maximal_counts / pixels.shape[1]
+
+
+def measure_image_set(image_paths: Dict[str, str]) -> Dict[str, float]:
+    """
+    This function loads the images of one image set and calculates the blur and saturation metrics per image.
+    Images with the same shape are measured together.
+
+    Args:
+        image_paths (Dict[str, str]): path to the image for each image name (e.g., "OrigDNA")
+
+    Returns:
+        Dict[str, float]: metrics named as in the CellProfiler Image.csv (e.g., ImageQuality_PercentMaximal_OrigDNA)
+    """
+    images = {image_name: zarr_store.read_image(path) for image_name, path in image_paths.items()}
+
+    shape_groups = {}
+    for image_name, image in images.items():
+        shape_groups.setdefault(image.shape, []).append(image_name)
+
+    measurements = {}
+    for image_names in shape_groups.values():
+        stack = np.stack([images[image_name] for image_name in image_names])
+        slopes = calculate_power_log_log_slope(stack)
+        percent_maximal = calculate_percent_maximal(stack)
+        for index, image_name in enumerate(image_names):
+            measurements[f"ImageQuality_PowerLogLogSlope_{image_name}"] = slopes[index]
+            measurements[f"ImageQuality_PercentMaximal_{image_name}"] = percent_maximal[index]
+
+    return measurements
+
+
+def measure_image_quality(
+    plate_info_dictionary: dict,
+    channels: List[str] = QC_CHANNELS,
+    max_workers: Optional[int] = None,
+) -> Dict[str, pd.DataFrame]:
+    """
+    This function calculates the whole image quality metrics for every image set of every plate, using a process
+    pool over the image sets of all plates, and saves an `Image.csv` per plate in the plate output folder. The
+    table has the ImageNumber, the LoadData metadata, file and path columns and the metric columns, so it can be
+    read in place of the `whole_img_qc.cppipe` output.
+
+    Args:
+        plate_info_dictionary (dict): dictionary with the LoadData ("path_to_loaddata") and output folder
+            ("path_to_output") per plate
+        channels (List[str], optional): image names to measure. Defaults to QC_CHANNELS.
+        max_workers (Optional[int], optional): number of processes. Defaults to None (the number of CPUs).
+
+    Raises:
+        ValueError: if a LoadData file is missing the file or path column for a channel
+
+    Returns:
+        Dict[str, pd.DataFrame]: image quality table per plate
+    """
+    loaddata_dfs = {}
+    image_sets = []
+    for plate_name, info in plate_info_dictionary.items():
+        loaddata_df = loaddata_store.read_loaddata(info["path_to_loaddata"])
+
+        missing_columns = [
+            f"{prefix}_{channel}"
+            for channel in channels
+            for prefix in ("FileName", "PathName")
+            if f"{prefix}_{channel}" not in loaddata_df.columns
+        ]
+        if missing_columns:
+            raise ValueError(
+                f"The LoadData file for {plate_name} is missing the columns: {', '.join(missing_columns)}"
+            )
+
+        paths = {
+            channel: loaddata_df[f"PathName_{channel}"].astype(str)
+            + os.sep
+            + loaddata_df[f"FileName_{channel}"].astype(str)
+            for channel in channels
+        }
+        image_sets.extend(pd.DataFrame(paths).to_dict(orient="records"))
+        loaddata_dfs[plate_name] = loaddata_df
+
+    max_workers = max_workers or os.cpu_count()
+    print(f"Measuring {len(image_sets)} image sets from {len(loaddata_dfs)} plates with {max_workers} processes")
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        measurements = list(
+            executor.map(
+                measure_image_set,
+                image_sets,
+                chunksize=max(1, len(image_sets) // (max_workers * 16)),
+            )
+        )
+
+    metric_columns = [
+        f"ImageQuality_{metric}_{channel}"
+        for metric in ("PowerLogLogSlope", "PercentMaximal")
+        for channel in channels
+    ]
+
+    qc_dfs = {}
+    start = 0
+    for plate_name, loaddata_df in loaddata_dfs.items():
+        metrics_df = pd.DataFrame(
+            measurements[start : start + len(loaddata_df)], columns=metric_columns
+        )
+        start += len(loaddata_df)
+
+        # image numbers start at 1 in the order of the LoadData rows, as in CellProfiler
+        qc_df = pd.concat(
+            [
+                pd.DataFrame({"ImageNumber": np.arange(1, len(loaddata_df) + 1)}),
+                loaddata_df.reset_index(drop=True),
+                metrics_df,
+            ],
+            axis=1,
+        )
+
+        path_to_output = pathlib.Path(plate_info_dictionary[plate_name]["path_to_output"])
+        path_to_output.mkdir(parents=True, exist_ok=True)
+        qc_df.to_csv(path_to_output / "Image.csv", index=False)
+
+        qc_dfs[plate_name] = qc_df
+        print(f"Image quality metrics for {plate_name} have been saved to {path_to_output / 'Image.csv'}!")
+
+    return qc_dfs
@@ -0,0 +1,308 @@
+"""
+This collection of functions stages the images of CellProfiler processes to a local scratch folder before they run.
+One background thread reads the images of each process in LoadData row order (in the order the processes will start)
+with large sequential reads, so the drive with the raw images is read sequentially instead of by many processes at
+once. The scratch folder is a cache with a size limit, where the least recently used images that no process needs
+are removed first, and each process gets a LoadData CSV with the `PathName_*` columns pointing to the scratch folder.
+"""
+
+import collections
+import hashlib
+import os
+import pathlib
+import shutil
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import loaddata_store
+
+# size of each read when copying an image to the scratch folder
+COPY_BUFFER_BYTES = 16 * 1024**2
+
+
+def create_staging_cache(scratch_dir: pathlib.Path, max_bytes: int) -> dict:
+    """
+    This function creates an empty staging cache in the scratch folder (removing images from a previous run).
+
+    Args:
+        scratch_dir (pathlib.Path): path to the local scratch folder
+        max_bytes (int): maximum size of the staged images
+
+    Returns:
+        dict: state of the cache, shared by the staging thread and the scheduler
+    """
+    scratch_dir = pathlib.Path(scratch_dir)
+    shutil.rmtree(scratch_dir / "images", ignore_errors=True)
+    (scratch_dir / "images").mkdir(parents=True, exist_ok=True)
+    (scratch_dir / "loaddata").mkdir(parents=True, exist_ok=True)
+
+    return {
+        "scratch_dir": scratch_dir,
+        "max_bytes": max_bytes,
+        "used_bytes": 0,
+        # source path -> staged path, size and the number of processes that need it (in least recently used order)
+        "entries": collections.OrderedDict(),
+        "condition": threading.Condition(),
+        "stopped": False,
+        "thread": None,
+    }
+
+
+def get_staged_directory(cache: dict, source_directory: str) -> pathlib.Path:
+    """
+    Get the scratch folder for the images of a source folder, named by a hash of the source folder path so images
+    with the same name from different folders do not collide.
+    """
+    source_directory = os.path.normpath(source_directory)
+    return cache["scratch_dir"] / "images" / hashlib.sha1(source_directory.encode()).hexdigest()[:16]
+
+
+def copy_sequential(source_path: str, staged_path: pathlib.Path) -> None:
+    """
+    Copy a file with large sequential reads, to a temporary file that is renamed so a partial copy is never used.
+    """
+    staged_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = staged_path.with_name(f"{staged_path.name}.tmp")
+
+    with open(source_path, "rb") as source_file, open(temp_path, "wb") as staged_file:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(source_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        shutil.copyfileobj(source_file, staged_file, COPY_BUFFER_BYTES)
+
+    os.replace(temp_path, staged_path)
+
+
+def _evict(cache: dict, needed_bytes: int) -> bool:
+    """
+    Remove the least recently used images that no process needs until there is space for the needed bytes.
+
+    Returns:
+        bool: if there is space (False if all remaining images are needed by processes)
+    """
+    entries = cache["entries"]
+    for source_path in list(entries):
+        if cache["used_bytes"] + needed_bytes <= cache["max_bytes"]:
+            break
+        entry = entries[source_path]
+        if entry["pins"] == 0:
+            entry["staged_path"].unlink(missing_ok=True)
+            cache["used_bytes"] -= entry["size"]
+            del entries[source_path]
+
+    return cache["used_bytes"] + needed_bytes <= cache["max_bytes"]
+
+
+def stage_file(cache: dict, source_path: str) -> pathlib.Path:
+    """
+    This function copies an image to the scratch folder (if it is not already there) and marks it as needed by one
+    more process, so it is not removed until `release_files` is called. When the cache is full, it waits for
+    processes to finish and release their images.
+
+    Args:
+        cache (dict): state of the staging cache
+        source_path (str): path to the image
+
+    Raises:
+        ValueError: if the image is larger than the cache or staging was stopped
+
+    Returns:
+        pathlib.Path: path to the staged image
+    """
+    entries = cache["entries"]
+
+    with cache["condition"]:
+        if cache["stopped"]:
+            raise ValueError("Staging was stopped")
+
+        if source_path in entries:
+            entries.move_to_end(source_path)
+            entries[source_path]["pins"] += 1
+            return entries[source_path]["staged_path"]
+
+        size = os.stat(source_path).st_size
+        if size > cache["max_bytes"]:
+            raise ValueError(f"The image '{source_path}' is larger than the staging cache")
+
+        while not _evict(cache, size):
+            if cache["stopped"]:
+                raise ValueError("Staging was stopped")
+            cache["condition"].wait()
+
+        source_directory, file_name = os.path.split(source_path)
+        staged_path = get_staged_directory(cache, source_directory) / file_name
+        cache["used_bytes"] += size
+
+    try:
+        copy_sequential(source_path, staged_path)
+    except OSError:
+        with cache["condition"]:
+            cache["used_bytes"] -= size
+        raise
+
+    with cache["condition"]:
+        entries[source_path] = {"staged_path": staged_path, "size": size, "pins": 1}
+
+    return staged_path
+
+
+def release_files(cache: dict, source_paths: List[str]) -> None:
+    """
+    This function marks images as no longer needed by a process, so they can be removed when the cache is full.
+
+    Args:
+        cache (dict): state of the staging cache
+        source_paths (List[str]): paths to the images that were staged for the process
+    """
+    with cache["condition"]:
+        for source_path in source_paths:
+            if source_path in cache["entries"]:
+                cache["entries"][source_path]["pins"] -= 1
+        cache["condition"].notify_all()
+
+
+def stage_loaddata(
+    cache: dict, path_to_loaddata: pathlib.Path, job_name: str
+) -> Tuple[pathlib.Path, List[str]]:
+    """
+    This function stages all images of a LoadData file (all `FileName_*`/`PathName_*` columns) in row order and
+    writes a LoadData CSV with the `PathName_*` columns pointing to the scratch folder.
+
+    Args:
+        cache (dict): state of the staging cache
+        path_to_loaddata (pathlib.Path): path to the LoadData CSV or Parquet file of the process
+        job_name (str): name of the process (the name of the staged LoadData CSV)
+
+    Raises:
+        ValueError: if the images of the process are larger than the cache (they stay needed by the process while it
+            is staged, so they could never all fit)
+
+    Returns:
+        Tuple[pathlib.Path, List[str]]: path to the staged LoadData CSV and the paths of the images that were staged
+    """
+    loaddata_df = loaddata_store.read_loaddata(path_to_loaddata)
+    image_names = [col.replace("FileName_", "") for col in loaddata_df.columns if col.startswith("FileName_")]
+
+    job_paths = [
+        os.path.join(str(path_name), str(file_name))
+        for row in loaddata_df[
+            [f"{prefix}_{name}" for name in image_names for prefix in ("PathName", "FileName")]
+        ].itertuples(index=False)
+        for path_name, file_name in zip(row[::2], row[1::2])
+    ]
+
+    # check the size of the process before staging anything, instead of waiting for space that will never be free
+    job_bytes = sum(os.stat(source_path).st_size for source_path in dict.fromkeys(job_paths))
+    if job_bytes > cache["max_bytes"]:
+        raise ValueError(
+            f"The images of {job_name} ({job_bytes} bytes) are larger than the staging cache ({cache['max_bytes']} bytes)"
+        )
+
+    source_paths = []
+    for source_path in job_paths:
+        try:
+            stage_file(cache, source_path)
+        except BaseException:
+            release_files(cache, source_paths)
+            raise
+        source_paths.append(source_path)
+
+    for name in image_names:
+        loaddata_df[f"PathName_{name}"] = (
+            loaddata_df[f"PathName_{name}"]
+            .astype(str)
+            .map(lambda source_directory: str(get_staged_directory(cache, source_directory)))
+        )
+
+    path_to_staged_loaddata = cache["scratch_dir"] / "loaddata" / f"{job_name}.csv"
+    temp_path = path_to_staged_loaddata.with_name(f"{path_to_staged_loaddata.name}.tmp")
+    loaddata_df.to_csv(temp_path, index=False)
+    os.replace(temp_path, path_to_staged_loaddata)
+
+    return path_to_staged_loaddata, source_paths
+
+
+def start_staging(cache: dict, jobs: List[Tuple[str, Optional[pathlib.Path]]]) -> Dict[str, dict]:
+    """
+    This function starts a thread that stages the images of each process in the order the processes will start.
+    The thread stays ahead of the running processes until the cache is full of images that processes still need.
+
+    Args:
+        cache (dict): state of the staging cache
+        jobs (List[Tuple[str, Optional[pathlib.Path]]]): name and LoadData path of each process, in start order
+
+    Returns:
+        Dict[str, dict]: per process, an event that is set once it is staged, the staged LoadData CSV and the staged
+            images (or the error if the images could not be staged)
+    """
+    staged_jobs = {
+        job_name: {"event": threading.Event(), "path_to_loaddata": None, "source_paths": [], "error": None}
+        for job_name, _ in jobs
+    }
+
+    def stage_jobs():
+        for job_name, path_to_loaddata in jobs:
+            staged_job = staged_jobs[job_name]
+            if cache["stopped"]:
+                staged_job["event"].set()
+                continue
+            if path_to_loaddata is not None:
+                try:
+                    path_to_staged_loaddata, source_paths = stage_loaddata(cache, path_to_loaddata, job_name)
+                except (OSError, ValueError) as error:
+                    staged_job["error"] = error
+                else:
+                    with cache["condition"]:
+                        # the process already started without waiting for its images (see `wait_for_job`)
+                        if staged_job["error"] is not None:
+                            release_files(cache, source_paths)
+                        else:
+                            staged_job["path_to_loaddata"], staged_job["source_paths"] = (
+                                path_to_staged_loaddata,
+                                source_paths,
+                            )
+            staged_job["event"].set()
+
+    cache["thread"] = threading.Thread(target=stage_jobs, name="image-staging", daemon=True)
+    cache["thread"].start()
+
+    return staged_jobs
+
+
+def wait_for_job(cache: dict, staged_job: dict, timeout: Optional[float] = None) -> bool:
+    """
+    This function waits for the images of a process to be staged. If they are not staged within the timeout, the
+    process is marked with an error so it reads the images from where they are (and its images are released once
+    the staging thread gets to them).
+
+    Args:
+        cache (dict): state of the staging cache
+        staged_job (dict): staging state of the process (see `start_staging`)
+        timeout (Optional[float], optional): maximum seconds to wait. Defaults to None (wait until staged).
+
+    Returns:
+        bool: if the images of the process were staged
+    """
+    if not staged_job["event"].wait(timeout):
+        with cache["condition"]:
+            if staged_job["path_to_loaddata"] is None and staged_job["error"] is None:
+                staged_job["error"] = TimeoutError(f"the images were not staged within {timeout} seconds")
+
+    return staged_job["error"] is None and staged_job["path_to_loaddata"] is not None
+
+
+def stop_staging(cache: dict) -> None:
+    """
+    This function stops staging new processes and removes the staged images from the scratch folder.
+
+    Args:
+        cache (dict): state of the staging cache
+    """
+    with cache["condition"]:
+        cache["stopped"] = True
+        cache["condition"].notify_all()
+
+    # wait for the image being copied
+    if cache["thread"] is not None:
+        cache["thread"].join()
+
+    shutil.rmtree(cache["scratch_dir"] / "images", ignore_errors=True)
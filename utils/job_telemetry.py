@@ -0,0 +1,125 @@
+"""
+This collection of functions collects resource usage (wall time, CPU time, peak memory and bytes read) for each
+CellProfiler process and saves the metrics for a run, so slow plates or shards can be found and machines sized.
+"""
+
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import time
+from typing import List, Optional, Tuple
+
+import loaddata_store
+
+# the file system reports input in 512-byte blocks
+BLOCK_SIZE_BYTES = 512
+
+
+def wait_with_usage(
+    process: subprocess.Popen, start_time: float
+) -> Tuple[int, dict]:
+    """
+    This function waits for a process to exit and collects the resources used by that process (and any process it
+    started) from the operating system, which is exact and does not need to sample the process while it runs.
+
+    Args:
+        process (subprocess.Popen): running process
+        start_time (float): `time.perf_counter()` value from when the process was started
+
+    Returns:
+        Tuple[int, dict]: return code of the process and its resource usage
+    """
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start_time
+
+    # let Popen know the process has exited so it does not wait on it again
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # peak RSS is reported in kilobytes on Linux and bytes on macOS
+    peak_rss_bytes = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+    return process.returncode, {
+        "wall_time_seconds": round(wall_time, 3),
+        "cpu_time_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        "peak_rss_bytes": peak_rss_bytes,
+        "read_bytes": usage.ru_inblock * BLOCK_SIZE_BYTES,
+    }
+
+
+def count_loaddata_rows(path_to_loaddata: Optional[pathlib.Path]) -> Optional[int]:
+    """
+    This function counts the image sets (rows without the header) in a LoadData CSV or Parquet file.
+
+    Args:
+        path_to_loaddata (Optional[pathlib.Path]): path to the LoadData file (None when using a path to images)
+
+    Returns:
+        Optional[int]: number of image sets, or None if there is no LoadData CSV
+    """
+    if path_to_loaddata is None:
+        return None
+
+    return loaddata_store.count_loaddata_rows(path_to_loaddata)
+
+
+def create_job_metrics(
+    job_name: str,
+    plate_name: str,
+    returncode: int,
+    usage: dict,
+    image_sets: Optional[int],
+    attempts: int = 1,
+) -> dict:
+    """
+    This function creates the metrics record for one CellProfiler process.
+
+    Args:
+        job_name (str): name of the plate or shard
+        plate_name (str): name of the plate the job belongs to (used to join to other plate data)
+        returncode (int): return code of the CellProfiler process
+        usage (dict): resource usage from `wait_with_usage`
+        image_sets (Optional[int]): number of image sets in the LoadData CSV
+        attempts (int, optional): number of times the process was started (the usage is of the last). Defaults to 1.
+
+    Returns:
+        dict: metrics for the process
+    """
+    wall_time = usage["wall_time_seconds"]
+    image_sets_per_second = (
+        round(image_sets / wall_time, 4) if image_sets is not None and wall_time > 0 else None
+    )
+
+    return {
+        "job_name": job_name,
+        "Metadata_Plate": plate_name,
+        "returncode": returncode,
+        **usage,
+        "image_sets": image_sets,
+        "image_sets_per_second": image_sets_per_second,
+        "attempts": attempts,
+    }
+
+
+def write_run_metrics(metrics: List[dict], metrics_path: pathlib.Path) -> None:
+    """
+    This function saves the metrics for a run as a JSON list of records (one per process), which can be loaded with
+    `pandas.read_json` and joined to other data by `Metadata_Plate`. Records from previous runs with the same
+    run name are kept unless the same job was run again, in which case the newest record replaces it.
+
+    Args:
+        metrics (List[dict]): metrics records from `create_job_metrics`
+        metrics_path (pathlib.Path): path to the JSON file for the run metrics
+    """
+    records = {}
+    if metrics_path.exists():
+        with open(metrics_path) as metrics_file:
+            records = {record["job_name"]: record for record in json.load(metrics_file)}
+
+    records.update({record["job_name"]: record for record in metrics})
+
+    temp_path = metrics_path.with_name(f"{metrics_path.name}.tmp")
+    with open(temp_path, "w") as metrics_file:
+        json.dump(list(records.values()), metrics_file, indent=4)
+    os.replace(temp_path, metrics_path)
@@ -0,0 +1,168 @@
+"""
+This collection of functions stores LoadData as Parquet, with the repeated path columns dictionary-encoded and the
+metadata typed, and writes the LoadData CSV that `cellprofiler --data-file` needs only when a process is started.
+All functions that read LoadData accept either a CSV or a Parquet file.
+"""
+
+import os
+import pathlib
+from typing import List, Optional, Sequence
+
+import pandas as pd
+
+# types for the metadata used to shard, join and flag image sets
+METADATA_DTYPES = {
+    "Metadata_Plate": "category",
+    "Metadata_Well": "category",
+    "Metadata_Site": "int16",
+    "Metadata_Reimaged": "bool",
+}
+
+# rows read at a time when writing CSVs from a Parquet file
+BATCH_SIZE = 10_000
+
+
+def is_parquet(path_to_loaddata: pathlib.Path) -> bool:
+    """
+    Check if a LoadData file is stored as Parquet (by the file extension).
+    """
+    return pathlib.Path(path_to_loaddata).suffix == ".parquet"
+
+
+def read_loaddata(
+    path_to_loaddata: pathlib.Path, columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """
+    This function reads LoadData from a CSV or Parquet file. Only the requested columns are read from Parquet files.
+
+    Args:
+        path_to_loaddata (pathlib.Path): path to the LoadData CSV or Parquet file
+        columns (Optional[List[str]], optional): columns to read. Defaults to None (all columns).
+
+    Returns:
+        pd.DataFrame: LoadData
+    """
+    if is_parquet(path_to_loaddata):
+        return pd.read_parquet(path_to_loaddata, columns=columns)
+
+    return pd.read_csv(path_to_loaddata, usecols=columns)
+
+
+def count_loaddata_rows(path_to_loaddata: pathlib.Path) -> int:
+    """
+    This function counts the image sets in a LoadData file, using the Parquet metadata so no rows are read.
+
+    Args:
+        path_to_loaddata (pathlib.Path): path to the LoadData CSV or Parquet file
+
+    Returns:
+        int: number of image sets
+    """
+    if is_parquet(path_to_loaddata):
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(path_to_loaddata).metadata.num_rows
+
+    with open(path_to_loaddata, "rb") as loaddata_file:
+        return max(sum(1 for _ in loaddata_file) - 1, 0)
+
+
+def loaddata_csv_to_parquet(
+    path_to_loaddata: pathlib.Path, path_to_parquet: Optional[pathlib.Path] = None
+) -> pathlib.Path:
+    """
+    This function converts a LoadData CSV to Parquet. The `PathName_*` columns (the same folder for every image set
+    from a measurement) are stored as dictionaries, and the well, site, plate and re-imaged flag are typed.
+    The column order is kept so the CSV written back out has the same columns.
+
+    Args:
+        path_to_loaddata (pathlib.Path): path to the LoadData CSV
+        path_to_parquet (Optional[pathlib.Path], optional): path to save the Parquet file. Defaults to None (the CSV
+            path with a .parquet extension).
+
+    Returns:
+        pathlib.Path: path to the Parquet file
+    """
+    if path_to_parquet is None:
+        path_to_parquet = pathlib.Path(path_to_loaddata).with_suffix(".parquet")
+
+    loaddata_df = pd.read_csv(path_to_loaddata)
+    dtypes = {col: "category" for col in loaddata_df.columns if col.startswith("PathName_")}
+    dtypes.update({col: dtype for col, dtype in METADATA_DTYPES.items() if col in loaddata_df.columns})
+    loaddata_df = loaddata_df.astype(dtypes)
+
+    temp_path = path_to_parquet.with_name(f"{path_to_parquet.name}.tmp")
+    loaddata_df.to_parquet(temp_path, index=False)
+    os.replace(temp_path, path_to_parquet)
+
+    return path_to_parquet
+
+
+def write_loaddata_csv(
+    path_to_parquet: pathlib.Path,
+    path_to_csv: pathlib.Path,
+    row_indices: Optional[Sequence[int]] = None,
+) -> pathlib.Path:
+    """
+    This function writes a LoadData CSV for CellProfiler from a Parquet file, reading it in batches so only one
+    batch is in memory. A subset of the image sets (e.g., a shard) can be written by giving their row positions.
+    The CSV is written to a temporary file that is renamed, so a partial CSV is never used.
+
+    Args:
+        path_to_parquet (pathlib.Path): path to the LoadData Parquet file
+        path_to_csv (pathlib.Path): path to save the CSV
+        row_indices (Optional[Sequence[int]], optional): positions of the rows to write, in order. Defaults to None
+            (all rows).
+
+    Returns:
+        pathlib.Path: path to the CSV
+    """
+    import pyarrow.parquet as pq
+
+    wanted_rows = None if row_indices is None else pd.Index(row_indices)
+
+    path_to_csv.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path_to_csv.with_name(f"{path_to_csv.name}.tmp")
+
+    parquet_file = pq.ParquetFile(path_to_parquet)
+    with open(temp_path, "w") as csv_file:
+        # write the header even if no rows are selected
+        csv_file.write(",".join(parquet_file.schema_arrow.names) + "\n")
+
+        batch_start = 0
+        for batch in parquet_file.iter_batches(batch_size=BATCH_SIZE):
+            batch_df = batch.to_pandas()
+            batch_df.index = pd.RangeIndex(batch_start, batch_start + len(batch_df))
+            batch_start += len(batch_df)
+
+            if wanted_rows is not None:
+                batch_df = batch_df.loc[batch_df.index.intersection(wanted_rows)]
+
+            batch_df.to_csv(csv_file, header=False, index=False)
+
+    os.replace(temp_path, path_to_csv)
+
+    return path_to_csv
+
+
+def get_loaddata_csv(path_to_loaddata: pathlib.Path) -> pathlib.Path:
+    """
+    This function returns a LoadData CSV for `cellprofiler --data-file`. CSVs are used as they are. For Parquet
+    files, a CSV is written to a `csv_cache` folder next to the Parquet file when it does not exist or is older
+    than the Parquet file.
+
+    Args:
+        path_to_loaddata (pathlib.Path): path to the LoadData CSV or Parquet file
+
+    Returns:
+        pathlib.Path: path to the LoadData CSV
+    """
+    path_to_loaddata = pathlib.Path(path_to_loaddata)
+    if not is_parquet(path_to_loaddata):
+        return path_to_loaddata
+
+    path_to_csv = path_to_loaddata.parent / "csv_cache" / f"{path_to_loaddata.stem}.csv"
+    if not path_to_csv.exists() or path_to_csv.stat().st_mtime < path_to_loaddata.stat().st_mtime:
+        write_loaddata_csv(path_to_loaddata, path_to_csv)
+
+    return path_to_csv
@@ -4,9 +4,220 @@ for specific CellProfiler pipelines.
 """
 
 
+import csv
+import hashlib
 import os
-import subprocess
 import pathlib
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+import yaml
+
+import image_index
+import loaddata_store
+
+
+def _local_name(tag: str) -> str:
+    """
+    Remove the namespace from an XML tag (e.g., "{http://www.perkinelmer.com/PEHH/HarmonyV7}Image" -> "Image").
+    """
+    return tag.rsplit("}", 1)[-1]
+
+
+def load_channel_config(config_path: pathlib.Path) -> Tuple[Dict[int, str], List[str]]:
+    """
+    Load the channel map and metadata fields from a pe2loaddata style config file
+
+    Parameters
+    ----------
+    config_path : pathlib.Path
+        path to the `config.yml` file with the `channelid` map (Harmony v7) and `metadata` fields
+
+    Returns
+    -------
+    Tuple[Dict[int, str], List[str]]
+        channel ID to image name (e.g. 5 -> OrigDNA) and the sorted list of metadata fields to include
+    """
+    with open(config_path, "r") as config_file:
+        config = yaml.safe_load(config_file)
+
+    channel_map = {int(channel_id): name for channel_id, name in config["channelid"].items()}
+    metadata_fields = sorted(config.get("metadata") or {})
+
+    return channel_map, metadata_fields
+
+
+def parse_harmony_index(
+    index_path: pathlib.Path, channel_map: Dict[int, str], metadata_fields: List[str]
+) -> Tuple[str, List[str], Dict[str, Dict[Tuple[int, int, int], Dict[str, dict]]]]:
+    """
+    Stream a Harmony v7 `Index.idx.xml` file and group the images per field of view, keeping only the values
+    needed for the LoadData CSV so the whole XML tree is never held in memory
+
+    Parameters
+    ----------
+    index_path : pathlib.Path
+        path to the `Index.idx.xml` file
+    channel_map : Dict[int, str]
+        channel ID to image name, images from other channels are ignored
+    metadata_fields : List[str]
+        names of the image elements to include as metadata (e.g. PositionX)
+
+    Returns
+    -------
+    Tuple[str, List[str], Dict[str, Dict[Tuple[int, int, int], Dict[str, dict]]]]
+        plate name, wells in plate order, and the images per well, (field, plane, timepoint) and image name
+    """
+    plate_name = None
+    well_order = {}
+    fields = {}
+    images_element = None
+
+    context = ET.iterparse(str(index_path), events=("start", "end"))
+    for event, element in context:
+        tag = _local_name(element.tag)
+
+        if event == "start":
+            if tag == "Images":
+                images_element = element
+            continue
+
+        if tag == "PlateID" and plate_name is None:
+            plate_name = element.text.strip()
+
+        # wells are listed in plate order as references (e.g. <Well id="0303"/>) in the Plate element
+        elif tag == "Well" and len(element) == 0 and "id" in element.attrib:
+            well_id = element.attrib["id"]
+            well_order.setdefault(f"{chr(ord('A') + int(well_id[:2]) - 1)}{well_id[2:]}", len(well_order))
+
+        # images with values (not the references in the Well elements)
+        elif tag == "Image" and len(element) > 0:
+            values = {_local_name(child.tag): (child.text or "").strip() for child in element}
+            channel_name = channel_map.get(int(values["ChannelID"]))
+
+            if channel_name is not None:
+                well_name = chr(ord("A") + int(values["Row"]) - 1) + "%02d" % int(values["Col"])
+                field_key = (
+                    int(values["FieldID"]),
+                    int(values.get("PlaneID", 1)),
+                    int(values.get("TimepointID", 1)),
+                )
+                well_order.setdefault(well_name, len(well_order))
+                fields.setdefault(well_name, {}).setdefault(field_key, {})[channel_name] = {
+                    "URL": values["URL"],
+                    **{field: values.get(field, "") for field in metadata_fields},
+                }
+
+            # remove the finished images so memory does not grow with the size of the XML
+            if images_element is not None:
+                images_element.clear()
+
+    if plate_name is None:
+        raise ValueError(f"No PlateID was found in {index_path}")
+
+    return plate_name, sorted(well_order, key=well_order.get), fields
+
+
+def write_loaddata_csv(
+    index_directory: pathlib.Path,
+    config_path: pathlib.Path,
+    path_to_output: pathlib.Path,
+    illum_directory: Optional[pathlib.Path] = None,
+    plate_id: Optional[str] = None,
+    image_index_path: Optional[pathlib.Path] = None,
+) -> int:
+    """
+    Write a LoadData CSV from the Harmony v7 `Index.idx.xml` file in an Images folder, with one row per field of
+    view that has an image for every channel in the config. The columns match pe2loaddata: file and path columns
+    per channel (in channel ID order), the plate, well and site, and the metadata fields in alphabetical order.
+    Metadata values are taken from the image of the last channel.
+
+    Parameters
+    ----------
+    index_directory : pathlib.Path
+        path to the Images folder with the `Index.idx.xml` file and the images
+    config_path : pathlib.Path
+        path to the `config.yml` file with the channel map and metadata fields
+    path_to_output : pathlib.Path
+        path to the LoadData CSV to create
+    illum_directory : Optional[pathlib.Path]
+        path to the folder with the illumination correction functions (.npy files), to add the columns for the
+        illumination functions of each channel (default is None, no illum columns)
+    plate_id : Optional[str]
+        plate name used as the prefix of the illumination correction functions (default is None, the plate name
+        from the XML)
+    image_index_path : Optional[pathlib.Path]
+        path to the image index (see `image_index`) to find the image files without listing the Images folder
+        (default is None, list the folder)
+
+    Returns
+    -------
+    int
+        number of rows (image sets) written
+    """
+    index_directory = pathlib.Path(index_directory)
+    index_path = next(index_directory.glob("Index*xml"), None)
+    if index_path is None:
+        raise FileNotFoundError(f"No Index.idx.xml file was found in {index_directory}")
+
+    channel_map, metadata_fields = load_channel_config(config_path)
+    plate_name, wells, fields = parse_harmony_index(index_path, channel_map, metadata_fields)
+
+    channel_names = [channel_map[channel_id] for channel_id in sorted(channel_map)]
+    image_files = None
+    if image_index_path is not None:
+        image_files = image_index.get_image_files(index_directory, image_index_path)
+    if image_files is None:
+        image_files = set(os.listdir(index_directory))
+
+    header = [f"{prefix}_{name}" for name in channel_names for prefix in ("FileName", "PathName")]
+    header += ["Metadata_Plate", "Metadata_Well", "Metadata_Site"]
+    header += [f"Metadata_{field}" for field in metadata_fields]
+
+    # illumination function columns are in alphabetical order of the channels (e.g. IllumAGP first)
+    illum_values = []
+    if illum_directory is not None:
+        for name in sorted(channel_names):
+            illum_name = name.replace("Orig", "Illum")
+            header += [f"FileName_{illum_name}", f"PathName_{illum_name}"]
+            illum_values += [f"{plate_id or plate_name}_{illum_name}.npy", str(illum_directory)]
+
+    path_to_output.parent.mkdir(parents=True, exist_ok=True)
+    rows_written = 0
+    skipped_fields = 0
+
+    with open(path_to_output, "w") as output_file:
+        writer = csv.writer(output_file, lineterminator="\n")
+        writer.writerow(header)
+
+        for well_name in wells:
+            well_fields = fields.get(well_name, {})
+            for field_key in sorted(well_fields):
+                images = well_fields[field_key]
+
+                # skip fields of view with a missing channel or image file (same as pe2loaddata)
+                if any(
+                    name not in images or images[name]["URL"] not in image_files for name in channel_names
+                ):
+                    skipped_fields += 1
+                    continue
+
+                row = []
+                for name in channel_names:
+                    row += [images[name]["URL"], str(index_directory)]
+                row += [plate_name, well_name, str(field_key[0])]
+                row += [images[channel_names[-1]][field] for field in metadata_fields]
+
+                writer.writerow(row + illum_values)
+                rows_written += 1
+
+    if skipped_fields:
+        print(f"{skipped_fields} fields of view in {index_directory} were skipped due to missing images")
+
+    return rows_written
 
 
 def create_loaddata_csv(
@@ -22,25 +233,21 @@ def create_loaddata_csv(
     index_directory : pathlib.Path
         path to the `Index.idx.xml` file for the plate (normally located in the /Images folder)
     config_path : pathlib.Path
-        path to the `config.yml' file for pe2loaddata to process the csv
+        path to the `config.yml' file with the channel map and metadata to process the csv
     path_to_output : pathlib.Path
         path to the `wave1_loaddata.csv' file used for generating the illumination correction functions for each channel
     """
-    command = [
-        "pe2loaddata",
-        "--index-directory",
-        f'{index_directory}',
-        str(config_path),
-        str(path_to_output),
-    ]
-    subprocess.run(command, check=True)
+    write_loaddata_csv(
+        index_directory=index_directory,
+        config_path=config_path,
+        path_to_output=path_to_output,
+    )
     print(f"{path_to_output.name} is created!")
 
 
 def create_loaddata_illum_csv(
     index_directory: pathlib.Path,
     config_path: pathlib.Path,
-    path_to_output: pathlib.Path,
     illum_directory: pathlib.Path,
     plate_id: str,
     illum_output_path: pathlib.Path,
@@ -53,9 +260,7 @@ def create_loaddata_illum_csv(
     index_directory : pathlib.Path
         path to the `Index.idx.xml` file for the plate (normally located in the /Images folder)
     config_path : pathlib.Path
-        path to the `config.yml' file for pe2loaddata to process the csv
-    path_to_output : pathlib.Path
-        path to the `wave1_loaddata.csv' file used for generating the illumination correction functions for each channel
+        path to the `config.yml' file with the channel map and metadata to process the csv
     illum_directory : pathlib.Path
         path to folder where the illumination correction functions (.npy files) are located
     plate_id : str
@@ -63,23 +268,271 @@ def create_loaddata_illum_csv(
     illum_output_path : pathlib.Path
         path to where the new csv will be created along with the name (e.g. path/to/wave1_loaddata_with_illum.csv)
     """
-    command = [
-        "pe2loaddata",
-        "--index-directory",
-        str(index_directory),
-        str(config_path),
-        str(path_to_output),
-        "--illum",
-        "--illum-directory",
-        str(illum_directory),
-        "--plate-id",
-        plate_id,
-        "--illum-output",
-        str(illum_output_path),
-    ]
-    subprocess.run(command, check=True)
+    write_loaddata_csv(
+        index_directory=index_directory,
+        config_path=config_path,
+        path_to_output=illum_output_path,
+        illum_directory=illum_directory,
+        plate_id=plate_id,
+    )
     print(f"{illum_output_path.name} is created!")
 
-    # remove the LoadData CSV that is created without the illum functions as it is not needed
-    os.remove(path_to_output)
-    print(f"The {path_to_output.name} CSV file has been removed as it does not contain the IC functions.")
+
+def create_loaddata_csvs_parallel(loaddata_jobs: List[dict], max_workers: Optional[int] = None):
+    """
+    Create the LoadData csvs for many Images folders at once, parsing each `Index.idx.xml` file in its own process
+
+    Parameters
+    ----------
+    loaddata_jobs : List[dict]
+        keyword arguments for `write_loaddata_csv` per Images folder (index_directory, config_path, path_to_output and
+        optionally illum_directory, plate_id and image_index_path)
+    max_workers : Optional[int]
+        maximum number of processes (default is None, the number of CPUs)
+
+    Raises
+    ------
+    RuntimeError
+        if any LoadData csv could not be created (after all other csvs are created)
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(write_loaddata_csv, **job): pathlib.Path(job["path_to_output"]) for job in loaddata_jobs
+        }
+
+    failed = []
+    for future, path_to_output in futures.items():
+        if future.exception() is not None:
+            print(f"{path_to_output.name} could not be created: {future.exception()}")
+            failed.append(path_to_output.name)
+        else:
+            print(f"{path_to_output.name} is created with {future.result()} rows!")
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} LoadData CSVs could not be created: {failed}")
+
+
+def add_illum_columns(
+    path_to_loaddata: pathlib.Path,
+    illum_directory: pathlib.Path,
+    path_to_output: pathlib.Path,
+) -> pd.DataFrame:
+    """
+    Add the illum correction function columns to an existing LoadData csv (e.g. the concatenated csvs made for
+    illumination correction), instead of parsing the `Index.idx.xml` files again. The columns are added for every
+    `FileName_Orig*` channel (in alphabetical order, before `Metadata_Reimaged` if it exists) using each row's
+    `Metadata_Plate`, and every function is checked to exist in `illum_directory/<plate>`.
+
+    Parameters
+    ----------
+    path_to_loaddata : pathlib.Path
+        path to the LoadData csv (or Parquet file) without illum functions
+    illum_directory : pathlib.Path
+        path to folder with one folder of illumination correction functions (.npy files) per plate
+    path_to_output : pathlib.Path
+        path to where the new csv will be created along with the name (e.g. path/to/plate_concatenated_with_illum.csv)
+
+    Raises
+    ------
+    FileNotFoundError
+        if an illumination correction function for a plate and channel does not exist
+
+    Returns
+    -------
+    pd.DataFrame
+        LoadData with illum function columns
+    """
+    loaddata_df = loaddata_store.read_loaddata(path_to_loaddata)
+
+    channels = sorted(
+        col.replace("FileName_Orig", "") for col in loaddata_df.columns if col.startswith("FileName_Orig")
+    )
+    plates = loaddata_df["Metadata_Plate"].astype(str)
+    plate_directories = {plate: pathlib.Path(illum_directory / plate).absolute() for plate in plates.unique()}
+
+    missing_functions = [
+        str(plate_directory / f"{plate}_Illum{channel}.npy")
+        for plate, plate_directory in plate_directories.items()
+        for channel in channels
+        if not (plate_directory / f"{plate}_Illum{channel}.npy").exists()
+    ]
+    if missing_functions:
+        raise FileNotFoundError(f"Illumination correction functions are missing: {missing_functions}")
+
+    illum_columns = {}
+    for channel in channels:
+        illum_columns[f"FileName_Illum{channel}"] = plates + f"_Illum{channel}.npy"
+        illum_columns[f"PathName_Illum{channel}"] = plates.map(lambda plate: str(plate_directories[plate]))
+
+    # keep the re-imaged flag as the last column, as in the csvs created from the Index.idx.xml files
+    position = (
+        loaddata_df.columns.get_loc("Metadata_Reimaged")
+        if "Metadata_Reimaged" in loaddata_df.columns
+        else len(loaddata_df.columns)
+    )
+    illum_df = pd.concat(
+        [loaddata_df.iloc[:, :position], pd.DataFrame(illum_columns), loaddata_df.iloc[:, position:]], axis=1
+    )
+
+    path_to_output.parent.mkdir(parents=True, exist_ok=True)
+    illum_df.to_csv(path_to_output, index=False)
+    print(f"{path_to_output.name} is created!")
+
+    return illum_df
+
+
+def _read_loaddata_csv(path_to_loaddata: pathlib.Path) -> pd.DataFrame:
+    """
+    Read a LoadData csv with the path columns as categoricals, since every image set in a folder has the same path.
+    """
+    columns = pd.read_csv(path_to_loaddata, nrows=0).columns
+    return pd.read_csv(
+        path_to_loaddata, dtype={col: "category" for col in columns if col.startswith("PathName_")}
+    )
+
+
+def _hash_loaddata_csvs(plate_csvs: List[pathlib.Path]) -> str:
+    """
+    Hash the names and contents of the LoadData csvs of a plate (they are created again on every run, so their
+    modification times can not tell if they changed).
+    """
+    sha1 = hashlib.sha1()
+    for csv_path in sorted(plate_csvs, key=lambda csv_path: csv_path.name):
+        sha1.update(csv_path.name.encode())
+        sha1.update(csv_path.read_bytes())
+    return sha1.hexdigest()
+
+
+def merge_reimaged_plate(
+    plate_csvs: List[pathlib.Path], path_to_output: pathlib.Path
+) -> Optional[pathlib.Path]:
+    """
+    Merge the LoadData csvs of one plate (the original imaging and any re-imaged wells) into one csv. Rows from the
+    original csv are replaced by the re-imaged rows with the same well and site, and `Metadata_Reimaged` is added
+    based on the file name (as it contains "Re-imaged"). The csv is sorted by column, row and site, and written to a
+    temporary file that is renamed so a partial csv is never left behind. A hash of the input csvs is saved next to
+    the output (<output>.sha1), and if the input csvs have the same contents as for the existing output, the plate
+    is not merged again.
+
+    Parameters
+    ----------
+    plate_csvs : List[pathlib.Path]
+        paths to the LoadData csvs of the plate (original and re-imaged)
+    path_to_output : pathlib.Path
+        path to the concatenated csv (e.g. path/to/BR00143976_concatenated.csv)
+
+    Raises
+    ------
+    ValueError
+        if none of the csvs is from the original imaging of the plate (only re-imaged csvs)
+
+    Returns
+    -------
+    Optional[pathlib.Path]
+        path to the concatenated csv, or None if it was already up to date
+    """
+    if not any("Re-imaged" not in csv_path.stem for csv_path in plate_csvs):
+        raise ValueError(
+            f"{path_to_output.name} can not be created, as the plate only has re-imaged LoadData csvs: "
+            f"{[csv_path.name for csv_path in plate_csvs]}"
+        )
+
+    inputs_hash = _hash_loaddata_csvs(plate_csvs)
+    path_to_hash = path_to_output.with_name(f"{path_to_output.name}.sha1")
+    if path_to_output.exists() and path_to_hash.exists() and path_to_hash.read_text().strip() == inputs_hash:
+        return None
+
+    original_csvs = [csv_path for csv_path in plate_csvs if "Re-imaged" not in csv_path.stem]
+    reimaged_csvs = sorted(csv_path for csv_path in plate_csvs if "Re-imaged" in csv_path.stem)
+
+    # the original plate csv sets the column order for the re-imaged csvs (which can have another channel order)
+    original_df = pd.concat([_read_loaddata_csv(csv_path) for csv_path in original_csvs], ignore_index=True)
+    column_order = original_df.columns.tolist()
+    merged_dfs = [original_df.assign(Metadata_Reimaged=False)]
+
+    if reimaged_csvs:
+        # only the re-imaged rows are compared, the first csv (by name) is used if a site was re-imaged twice
+        reimaged_df = (
+            pd.concat([_read_loaddata_csv(csv_path)[column_order] for csv_path in reimaged_csvs], ignore_index=True)
+            .drop_duplicates(subset=["Metadata_Well", "Metadata_Site"], keep="first")
+            .assign(Metadata_Reimaged=True)
+        )
+        reimaged_sites = pd.MultiIndex.from_frame(reimaged_df[["Metadata_Well", "Metadata_Site"]])
+        original_sites = pd.MultiIndex.from_frame(original_df[["Metadata_Well", "Metadata_Site"]])
+
+        merged_dfs = [merged_dfs[0][~original_sites.isin(reimaged_sites)], reimaged_df]
+
+    merged_df = (
+        pd.concat(merged_dfs, ignore_index=True)
+        .drop_duplicates(subset=["Metadata_Well", "Metadata_Site"], keep="first")
+        .sort_values(["Metadata_Col", "Metadata_Row", "Metadata_Site"], kind="stable")
+    )
+
+    temp_path = path_to_output.with_name(f"{path_to_output.name}.tmp")
+    merged_df.to_csv(temp_path, index=False)
+    os.replace(temp_path, path_to_output)
+    path_to_hash.write_text(inputs_hash)
+
+    return path_to_output
+
+
+def merge_reimaged_plates(
+    loaddata_csvs: List[pathlib.Path],
+    output_dir: pathlib.Path,
+    output_suffix: str = "_concatenated",
+    max_workers: Optional[int] = None,
+) -> Dict[str, pathlib.Path]:
+    """
+    Merge the re-imaged LoadData csvs back to their original plate for all plates in parallel (one process per
+    plate), grouping the csvs by the BR00 plate ID in their file names. Plates with only re-imaged csvs are reported
+    and not merged.
+
+    Parameters
+    ----------
+    loaddata_csvs : List[pathlib.Path]
+        paths to the LoadData csvs of all plates (csvs ending with the output suffix are ignored)
+    output_dir : pathlib.Path
+        path to the folder for the concatenated csvs
+    output_suffix : str
+        suffix of the concatenated csv names after the plate ID (default is "_concatenated")
+    max_workers : Optional[int]
+        maximum number of processes (default is None, the number of CPUs)
+
+    Returns
+    -------
+    Dict[str, pathlib.Path]
+        plate ID to the path of the concatenated csv
+    """
+    plate_csvs = {}
+    for csv_path in sorted(loaddata_csvs):
+        if csv_path.stem.endswith(output_suffix):
+            continue
+        match = re.search(r"(BR00\d+)", csv_path.stem)
+        if match is None:
+            print(f"Warning: {csv_path.name} does not have a plate ID and was not used!")
+            continue
+        plate_csvs.setdefault(match.group(1), []).append(csv_path)
+
+    for plate_id, csv_paths in list(plate_csvs.items()):
+        if all("Re-imaged" in csv_path.stem for csv_path in csv_paths):
+            print(f"Warning: {plate_id} only has re-imaged LoadData csvs and was not merged: {[csv_path.name for csv_path in csv_paths]}")
+            del plate_csvs[plate_id]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            plate_id: executor.submit(
+                merge_reimaged_plate, csv_paths, output_dir / f"{plate_id}{output_suffix}.csv"
+            )
+            for plate_id, csv_paths in sorted(plate_csvs.items(), key=lambda item: int(item[0][4:]))
+        }
+
+    output_paths = {}
+    for plate_id, future in futures.items():
+        output_path = future.result()
+        if output_path is None:
+            print(f"{plate_id}{output_suffix}.csv is up to date, skipping.")
+        else:
+            print(f"Saved: {output_path}")
+        output_paths[plate_id] = output_dir / f"{plate_id}{output_suffix}.csv"
+
+    return output_paths
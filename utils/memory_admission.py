@@ -0,0 +1,99 @@
+"""
+This collection of functions decides when another CellProfiler process can be started based on memory, so parallel
+runs keep the machine busy without running out of memory and swapping.
+"""
+
+import json
+import os
+import pathlib
+from typing import Optional
+
+
+def get_total_memory_bytes() -> int:
+    """
+    This function gets the total physical memory of the machine.
+
+    Returns:
+        int: total memory in bytes
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def get_available_memory_bytes() -> int:
+    """
+    This function gets the memory that can be used by new processes without swapping. On Linux this is
+    `MemAvailable` from /proc/meminfo (which includes reclaimable cache), otherwise the number of free pages.
+
+    Returns:
+        int: available memory in bytes
+    """
+    meminfo_path = pathlib.Path("/proc/meminfo")
+    if meminfo_path.exists():
+        with open(meminfo_path) as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    # the value is reported in kilobytes
+                    return int(line.split()[1]) * 1024
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def estimate_job_memory_from_metrics(metrics_path: pathlib.Path) -> Optional[int]:
+    """
+    This function estimates the memory needed per CellProfiler process from the peak RSS recorded for a previous
+    run with the same run name (see `job_telemetry`), using the largest peak so the estimate is not too low.
+
+    Args:
+        metrics_path (pathlib.Path): path to the metrics JSON file of the run
+
+    Returns:
+        Optional[int]: estimated memory per process in bytes, or None if there are no recorded peaks
+    """
+    if not metrics_path.exists():
+        return None
+
+    with open(metrics_path) as metrics_file:
+        peaks = [
+            record["peak_rss_bytes"]
+            for record in json.load(metrics_file)
+            if record.get("peak_rss_bytes") and record.get("returncode") == 0
+        ]
+
+    return max(peaks) if peaks else None
+
+
+def can_start_job(
+    num_running: int,
+    max_workers: int,
+    memory_per_job_bytes: Optional[int],
+    memory_budget_bytes: int,
+    min_available_bytes: int,
+) -> bool:
+    """
+    This function decides if another CellProfiler process can be started. A process is started when a worker is free,
+    the projected memory of all running processes plus the new one fits in the memory budget, and the machine
+    would still have at least `min_available_bytes` of memory available after the new process reaches its peak.
+    When nothing is running, a process is always started so the run keeps making progress.
+
+    Args:
+        num_running (int): number of CellProfiler processes running now
+        max_workers (int): maximum number of CellProfiler processes to run at once
+        memory_per_job_bytes (Optional[int]): estimated peak memory of one process, or None if unknown
+        memory_budget_bytes (int): maximum total memory for all CellProfiler processes
+        min_available_bytes (int): memory that should always stay available on the machine
+
+    Returns:
+        bool: True if another process can be started
+    """
+    if num_running == 0:
+        return True
+
+    if num_running >= max_workers:
+        return False
+
+    estimate = memory_per_job_bytes or 0
+
+    if (num_running + 1) * estimate > memory_budget_bytes:
+        return False
+
+    return get_available_memory_bytes() - estimate >= min_available_bytes
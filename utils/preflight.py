@@ -0,0 +1,258 @@
+"""
+This collection of functions checks every image referenced by LoadData before CellProfiler is started, so missing,
+empty, truncated or corrupt TIFFs are found in seconds instead of hours into a run. Only the file metadata and the
+TIFF header of each image are read, using a thread pool since the checks wait on the disk.
+"""
+
+import os
+import pathlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import pandas as pd
+
+import loaddata_store
+
+# TIFF tags read from the first image file directory
+IMAGE_WIDTH_TAG = 256
+IMAGE_LENGTH_TAG = 257
+BITS_PER_SAMPLE_TAG = 258
+STRIP_OFFSETS_TAG = 273
+STRIP_BYTE_COUNTS_TAG = 279
+TILE_OFFSETS_TAG = 324
+TILE_BYTE_COUNTS_TAG = 325
+
+# struct format and size of each TIFF field type (BYTE, ASCII, SHORT, LONG, RATIONAL, ..., LONG8)
+FIELD_TYPES = {1: ("B", 1), 2: ("c", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8), 16: ("Q", 8)}
+
+METADATA_COLUMNS = ["Metadata_Plate", "Metadata_Well", "Metadata_Site"]
+
+TIFF_EXTENSIONS = (".tiff", ".tif")
+
+
+def _read_field_values(
+    tiff_file, byte_order: str, field_type: int, count: int, value_bytes: bytes, offset_format: str
+) -> List[int]:
+    """
+    Read the values of a TIFF field, which are stored in the entry itself when they fit or else at an offset.
+    """
+    if field_type not in FIELD_TYPES:
+        return []
+
+    value_format, value_size = FIELD_TYPES[field_type]
+    size = value_size * count
+
+    if size > len(value_bytes):
+        (offset,) = struct.unpack(byte_order + offset_format, value_bytes)
+        tiff_file.seek(offset)
+        data = tiff_file.read(size)
+        if len(data) < size:
+            raise ValueError("field values are past the end of the file")
+    else:
+        data = value_bytes[:size]
+
+    return list(struct.unpack(f"{byte_order}{count * value_format}", data))
+
+
+def read_tiff_header(image_path: pathlib.Path) -> dict:
+    """
+    This function reads the header and first image file directory of a TIFF (classic or BigTIFF) without reading
+    the pixel data.
+
+    Args:
+        image_path (pathlib.Path): path to the TIFF
+
+    Raises:
+        ValueError: if the file is not a valid TIFF
+
+    Returns:
+        dict: width, height and bits per sample of the image, and the byte where its pixel data ends
+    """
+    with open(image_path, "rb") as tiff_file:
+        header = tiff_file.read(16)
+        if header[:2] not in (b"II", b"MM"):
+            raise ValueError("not a TIFF file")
+        byte_order = "<" if header[:2] == b"II" else ">"
+
+        (version,) = struct.unpack(byte_order + "H", header[2:4])
+        if version == 42:
+            (ifd_offset,) = struct.unpack(byte_order + "I", header[4:8])
+            count_format, entry_format, offset_format, entry_size = "H", "HHI4s", "I", 12
+        elif version == 43:
+            (ifd_offset,) = struct.unpack(byte_order + "Q", header[8:16])
+            count_format, entry_format, offset_format, entry_size = "Q", "HHQ8s", "Q", 20
+        else:
+            raise ValueError(f"unknown TIFF version {version}")
+
+        tiff_file.seek(ifd_offset)
+        count_bytes = tiff_file.read(struct.calcsize(count_format))
+        if len(count_bytes) < struct.calcsize(count_format):
+            raise ValueError("image file directory is past the end of the file")
+        (num_entries,) = struct.unpack(byte_order + count_format, count_bytes)
+
+        entries_bytes = tiff_file.read(num_entries * entry_size)
+        if len(entries_bytes) < num_entries * entry_size:
+            raise ValueError("image file directory is truncated")
+
+        tags = {}
+        for entry_index in range(num_entries):
+            tag, field_type, count, value_bytes = struct.unpack(
+                byte_order + entry_format,
+                entries_bytes[entry_index * entry_size : (entry_index + 1) * entry_size],
+            )
+            if tag in (
+                IMAGE_WIDTH_TAG,
+                IMAGE_LENGTH_TAG,
+                BITS_PER_SAMPLE_TAG,
+                STRIP_OFFSETS_TAG,
+                STRIP_BYTE_COUNTS_TAG,
+                TILE_OFFSETS_TAG,
+                TILE_BYTE_COUNTS_TAG,
+            ):
+                tags[tag] = _read_field_values(
+                    tiff_file, byte_order, field_type, count, value_bytes, offset_format
+                )
+
+    if IMAGE_WIDTH_TAG not in tags or IMAGE_LENGTH_TAG not in tags:
+        raise ValueError("image dimensions are missing")
+
+    # the pixel data ends at the end of the last strip (or tile)
+    offsets = tags.get(STRIP_OFFSETS_TAG) or tags.get(TILE_OFFSETS_TAG) or []
+    byte_counts = tags.get(STRIP_BYTE_COUNTS_TAG) or tags.get(TILE_BYTE_COUNTS_TAG) or []
+    data_end = max((offset + size for offset, size in zip(offsets, byte_counts)), default=0)
+
+    return {
+        "width": tags[IMAGE_WIDTH_TAG][0],
+        "height": tags[IMAGE_LENGTH_TAG][0],
+        "bits_per_sample": tags.get(BITS_PER_SAMPLE_TAG, [1])[0],
+        "data_end": data_end,
+    }
+
+
+def check_image(image_path: pathlib.Path) -> Tuple[Optional[str], Optional[dict]]:
+    """
+    This function checks that an image exists, is not empty and has a valid TIFF header with all of its pixel data
+    in the file. Files that are not TIFFs (e.g., illumination functions) are only checked to exist and not be empty.
+
+    Args:
+        image_path (pathlib.Path): path to the image
+
+    Returns:
+        Tuple[Optional[str], Optional[dict]]: the problem with the image (None if there is none) and the TIFF header
+    """
+    try:
+        size = os.stat(image_path).st_size
+    except FileNotFoundError:
+        return "missing", None
+    except OSError as error:
+        return f"unreadable ({error.strerror})", None
+
+    if size == 0:
+        return "zero-byte", None
+
+    if not str(image_path).lower().endswith(TIFF_EXTENSIONS):
+        return None, None
+
+    try:
+        header = read_tiff_header(image_path)
+    except (ValueError, struct.error, OSError) as error:
+        return f"corrupt ({error})", None
+
+    if header["data_end"] > size:
+        return f"truncated ({size} of {header['data_end']} bytes)", header
+
+    return None, header
+
+
+def validate_loaddata_images(
+    loaddata_paths: List[pathlib.Path],
+    max_workers: int = 32,
+    expected_shape: Optional[Tuple[int, int]] = None,
+    expected_bits_per_sample: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    This function checks every image (all `FileName_*`/`PathName_*` columns) in the LoadData files. Images with
+    dimensions or bit depths that do not match the expected values are also reported. When no expected values are
+    given, the most common values across all images are expected.
+
+    Args:
+        loaddata_paths (List[pathlib.Path]): paths to the LoadData CSV or Parquet files to check
+        max_workers (int, optional): number of threads to check images with. Defaults to 32.
+        expected_shape (Optional[Tuple[int, int]], optional): expected (height, width) of every image.
+            Defaults to None (the most common shape).
+        expected_bits_per_sample (Optional[int], optional): expected bit depth of every image.
+            Defaults to None (the most common bit depth).
+
+    Returns:
+        pd.DataFrame: one row per problem with the plate, well, site, image name, path and problem
+    """
+    image_dfs = []
+    for loaddata_path in loaddata_paths:
+        loaddata_df = loaddata_store.read_loaddata(loaddata_path)
+        image_names = [col.replace("FileName_", "") for col in loaddata_df.columns if col.startswith("FileName_")]
+        for image_name in image_names:
+            image_dfs.append(
+                loaddata_df[METADATA_COLUMNS]
+                .astype({"Metadata_Plate": str, "Metadata_Well": str})
+                .assign(
+                    image_name=image_name,
+                    path=loaddata_df[f"PathName_{image_name}"].astype(str)
+                    + os.sep
+                    + loaddata_df[f"FileName_{image_name}"].astype(str),
+                )
+            )
+
+    if not image_dfs:
+        return pd.DataFrame(columns=METADATA_COLUMNS + ["image_name", "path", "problem"])
+
+    # the same image can be referenced by more than one LoadData file (e.g., shards and the full plate)
+    images_df = pd.concat(image_dfs, ignore_index=True).drop_duplicates(subset="path", ignore_index=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        checks = list(executor.map(check_image, images_df["path"]))
+
+    images_df["problem"] = [problem for problem, _ in checks]
+    headers = pd.DataFrame(
+        [header or {"width": None, "height": None, "bits_per_sample": None} for _, header in checks]
+    )
+
+    valid = headers["width"].notna()
+    if valid.any():
+        if expected_shape is None:
+            expected_shape = tuple(
+                headers.loc[valid, ["height", "width"]].astype(int).value_counts().idxmax()
+            )
+        if expected_bits_per_sample is None:
+            expected_bits_per_sample = int(headers.loc[valid, "bits_per_sample"].astype(int).mode()[0])
+
+        wrong_shape = valid & (
+            (headers["height"] != expected_shape[0]) | (headers["width"] != expected_shape[1])
+        )
+        wrong_bits = valid & (headers["bits_per_sample"] != expected_bits_per_sample)
+        no_problem = images_df["problem"].isna()
+
+        images_df.loc[no_problem & wrong_shape, "problem"] = (
+            "unexpected shape ("
+            + headers["height"].astype("Int64").astype(str)
+            + "x"
+            + headers["width"].astype("Int64").astype(str)
+            + f", expected {expected_shape[0]}x{expected_shape[1]})"
+        )
+        images_df.loc[no_problem & ~wrong_shape & wrong_bits, "problem"] = (
+            "unexpected bit depth ("
+            + headers["bits_per_sample"].astype("Int64").astype(str)
+            + f", expected {expected_bits_per_sample})"
+        )
+
+    problems_df = images_df[images_df["problem"].notna()].reset_index(drop=True)
+
+    print(
+        f"Checked {len(images_df)} images from {len(loaddata_paths)} LoadData files: "
+        f"{len(problems_df)} problems found"
+    )
+    if not problems_df.empty:
+        problem_types = problems_df["problem"].str.split(" ").str[0].rename("problem_type")
+        print(problems_df.groupby(["Metadata_Plate", problem_types]).size().to_string())
+
+    return problems_df
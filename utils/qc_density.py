@@ -0,0 +1,372 @@
+"""
+This collection of functions renders the density plots of the whole image QC metrics from binned kernel density
+estimates instead of a KDE over every image. The metrics of each plate are counted in fixed-grid histograms per
+channel (read in chunks with only the metric columns), and each density is the histogram convolved with a Gaussian
+kernel using an FFT, with the same bandwidth as seaborn `kdeplot` (Scott's rule). The histograms and densities are
+cached per plate and only calculated again when the plate's `Image.csv` changes, and the figures are rendered in a
+process pool with the Agg backend.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import qc_thresholds
+from image_qc import QC_CHANNELS
+
+# fixed grid per metric, with room for the kernel past the values (the saturation metric is plotted as log1p of the
+# percent, which is from 0 to log1p(100))
+DENSITY_GRIDS = {"PowerLogLogSlope": (-6.0, 1.0), "PercentMaximal": (-1.0, 5.0)}
+TRANSFORMS = {"PercentMaximal": np.log1p}
+NUM_BINS = 2048
+
+# densities are cut at this many bandwidths past the minimum and maximum value, as in seaborn
+CUT = 3
+
+CHANNEL_COLORS = ["b", "g", "r", "magenta", "orange"]
+
+# PNG text key with the hash of the spec a figure was rendered from
+FIGURE_HASH_KEY = "QC density spec"
+
+
+def get_grid(metric: str, num_bins: int = NUM_BINS) -> Tuple[np.ndarray, float]:
+    """
+    Get the bin centers and bin width of the fixed grid of a metric.
+    """
+    start, stop = DENSITY_GRIDS[metric]
+    bin_width = (stop - start) / num_bins
+    return start + bin_width * (np.arange(num_bins) + 0.5), bin_width
+
+
+def transform_values(values: np.ndarray, metric: str) -> np.ndarray:
+    """
+    Transform the values of a metric to the scale they are plotted on (finite values only).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    return TRANSFORMS[metric](values) if metric in TRANSFORMS else values
+
+
+def histogram_values(values: np.ndarray, metric: str, num_bins: int = NUM_BINS) -> np.ndarray:
+    """
+    This function counts values (already transformed) in the fixed grid of a metric. Values outside the grid are
+    counted in the first or last bin.
+
+    Args:
+        values (np.ndarray): values of the metric
+        metric (str): image quality metric (e.g., "PowerLogLogSlope")
+        num_bins (int, optional): number of bins. Defaults to NUM_BINS.
+
+    Returns:
+        np.ndarray: count per bin
+    """
+    start, stop = DENSITY_GRIDS[metric]
+    bins = np.floor((values - start) / (stop - start) * num_bins).astype(np.int64)
+    return np.bincount(np.clip(bins, 0, num_bins - 1), minlength=num_bins).astype(np.float64)
+
+
+def calculate_density(
+    counts: np.ndarray, statistics: dict, metric: str, bw_adjust: float = 1.0
+) -> np.ndarray:
+    """
+    This function calculates the kernel density estimate of binned values by convolving the histogram with a Gaussian
+    kernel using an FFT. The bandwidth is the standard deviation times n^(-1/5) (Scott's rule, the seaborn
+    default), and the density is missing (NaN) past the minimum and maximum by 3 bandwidths, as seaborn cuts it.
+
+    Args:
+        counts (np.ndarray): count per bin of the fixed grid
+        statistics (dict): running statistics of the (transformed) values from `qc_thresholds`
+        metric (str): image quality metric (e.g., "PowerLogLogSlope")
+        bw_adjust (float, optional): factor to scale the bandwidth by. Defaults to 1.0.
+
+    Returns:
+        np.ndarray: density per bin (integrates to 1 over the grid)
+    """
+    centers, bin_width = get_grid(metric, len(counts))
+    density = np.full(len(counts), np.nan)
+
+    count = statistics["count"]
+    std_dev = qc_thresholds.get_standard_deviation(statistics)
+    if count < 2 or not std_dev > 0:
+        return density
+
+    bandwidth = bw_adjust * std_dev * count ** (-1 / 5)
+
+    # the kernel is sampled to 4 bandwidths (at most the grid width) and the FFT is padded so it does not wrap around
+    half_width = min(int(np.ceil(4 * bandwidth / bin_width)), len(counts))
+    offsets = np.arange(-half_width, half_width + 1) * bin_width
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    kernel /= kernel.sum()
+
+    fft_size = 1 << int(np.ceil(np.log2(len(counts) + len(kernel) - 1)))
+    smoothed = np.fft.irfft(np.fft.rfft(counts, fft_size) * np.fft.rfft(kernel, fft_size), fft_size)
+    smoothed = np.maximum(smoothed[half_width : half_width + len(counts)], 0)
+
+    support = (centers >= statistics["min"] - CUT * bandwidth) & (centers <= statistics["max"] + CUT * bandwidth)
+    density[support] = smoothed[support] / (counts.sum() * bin_width)
+    return density
+
+
+def calculate_plate_densities(
+    path_to_qc: pathlib.Path, channels: List[str], metrics: List[str], chunksize: int = 100_000
+) -> dict:
+    """
+    This function reads the `Image.csv` of a plate in chunks, with only the metric columns, and calculates the
+    histogram, running statistics and density of each metric per channel.
+
+    Args:
+        path_to_qc (pathlib.Path): path to the `Image.csv` of the plate
+        channels (List[str]): image names
+        metrics (List[str]): image quality metrics
+        chunksize (int, optional): number of rows read at a time. Defaults to 100,000.
+
+    Returns:
+        dict: per metric, the histograms and densities (channels x bins) and the running statistics per channel
+    """
+    histograms = {metric: np.zeros((len(channels), NUM_BINS)) for metric in metrics}
+    statistics = {
+        metric: {channel: qc_thresholds.create_running_statistics() for channel in channels} for metric in metrics
+    }
+
+    columns = [f"ImageQuality_{metric}_{channel}" for metric in metrics for channel in channels]
+    for chunk_df in pd.read_csv(path_to_qc, usecols=columns, chunksize=chunksize):
+        for metric in metrics:
+            for channel_index, channel in enumerate(channels):
+                values = transform_values(chunk_df[f"ImageQuality_{metric}_{channel}"].to_numpy(), metric)
+                histograms[metric][channel_index] += histogram_values(values, metric)
+                qc_thresholds.update_running_statistics(statistics[metric][channel], values)
+
+    densities = {
+        metric: np.stack(
+            [
+                calculate_density(histograms[metric][channel_index], statistics[metric][channel], metric)
+                for channel_index, channel in enumerate(channels)
+            ]
+        )
+        for metric in metrics
+    }
+
+    return {"histograms": histograms, "densities": densities, "statistics": statistics}
+
+
+def update_density_cache(
+    qc_dir: pathlib.Path,
+    cache_dir: pathlib.Path,
+    channels: List[str] = QC_CHANNELS,
+    metrics: List[str] = qc_thresholds.QC_METRICS,
+) -> Dict[str, dict]:
+    """
+    This function loads the cached histograms and densities of every plate in the QC folder (one `Image.csv` per
+    plate folder), and calculates them again for plates that are new or have a changed `Image.csv`. The cache of each
+    plate is saved as <plate>.npz with the settings and signature of the `Image.csv` as JSON.
+
+    Args:
+        qc_dir (pathlib.Path): path to the folder with a folder per plate
+        cache_dir (pathlib.Path): path to the folder for the cache
+        channels (List[str], optional): image names. Defaults to QC_CHANNELS.
+        metrics (List[str], optional): image quality metrics. Defaults to QC_METRICS.
+
+    Returns:
+        Dict[str, dict]: histograms, densities and running statistics per plate
+    """
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    settings = {"channels": list(channels), "metrics": list(metrics), "num_bins": NUM_BINS}
+    settings["grids"] = {metric: list(DENSITY_GRIDS[metric]) for metric in metrics}
+
+    density_cache = {}
+    for plate_dir in sorted(pathlib.Path(qc_dir).iterdir()):
+        path_to_qc = plate_dir / "Image.csv"
+        if not path_to_qc.is_file():
+            continue
+
+        stat = path_to_qc.stat()
+        signature = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        path_to_cache = cache_dir / f"{plate_dir.name}.npz"
+
+        if path_to_cache.exists():
+            with np.load(path_to_cache) as cached:
+                metadata = json.loads(str(cached["metadata"]))
+                if metadata["settings"] == settings and metadata["signature"] == signature:
+                    density_cache[plate_dir.name] = {
+                        "histograms": {metric: cached[f"histograms_{metric}"] for metric in metrics},
+                        "densities": {metric: cached[f"densities_{metric}"] for metric in metrics},
+                        "statistics": metadata["statistics"],
+                    }
+                    continue
+
+        print(f"Calculating the QC metric densities of {plate_dir.name}")
+        plate_densities = calculate_plate_densities(path_to_qc, channels, metrics)
+
+        temp_path = path_to_cache.with_name(f"{path_to_cache.stem}.tmp.npz")
+        np.savez(
+            temp_path,
+            metadata=json.dumps(
+                {"settings": settings, "signature": signature, "statistics": plate_densities["statistics"]}
+            ),
+            **{f"histograms_{metric}": plate_densities["histograms"][metric] for metric in metrics},
+            **{f"densities_{metric}": plate_densities["densities"][metric] for metric in metrics},
+        )
+        os.replace(temp_path, path_to_cache)
+
+        density_cache[plate_dir.name] = plate_densities
+
+    return density_cache
+
+
+def get_channel_densities(density_cache: dict, plate: str, metric: str) -> Dict[str, np.ndarray]:
+    """
+    Get the cached density of a metric per channel for a plate.
+    """
+    channels = list(density_cache[plate]["statistics"][metric])
+    return dict(zip(channels, density_cache[plate]["densities"][metric]))
+
+
+def get_plate_densities(density_cache: dict, metric: str, common_norm: bool = True) -> Dict[str, np.ndarray]:
+    """
+    This function calculates the density of a metric per plate across all channels (from the summed histograms).
+
+    Args:
+        density_cache (dict): histograms, densities and running statistics per plate
+        metric (str): image quality metric (e.g., "PowerLogLogSlope")
+        common_norm (bool, optional): scale each density by the fraction of images in the plate, so the densities
+            sum to 1 (as seaborn `common_norm`). Defaults to True.
+
+    Returns:
+        Dict[str, np.ndarray]: density per plate
+    """
+    densities = {}
+    for plate, plate_cache in density_cache.items():
+        statistics = qc_thresholds.merge_running_statistics(list(plate_cache["statistics"][metric].values()))
+        densities[plate] = (
+            calculate_density(plate_cache["histograms"][metric].sum(axis=0), statistics, metric),
+            statistics["count"],
+        )
+
+    total = sum(count for _, count in densities.values())
+    return {
+        plate: density * (count / total if common_norm and total > 0 else 1.0)
+        for plate, (density, count) in densities.items()
+    }
+
+
+def get_outlier_densities(
+    outliers_df: pd.DataFrame, metric: str, hue: str = "Metadata_Plate"
+) -> Dict[str, np.ndarray]:
+    """
+    This function calculates the density of a metric per group of the outliers (each integrates to 1).
+
+    Args:
+        outliers_df (pd.DataFrame): outliers with the metric (`ImageQuality_<metric>`) and the hue column
+        metric (str): image quality metric (e.g., "PowerLogLogSlope")
+        hue (str, optional): column to group by. Defaults to "Metadata_Plate".
+
+    Returns:
+        Dict[str, np.ndarray]: density per group
+    """
+    densities = {}
+    for group, group_df in outliers_df.groupby(hue, sort=True):
+        values = transform_values(group_df[f"ImageQuality_{metric}"].to_numpy(), metric)
+        statistics = qc_thresholds.create_running_statistics()
+        qc_thresholds.update_running_statistics(statistics, values)
+        densities[str(group)] = calculate_density(histogram_values(values, metric), statistics, metric)
+
+    return densities
+
+
+def get_colors(labels: List[str], palette: Optional[str] = None) -> List:
+    """
+    Get a color per label from a list of colors or a matplotlib colormap name (the default color cycle if None).
+    """
+    import matplotlib
+
+    if palette is None:
+        cycle = matplotlib.rcParams["axes.prop_cycle"].by_key()["color"]
+        return [cycle[index % len(cycle)] for index in range(len(labels))]
+
+    return [tuple(color) for color in matplotlib.colormaps[palette](np.linspace(0, 1, len(labels)))]
+
+
+def render_density_figure(figure_spec: dict) -> pathlib.Path:
+    """
+    This function renders a figure of density plots (one panel per spec) with the Agg backend and saves it, unless
+    the saved figure was rendered from the same spec.
+
+    Args:
+        figure_spec (dict): path to save to ("path"), figure size ("figsize"), number of rows and columns ("num_rows",
+            "num_cols"), "dpi" and the panels, each with the metric, the densities per label, their colors, and an
+            optional title, x label, legend title, threshold lines ("vlines") and x limits ("xlim")
+
+    Returns:
+        pathlib.Path: path to the saved figure
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from PIL import Image
+
+    path = pathlib.Path(figure_spec["path"])
+    spec_hash = hashlib.sha1(pickle.dumps(figure_spec)).hexdigest()
+
+    # figures rendered from the same spec (e.g., plates that did not change) are not rendered again
+    if path.exists():
+        with Image.open(path) as saved_figure:
+            if saved_figure.info.get(FIGURE_HASH_KEY) == spec_hash:
+                return path
+
+    figure = Figure(figsize=figure_spec.get("figsize", (6.4, 4.8)))
+    FigureCanvasAgg(figure)
+
+    num_rows, num_cols = figure_spec.get("num_rows", 1), figure_spec.get("num_cols", 1)
+    for panel_index, panel in enumerate(figure_spec["panels"]):
+        ax = figure.add_subplot(num_rows, num_cols, panel_index + 1)
+        ax.grid(True, color="0.9")
+        ax.set_axisbelow(True)
+
+        centers, _ = get_grid(panel["metric"], NUM_BINS)
+        for (label, density), color in zip(panel["densities"].items(), panel["colors"]):
+            ax.fill_between(centers, density, color=color, alpha=0.25, linewidth=0)
+            ax.plot(centers, density, color=color, linewidth=1.5, label=label)
+
+        for vline in panel.get("vlines", []):
+            ax.axvline(x=vline, color="red", linestyle="--")
+
+        if panel.get("xlim") is not None:
+            ax.set_xlim(*panel["xlim"])
+        else:
+            # limit the x axis to where there is density
+            has_density = np.any([np.nan_to_num(density) > 0 for density in panel["densities"].values()], axis=0)
+            if np.any(has_density):
+                ax.set_xlim(centers[has_density][0], centers[has_density][-1])
+        ax.set_ylim(bottom=0)
+
+        ax.set_title(panel.get("title", ""))
+        ax.set_xlabel(panel.get("xlabel", ""))
+        ax.set_ylabel(panel.get("ylabel", "Density"))
+        ax.legend(title=panel.get("legend_title"))
+
+    figure.tight_layout()
+    figure.savefig(path, dpi=figure_spec.get("dpi", 500), metadata={FIGURE_HASH_KEY: spec_hash})
+
+    return path
+
+
+def render_density_figures(figure_specs: List[dict], max_workers: Optional[int] = None) -> List[pathlib.Path]:
+    """
+    This function renders figures of density plots in a process pool (see `render_density_figure`).
+
+    Args:
+        figure_specs (List[dict]): specs of the figures to render
+        max_workers (Optional[int], optional): number of processes. Defaults to None (the number of CPUs).
+
+    Returns:
+        List[pathlib.Path]: paths to the saved figures
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(render_density_figure, figure_specs))
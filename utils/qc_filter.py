@@ -0,0 +1,128 @@
+"""
+This collection of functions removes the image sets that fail the whole image QC thresholds from a LoadData file
+before CellProfiler runs, instead of loading all channels of those image sets in CellProfiler only for the FlagImage
+module to skip them. The thresholds are read from the FlagImage module of the pipeline (so they are the same as in
+CellProfiler), the measurements from the whole image QC `Image.csv` of the plate, and a file listing the removed
+image sets and the reason is saved next to the filtered LoadData.
+"""
+
+import os
+import pathlib
+from typing import List, Optional
+
+import pandas as pd
+
+import loaddata_store
+from illum_calculate import flag_image_sets, get_flag_rules
+
+SITE_COLUMNS = ["Metadata_Well", "Metadata_Site"]
+
+
+def get_flag_reasons(qc_df: pd.DataFrame, rules: List[dict]) -> pd.Series:
+    """
+    This function gets the rules each image set fails as text (e.g., "ImageQuality_PowerLogLogSlope_OrigDNA <
+    -2.7977"), to explain why image sets flagged with `illum_calculate.flag_image_sets` are removed.
+
+    Args:
+        qc_df (pd.DataFrame): image quality measurements of the flagged image sets
+        rules (List[dict]): thresholds per measurement (see `illum_calculate.get_flag_rules`)
+
+    Returns:
+        pd.Series: the failed rules joined by "; " per image set
+    """
+    failed_rules = []
+    for rule in rules:
+        values = qc_df[rule["measurement"]]
+        if rule["minimum"] is not None:
+            failed_rules.append(
+                pd.Series(f"{rule['measurement']} < {rule['minimum']:.4f}", index=qc_df.index).where(
+                    values < rule["minimum"]
+                )
+            )
+        if rule["maximum"] is not None:
+            failed_rules.append(
+                pd.Series(f"{rule['measurement']} > {rule['maximum']:.4f}", index=qc_df.index).where(
+                    values > rule["maximum"]
+                )
+            )
+
+    reasons = [
+        "; ".join(reason for reason in row if isinstance(reason, str))
+        for row in zip(*[failed_rule.tolist() for failed_rule in failed_rules])
+    ]
+    return pd.Series(reasons if failed_rules else "", index=qc_df.index, dtype=object)
+
+
+def filter_flagged_image_sets(
+    path_to_loaddata: pathlib.Path,
+    path_to_qc: pathlib.Path,
+    path_to_pipeline: pathlib.Path,
+    path_to_output: pathlib.Path,
+    path_to_excluded: Optional[pathlib.Path] = None,
+) -> pd.DataFrame:
+    """
+    This function removes the image sets that the FlagImage module of the pipeline would skip from a LoadData file
+    and saves the filtered LoadData CSV (which can be the same path as the input). The removed image sets are saved to
+    a CSV with the plate, well, site, measurements and reason. Image sets without image quality measurements are kept,
+    so FlagImage still checks them in CellProfiler.
+
+    Args:
+        path_to_loaddata (pathlib.Path): path to the LoadData CSV or Parquet file of the plate
+        path_to_qc (pathlib.Path): path to the `Image.csv` with the image quality measurements of the plate
+        path_to_pipeline (pathlib.Path): path to the pipeline with the FlagImage module
+        path_to_output (pathlib.Path): path to save the filtered LoadData CSV
+        path_to_excluded (Optional[pathlib.Path], optional): path to save the removed image sets. Defaults to None
+            (<output name>_excluded.csv next to the output).
+
+    Raises:
+        FileNotFoundError: if the `Image.csv` does not exist
+
+    Returns:
+        pd.DataFrame: LoadData without the flagged image sets
+    """
+    path_to_output = pathlib.Path(path_to_output)
+    path_to_excluded = pathlib.Path(
+        path_to_excluded or path_to_output.with_name(f"{path_to_output.stem}_excluded.csv")
+    )
+    if not pathlib.Path(path_to_qc).exists():
+        raise FileNotFoundError(f"The image quality measurements '{path_to_qc}' do not exist")
+
+    loaddata_df = loaddata_store.read_loaddata(path_to_loaddata)
+    rules, flag_if_all_fail = get_flag_rules(path_to_pipeline)
+    measurements = list(dict.fromkeys(rule["measurement"] for rule in rules))
+
+    # only the site and measurement columns are read, and matched to the LoadData rows by well and site
+    qc_df = (
+        loaddata_df[SITE_COLUMNS]
+        .astype(str)
+        .merge(
+            pd.read_csv(path_to_qc, usecols=SITE_COLUMNS + measurements)
+            .astype({col: str for col in SITE_COLUMNS})
+            .drop_duplicates(SITE_COLUMNS, keep="last"),
+            on=SITE_COLUMNS,
+            how="left",
+        )
+    )
+    qc_df.index = loaddata_df.index
+
+    flagged = flag_image_sets(qc_df, rules, flag_if_all_fail)
+    num_missing = int(qc_df[measurements].isna().all(axis=1).sum()) if measurements else 0
+
+    excluded_df = loaddata_df.loc[flagged, ["Metadata_Plate"] + SITE_COLUMNS].copy()
+    excluded_df[measurements] = qc_df.loc[flagged, measurements]
+    excluded_df["Reason"] = get_flag_reasons(qc_df[flagged], rules)
+
+    filtered_df = loaddata_df[~flagged]
+
+    for df, path in ((filtered_df, path_to_output), (excluded_df, path_to_excluded)):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f"{path.name}.tmp")
+        df.to_csv(temp_path, index=False)
+        os.replace(temp_path, path)
+
+    print(
+        f"Removed {flagged.sum()} of {len(loaddata_df)} image sets flagged by FlagImage from {path_to_output.name} "
+        f"({num_missing} image sets without QC measurements are kept), see {path_to_excluded}"
+    )
+
+    return filtered_df
@@ -0,0 +1,424 @@
+"""
+This collection of functions calculates the whole image QC thresholds across plates without loading every plate's
+`Image.csv` at once. Each plate is read in chunks with only the metric columns, and running statistics are kept per
+plate, channel and metric: the count, mean and sum of squared differences (Welford's method) and a quantile sketch
+(log-spaced bins with a relative accuracy, as in DDSketch). Both can be merged, so the statistics across plates and
+channels are merged from the per-plate statistics, which are saved to a JSON file. When a plate is added or its
+`Image.csv` changes, only that plate is read again.
+"""
+
+import json
+import math
+import os
+import pathlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from image_qc import QC_CHANNELS
+
+QC_METRICS = ["PowerLogLogSlope", "PercentMaximal"]
+
+# values closer to 0 than this are counted in the zero bin of the quantile sketch
+MIN_SKETCH_VALUE = 1e-9
+
+
+def create_running_statistics(relative_accuracy: float = 0.01) -> dict:
+    """
+    This function creates empty running statistics (moments and a quantile sketch).
+
+    Args:
+        relative_accuracy (float, optional): relative error of the quantiles from the sketch. Defaults to 0.01.
+
+    Returns:
+        dict: running statistics (can be saved as JSON)
+    """
+    return {
+        "count": 0,
+        "mean": 0.0,
+        "m2": 0.0,
+        "min": None,
+        "max": None,
+        "sketch": {"relative_accuracy": relative_accuracy, "zero": 0, "positive": {}, "negative": {}},
+    }
+
+
+def _get_gamma(sketch: dict) -> float:
+    """
+    Get the ratio between the bounds of the sketch bins from its relative accuracy.
+    """
+    return (1 + sketch["relative_accuracy"]) / (1 - sketch["relative_accuracy"])
+
+
+def _add_bin_counts(bins: dict, keys: np.ndarray) -> None:
+    """
+    Add one count per value to the bins of the sketch (keys are saved as strings for JSON).
+    """
+    unique_keys, counts = np.unique(keys, return_counts=True)
+    for key, count in zip(unique_keys.tolist(), counts.tolist()):
+        bins[str(key)] = bins.get(str(key), 0) + count
+
+
+def update_running_statistics(statistics: dict, values: np.ndarray) -> None:
+    """
+    This function adds values to running statistics in place. The moments of the values are merged with the
+    running moments (Chan et al.), which is as stable as adding one value at a time with Welford's method.
+
+    Args:
+        statistics (dict): running statistics to update
+        values (np.ndarray): values to add (missing values are skipped)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return
+
+    batch_mean = values.mean()
+    batch_m2 = float(np.sum((values - batch_mean) ** 2))
+    _merge_moments(statistics, len(values), batch_mean, batch_m2, values.min(), values.max())
+
+    sketch = statistics["sketch"]
+    log_gamma = math.log(_get_gamma(sketch))
+    magnitudes = np.abs(values)
+    is_zero = magnitudes < MIN_SKETCH_VALUE
+    sketch["zero"] += int(np.count_nonzero(is_zero))
+    keys = np.ceil(np.log(np.where(is_zero, 1.0, magnitudes)) / log_gamma).astype(np.int64)
+    _add_bin_counts(sketch["positive"], keys[~is_zero & (values > 0)])
+    _add_bin_counts(sketch["negative"], keys[~is_zero & (values < 0)])
+
+
+def _merge_moments(
+    statistics: dict, count: int, mean: float, m2: float, minimum: float, maximum: float
+) -> None:
+    """
+    Merge the count, mean, sum of squared differences, minimum and maximum of other values into running statistics.
+    """
+    total = statistics["count"] + count
+    delta = mean - statistics["mean"]
+    statistics["mean"] = float(statistics["mean"] + delta * count / total)
+    statistics["m2"] = float(statistics["m2"] + m2 + delta**2 * statistics["count"] * count / total)
+    statistics["count"] = int(total)
+    statistics["min"] = float(minimum if statistics["min"] is None else min(statistics["min"], minimum))
+    statistics["max"] = float(maximum if statistics["max"] is None else max(statistics["max"], maximum))
+
+
+def merge_running_statistics(statistics_list: List[dict]) -> dict:
+    """
+    This function merges running statistics (e.g., of several plates or channels) into new running statistics.
+
+    Args:
+        statistics_list (List[dict]): running statistics with sketches of the same relative accuracy
+
+    Raises:
+        ValueError: if the sketches do not have the same relative accuracy
+
+    Returns:
+        dict: running statistics of all the values
+    """
+    relative_accuracies = {statistics["sketch"]["relative_accuracy"] for statistics in statistics_list}
+    if len(relative_accuracies) > 1:
+        raise ValueError(f"Sketches with different relative accuracies can not be merged: {relative_accuracies}")
+
+    merged = create_running_statistics(*relative_accuracies)
+    for statistics in statistics_list:
+        if statistics["count"] == 0:
+            continue
+        _merge_moments(
+            merged,
+            statistics["count"],
+            statistics["mean"],
+            statistics["m2"],
+            statistics["min"],
+            statistics["max"],
+        )
+        merged["sketch"]["zero"] += statistics["sketch"]["zero"]
+        for side in ("positive", "negative"):
+            for key, count in statistics["sketch"][side].items():
+                merged["sketch"][side][key] = merged["sketch"][side].get(key, 0) + count
+
+    return merged
+
+
+def get_quantile(statistics: dict, quantile: float) -> Optional[float]:
+    """
+    This function estimates a quantile from the sketch of running statistics (within the relative accuracy of the
+    sketch, and clipped to the minimum and maximum).
+
+    Args:
+        statistics (dict): running statistics
+        quantile (float): quantile between 0 and 1
+
+    Returns:
+        Optional[float]: estimated quantile (None if there are no values)
+    """
+    if statistics["count"] == 0:
+        return None
+
+    sketch = statistics["sketch"]
+    gamma = _get_gamma(sketch)
+
+    # bins in increasing order of value (the most negative bin first)
+    bins = sorted(((int(key), count, -1) for key, count in sketch["negative"].items()), reverse=True)
+    bins.append((None, sketch["zero"], 0))
+    bins.extend(sorted((int(key), count, 1) for key, count in sketch["positive"].items()))
+
+    rank = quantile * (statistics["count"] - 1)
+    seen = 0
+    for key, count, sign in bins:
+        seen += count
+        if seen > rank:
+            value = 0.0 if sign == 0 else sign * 2 * gamma**key / (gamma + 1)
+            return float(min(max(value, statistics["min"]), statistics["max"]))
+
+    return statistics["max"]
+
+
+def get_standard_deviation(statistics: dict, ddof: int = 1) -> float:
+    """
+    Get the standard deviation from running statistics (sample standard deviation by default, as in pandas).
+    """
+    if statistics["count"] <= ddof:
+        return float("nan")
+    return math.sqrt(statistics["m2"] / (statistics["count"] - ddof))
+
+
+def describe_statistics(statistics: dict) -> pd.Series:
+    """
+    This function summarizes running statistics like `pd.Series.describe` (quartiles are estimated from the sketch).
+
+    Args:
+        statistics (dict): running statistics
+
+    Returns:
+        pd.Series: count, mean, standard deviation, minimum, quartiles and maximum
+    """
+    return pd.Series(
+        {
+            "count": statistics["count"],
+            "mean": statistics["mean"],
+            "std": get_standard_deviation(statistics),
+            "min": statistics["min"],
+            "25%": get_quantile(statistics, 0.25),
+            "50%": get_quantile(statistics, 0.5),
+            "75%": get_quantile(statistics, 0.75),
+            "max": statistics["max"],
+        },
+        dtype=np.float64,
+    )
+
+
+def get_thresholds(statistics: dict, threshold_z: float, ddof: int = 1) -> Tuple[float, float]:
+    """
+    This function gets the values that are a number of standard deviations below and above the mean.
+
+    Args:
+        statistics (dict): running statistics
+        threshold_z (float): number of standard deviations from the mean
+        ddof (int, optional): delta degrees of freedom of the standard deviation. Defaults to 1 (as in pandas, while
+            `scipy.stats.zscore` uses 0).
+
+    Returns:
+        Tuple[float, float]: thresholds below and above the mean
+    """
+    std_dev = get_standard_deviation(statistics, ddof=ddof)
+    return statistics["mean"] - threshold_z * std_dev, statistics["mean"] + threshold_z * std_dev
+
+
+def _get_signature(path: pathlib.Path) -> dict:
+    """
+    Get the size and modification time of a file, to find files that changed since the statistics were saved.
+    """
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def calculate_plate_statistics(
+    path_to_qc: pathlib.Path,
+    channels: List[str] = QC_CHANNELS,
+    metrics: List[str] = QC_METRICS,
+    relative_accuracy: float = 0.01,
+    chunksize: int = 100_000,
+) -> dict:
+    """
+    This function reads the `Image.csv` of a plate in chunks, with only the metric columns, and calculates the running
+    statistics per metric and channel.
+
+    Args:
+        path_to_qc (pathlib.Path): path to the `Image.csv` of the plate
+        channels (List[str], optional): image names. Defaults to QC_CHANNELS.
+        metrics (List[str], optional): image quality metrics. Defaults to QC_METRICS.
+        relative_accuracy (float, optional): relative error of the quantiles. Defaults to 0.01.
+        chunksize (int, optional): number of rows read at a time. Defaults to 100,000.
+
+    Returns:
+        dict: number of image sets and running statistics per metric and channel
+    """
+    statistics = {
+        metric: {channel: create_running_statistics(relative_accuracy) for channel in channels} for metric in metrics
+    }
+
+    num_image_sets = 0
+    columns = [f"ImageQuality_{metric}_{channel}" for metric in metrics for channel in channels]
+    for chunk_df in pd.read_csv(path_to_qc, usecols=columns, chunksize=chunksize):
+        num_image_sets += len(chunk_df)
+        for metric in metrics:
+            for channel in channels:
+                update_running_statistics(
+                    statistics[metric][channel], chunk_df[f"ImageQuality_{metric}_{channel}"].to_numpy()
+                )
+
+    return {"num_image_sets": num_image_sets, "statistics": statistics}
+
+
+def update_qc_statistics(
+    qc_dir: pathlib.Path,
+    path_to_statistics: pathlib.Path,
+    channels: List[str] = QC_CHANNELS,
+    metrics: List[str] = QC_METRICS,
+    relative_accuracy: float = 0.01,
+) -> dict:
+    """
+    This function updates the saved running statistics with the plates in the QC folder (one `Image.csv` per plate
+    folder). Only plates that are new or have a changed `Image.csv` are read, plates that were removed are dropped,
+    and the statistics are saved again.
+
+    Args:
+        qc_dir (pathlib.Path): path to the folder with a folder per plate
+        path_to_statistics (pathlib.Path): path to the JSON file with the running statistics
+        channels (List[str], optional): image names. Defaults to QC_CHANNELS.
+        metrics (List[str], optional): image quality metrics. Defaults to QC_METRICS.
+        relative_accuracy (float, optional): relative error of the quantiles. Defaults to 0.01.
+
+    Returns:
+        dict: running statistics per plate (with the signature of each `Image.csv`)
+    """
+    path_to_statistics = pathlib.Path(path_to_statistics)
+    settings = {"channels": list(channels), "metrics": list(metrics), "relative_accuracy": relative_accuracy}
+
+    saved = {"settings": settings, "plates": {}}
+    if path_to_statistics.exists():
+        with open(path_to_statistics) as statistics_file:
+            saved = json.load(statistics_file)
+        # statistics of other channels, metrics or accuracy can not be merged, so all plates are read again
+        if saved["settings"] != settings:
+            saved = {"settings": settings, "plates": {}}
+
+    plates = {}
+    for plate_dir in sorted(pathlib.Path(qc_dir).iterdir()):
+        path_to_qc = plate_dir / "Image.csv"
+        if not path_to_qc.is_file():
+            continue
+
+        signature = _get_signature(path_to_qc)
+        plate_statistics = saved["plates"].get(plate_dir.name)
+        if plate_statistics is None or plate_statistics["signature"] != signature:
+            print(f"Reading the QC metrics of {plate_dir.name}")
+            plate_statistics = calculate_plate_statistics(
+                path_to_qc, channels=channels, metrics=metrics, relative_accuracy=relative_accuracy
+            )
+            plate_statistics["signature"] = signature
+        plates[plate_dir.name] = plate_statistics
+
+    statistics = {"settings": settings, "plates": plates}
+
+    path_to_statistics.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path_to_statistics.with_name(f"{path_to_statistics.name}.tmp")
+    with open(temp_path, "w") as statistics_file:
+        json.dump(statistics, statistics_file)
+    os.replace(temp_path, path_to_statistics)
+
+    return statistics
+
+
+def combine_statistics(
+    statistics: dict,
+    metric: str,
+    plates: Optional[List[str]] = None,
+    channels: Optional[List[str]] = None,
+) -> dict:
+    """
+    This function merges the running statistics of a metric across plates and channels.
+
+    Args:
+        statistics (dict): running statistics per plate from `update_qc_statistics`
+        metric (str): image quality metric (e.g., "PowerLogLogSlope")
+        plates (Optional[List[str]], optional): plates to merge. Defaults to None (all plates).
+        channels (Optional[List[str]], optional): channels to merge. Defaults to None (all channels).
+
+    Returns:
+        dict: running statistics of the metric
+    """
+    plates = plates or list(statistics["plates"])
+    channels = channels or statistics["settings"]["channels"]
+
+    return merge_running_statistics(
+        [statistics["plates"][plate]["statistics"][metric][channel] for plate in plates for channel in channels]
+    )
+
+
+def count_image_sets(statistics: dict) -> int:
+    """
+    Get the number of image sets across plates.
+    """
+    return sum(plate_statistics["num_image_sets"] for plate_statistics in statistics["plates"].values())
+
+
+def find_outliers(
+    qc_dir: pathlib.Path,
+    statistics: dict,
+    metric: str,
+    lower_threshold: Optional[float],
+    upper_threshold: Optional[float],
+    chunksize: int = 100_000,
+) -> pd.DataFrame:
+    """
+    This function reads the `Image.csv` of each plate in chunks and keeps the images with a metric below the lower
+    threshold or above the upper threshold, with one row per image (plate, well, site and channel).
+
+    Args:
+        qc_dir (pathlib.Path): path to the folder with a folder per plate
+        statistics (dict): running statistics per plate from `update_qc_statistics`
+        metric (str): image quality metric (e.g., "PowerLogLogSlope")
+        lower_threshold (Optional[float]): values below are outliers (None for no lower threshold)
+        upper_threshold (Optional[float]): values above are outliers (None for no upper threshold)
+        chunksize (int, optional): number of rows read at a time. Defaults to 100,000.
+
+    Returns:
+        pd.DataFrame: metadata columns, the metric (`ImageQuality_<metric>`) and the channel of each outlier
+    """
+    channels = statistics["settings"]["channels"]
+    metric_columns = [f"ImageQuality_{metric}_{channel}" for channel in channels]
+
+    outlier_dfs = []
+    # metadata columns from the CSV headers, to return the same columns when there are no outliers
+    metadata_columns = {}
+    for plate in statistics["plates"]:
+        path_to_qc = pathlib.Path(qc_dir) / plate / "Image.csv"
+        for chunk_df in pd.read_csv(
+            path_to_qc,
+            usecols=lambda column: column.startswith("Metadata_") or column in metric_columns,
+            chunksize=chunksize,
+        ):
+            metadata_columns.update(dict.fromkeys(chunk_df.filter(like="Metadata_").columns))
+            for channel, metric_column in zip(channels, metric_columns):
+                values = chunk_df[metric_column]
+                is_outlier = pd.Series(False, index=chunk_df.index)
+                if lower_threshold is not None:
+                    is_outlier |= values < lower_threshold
+                if upper_threshold is not None:
+                    is_outlier |= values > upper_threshold
+                if not is_outlier.any():
+                    continue
+
+                outlier_df = chunk_df.loc[is_outlier].filter(like="Metadata_").copy()
+                outlier_df[f"ImageQuality_{metric}"] = values[is_outlier]
+                outlier_df["Channel"] = channel
+                outlier_df["Metadata_Plate"] = plate
+                outlier_dfs.append(outlier_df)
+
+    if not outlier_dfs:
+        metadata_columns.setdefault("Metadata_Plate")
+        return pd.DataFrame(columns=[*metadata_columns, f"ImageQuality_{metric}", "Channel"])
+
+    return pd.concat(outlier_dfs, ignore_index=True)
@@ -0,0 +1,217 @@
+"""
+This collection of functions keeps a manifest (JSON file) of which CellProfiler processes (plates or shards) have
+finished, so a parallel run that stops partway through can be restarted and only redo incomplete or failed work.
+Each finished process is recorded with the output files it is expected to write (e.g., the SQLite file from
+ExportToDatabase), and it is only skipped while those files exist and are not empty.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+from datetime import datetime
+from typing import List, Optional
+
+
+def _update_hash_with_file(hasher: "hashlib._Hash", path: pathlib.Path) -> None:
+    """
+    Add the contents of a file to a hash in chunks so large files are not loaded in memory.
+
+    Args:
+        hasher (hashlib._Hash): hash object to update
+        path (pathlib.Path): path to the file
+    """
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            hasher.update(chunk)
+
+
+def compute_job_key(
+    path_to_pipeline: pathlib.Path,
+    path_to_output: pathlib.Path,
+    path_to_loaddata: Optional[pathlib.Path] = None,
+    path_to_images: Optional[pathlib.Path] = None,
+) -> str:
+    """
+    This function computes the key of a CellProfiler process from a hash of everything that determines its output:
+    the contents of the pipeline file, the LoadData rows (or the image file names when using a path to images)
+    and the output path. Any change to these gives a new key, so the process is run again.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler pipeline
+        path_to_output (pathlib.Path): path to the output folder for the process
+        path_to_loaddata (Optional[pathlib.Path], optional): path to the LoadData CSV. Defaults to None.
+        path_to_images (Optional[pathlib.Path], optional): path to the images folder. Defaults to None.
+
+    Returns:
+        str: SHA-256 hex digest identifying the process
+    """
+    hasher = hashlib.sha256()
+
+    _update_hash_with_file(hasher, pathlib.Path(path_to_pipeline))
+
+    if path_to_loaddata is not None:
+        _update_hash_with_file(hasher, pathlib.Path(path_to_loaddata))
+    elif path_to_images is not None:
+        for image_path in sorted(pathlib.Path(path_to_images).iterdir()):
+            hasher.update(image_path.name.encode("utf-8"))
+
+    hasher.update(str(pathlib.Path(path_to_output).resolve()).encode("utf-8"))
+
+    return hasher.hexdigest()
+
+
+def _get_output_subfolder(location: str) -> Optional[str]:
+    """
+    Get the subfolder of the default output folder from an "Output file location" setting (None for other folders).
+    """
+    folder, _, subfolder = location.partition("|")
+    return subfolder if folder == "Default Output Folder" else None
+
+
+def get_pipeline_outputs(path_to_pipeline: pathlib.Path) -> List[str]:
+    """
+    This function finds the data files that the export modules of a pipeline write to the output folder: the SQLite
+    file from ExportToDatabase and the `Image.csv` from ExportToSpreadsheet (when all measurement types are exported
+    with the object names as file names).
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler pipeline
+
+    Returns:
+        List[str]: paths of the files relative to the output folder (empty if the pipeline does not export data)
+    """
+    outputs = []
+    for module in pathlib.Path(path_to_pipeline).read_text().strip("\n").split("\n\n"):
+        header, *lines = module.splitlines()
+        if "enabled:False" in header:
+            continue
+        module_name = header.split(":[", 1)[0]
+        settings = dict(line.strip().split(":", 1) for line in lines if ":" in line)
+        subfolder = _get_output_subfolder(settings.get("Output file location", ""))
+        if subfolder is None:
+            continue
+
+        if module_name == "ExportToDatabase" and settings.get("Database type") == "SQLite":
+            outputs.append(os.path.join(subfolder, settings["Name the SQLite database file"]))
+        elif (
+            module_name == "ExportToSpreadsheet"
+            and settings.get("Export all measurement types?") == "Yes"
+            and settings.get("Use the object name for the file name?") == "Yes"
+        ):
+            prefix = settings.get("Filename prefix", "") if settings.get("Add a prefix to file names?") == "Yes" else ""
+            outputs.append(os.path.join(subfolder, f"{prefix}Image.csv"))
+
+    return outputs
+
+
+def list_output_files(path_to_output: pathlib.Path) -> List[str]:
+    """
+    This function lists the files a process wrote to its output folder (not in subfolders), to use as its expected
+    outputs when the pipeline does not export data (e.g., illumination functions saved with SaveImages).
+
+    Args:
+        path_to_output (pathlib.Path): path to the output folder for the process
+
+    Returns:
+        List[str]: names of the files in the output folder
+    """
+    path_to_output = pathlib.Path(path_to_output)
+    if not path_to_output.is_dir():
+        return []
+
+    return sorted(path.name for path in path_to_output.iterdir() if path.is_file())
+
+
+def load_manifest(manifest_path: pathlib.Path) -> dict:
+    """
+    This function loads the manifest for a run, or an empty manifest if the run has not been started before.
+
+    Args:
+        manifest_path (pathlib.Path): path to the manifest JSON file
+
+    Returns:
+        dict: manifest with one entry per job key
+    """
+    if not manifest_path.exists():
+        return {}
+
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest: dict, manifest_path: pathlib.Path) -> None:
+    """
+    This function saves the manifest by writing to a temporary file and renaming it, so the manifest on disk is
+    never left half written if the run is stopped.
+
+    Args:
+        manifest (dict): manifest with one entry per job key
+        manifest_path (pathlib.Path): path to the manifest JSON file
+    """
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = manifest_path.with_name(f"{manifest_path.name}.tmp")
+
+    with open(temp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+    os.replace(temp_path, manifest_path)
+
+
+def record_job(
+    manifest: dict, job_key: str, job_name: str, returncode: int, outputs: Optional[List[str]] = None
+) -> None:
+    """
+    This function records the result of a finished process in the manifest.
+
+    Args:
+        manifest (dict): manifest with one entry per job key
+        job_key (str): key of the process from `compute_job_key`
+        job_name (str): name of the plate or shard
+        returncode (int): return code of the CellProfiler process
+        outputs (Optional[List[str]], optional): files the process is expected to write, relative to its output
+            folder (see `get_pipeline_outputs` and `list_output_files`). Defaults to None.
+    """
+    manifest[job_key] = {
+        "job_name": job_name,
+        "status": "completed" if returncode == 0 else "failed",
+        "returncode": returncode,
+        "outputs": list(outputs or []),
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def is_job_completed(
+    manifest: dict,
+    job_key: str,
+    path_to_output: pathlib.Path,
+    expected_outputs: Optional[List[str]] = None,
+) -> bool:
+    """
+    This function checks if a process already finished successfully with the same inputs and the output files
+    recorded for it (or else the expected outputs) still exist and are not empty. A process without any known output
+    files is never skipped, since other files left in its output folder (e.g., outline images) do not show that it
+    finished.
+
+    Args:
+        manifest (dict): manifest with one entry per job key
+        job_key (str): key of the process from `compute_job_key`
+        path_to_output (pathlib.Path): path to the output folder for the process
+        expected_outputs (Optional[List[str]], optional): files the process is expected to write, used for entries
+            recorded without outputs. Defaults to None.
+
+    Returns:
+        bool: True if the process can be skipped
+    """
+    entry = manifest.get(job_key)
+    if entry is None or entry["status"] != "completed":
+        return False
+
+    outputs = entry.get("outputs") or expected_outputs
+    if not outputs:
+        return False
+
+    path_to_output = pathlib.Path(path_to_output)
+    return all(
+        (path_to_output / output).is_file() and (path_to_output / output).stat().st_size > 0 for output in outputs
+    )
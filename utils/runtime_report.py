@@ -0,0 +1,159 @@
+"""
+This collection of functions creates a report of how much time each CellProfiler module took, using the
+`ExecutionTime_*` columns in the Per_Image table of every plate's SQLite file, summarized by module, plate and
+cell line.
+"""
+
+import pathlib
+import re
+import sqlite3
+from typing import Dict, List
+
+import pandas as pd
+
+from cost_model import load_platemap_metadata
+
+# execution time columns are named by module number and module name (e.g., Image_ExecutionTime_05IdentifyPrimaryObjects)
+EXECUTION_TIME_PATTERN = re.compile(r"^Image_ExecutionTime_(\d+)(\w+)$")
+
+
+def load_module_execution_times(sqlite_path: pathlib.Path) -> pd.DataFrame:
+    """
+    This function loads the execution time of every module for every image set in a CellProfiler SQLite file,
+    reading only the metadata and `ExecutionTime_*` columns of the Per_Image table.
+
+    Args:
+        sqlite_path (pathlib.Path): path to the SQLite file for a plate
+
+    Returns:
+        pd.DataFrame: one row per image set and module with the execution time in seconds
+    """
+    with sqlite3.connect(sqlite_path) as connection:
+        columns = [row[1] for row in connection.execute('PRAGMA table_info("Per_Image")')]
+        time_columns = [col for col in columns if EXECUTION_TIME_PATTERN.match(col)]
+
+        query = "SELECT {} FROM Per_Image".format(
+            ", ".join(
+                f'"{col}"'
+                for col in ["ImageNumber", "Image_Metadata_Plate", "Image_Metadata_Well"] + time_columns
+            )
+        )
+        times_df = pd.read_sql_query(query, connection)
+
+    times_df = times_df.melt(
+        id_vars=["ImageNumber", "Image_Metadata_Plate", "Image_Metadata_Well"],
+        value_vars=time_columns,
+        var_name="Module",
+        value_name="ExecutionTime",
+    )
+
+    # image numbers are only unique within a plate
+    times_df["ImageSet"] = times_df["Image_Metadata_Plate"] + "_" + times_df["ImageNumber"].astype(str)
+
+    # split the column name into the module number and the module name
+    module_parts = times_df["Module"].str.extract(EXECUTION_TIME_PATTERN)
+    times_df["ModuleNumber"] = module_parts[0].astype(int)
+    times_df["Module"] = module_parts[1]
+
+    return times_df.rename(
+        columns={"Image_Metadata_Plate": "Metadata_Plate", "Image_Metadata_Well": "Metadata_Well"}
+    )
+
+
+def _summarize(times_df: pd.DataFrame, group_columns: List[str]) -> pd.DataFrame:
+    """
+    Sum the execution times by the given columns and rank the groups from most to least time.
+
+    Args:
+        times_df (pd.DataFrame): execution times per image set and module
+        group_columns (List[str]): columns to group by
+
+    Returns:
+        pd.DataFrame: total and mean time per image set for each group, with the percent of the total time
+    """
+    summary_df = (
+        times_df.groupby(group_columns)
+        .agg(
+            total_seconds=("ExecutionTime", "sum"),
+            image_sets=("ImageSet", "nunique"),
+        )
+        .reset_index()
+        .sort_values("total_seconds", ascending=False, ignore_index=True)
+    )
+    summary_df["mean_seconds_per_image_set"] = summary_df["total_seconds"] / summary_df["image_sets"]
+    summary_df["percent_of_total"] = 100 * summary_df["total_seconds"] / times_df["ExecutionTime"].sum()
+
+    return summary_df
+
+
+def create_runtime_report(
+    sqlite_dir: pathlib.Path,
+    platemap_dir: pathlib.Path,
+    output_dir: pathlib.Path,
+    db_name: str = "alsf_morphology_features.sqlite",
+) -> Dict[str, pd.DataFrame]:
+    """
+    This function creates the runtime report for all plates in the SQLite output folder. It saves:
+
+    - runtime_by_module.parquet: total time per module (across all plates), per plate and module, and per cell line
+      and module, with a `level` column to select one summary
+    - runtime_report.txt: the same summaries as ranked text tables
+
+    Args:
+        sqlite_dir (pathlib.Path): path to the SQLite outputs folder with one folder per plate
+        platemap_dir (pathlib.Path): path to the platemaps folder (to add cell lines)
+        output_dir (pathlib.Path): path to the folder for the report files
+        db_name (str, optional): name of the SQLite file in each plate folder. Defaults to "alsf_morphology_features.sqlite".
+
+    Raises:
+        FileNotFoundError: if there are no SQLite files in the SQLite outputs folder
+
+    Returns:
+        Dict[str, pd.DataFrame]: summary per level ("module", "plate", "cell_line")
+    """
+    sqlite_paths = sorted(sqlite_dir.glob(f"*/{db_name}"))
+    if not sqlite_paths:
+        raise FileNotFoundError(f"No SQLite files named '{db_name}' were found in '{sqlite_dir}'")
+
+    times_df = pd.concat(
+        [load_module_execution_times(sqlite_path) for sqlite_path in sqlite_paths], ignore_index=True
+    ).merge(
+        load_platemap_metadata(platemap_dir)[["Metadata_Plate", "Metadata_Well", "Metadata_cell_line"]],
+        on=["Metadata_Plate", "Metadata_Well"],
+        how="left",
+    )
+
+    summaries = {
+        "module": _summarize(times_df, ["ModuleNumber", "Module"]),
+        "plate": _summarize(times_df, ["Metadata_Plate", "ModuleNumber", "Module"]),
+        "cell_line": _summarize(times_df, ["Metadata_cell_line", "ModuleNumber", "Module"]),
+    }
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    pd.concat(
+        [summary_df.assign(level=level) for level, summary_df in summaries.items()],
+        ignore_index=True,
+    ).to_parquet(output_dir / "runtime_by_module.parquet", index=False)
+
+    total_hours = times_df["ExecutionTime"].sum() / 3600
+    with open(output_dir / "runtime_report.txt", "w") as report_file:
+        report_file.write(
+            f"CellProfiler runtime report for {len(sqlite_paths)} plates "
+            f"({total_hours:.2f} hours of module time in total)\n\n"
+        )
+        report_file.write("Modules ranked by total time across all plates\n")
+        report_file.write(summaries["module"].to_string(index=False, float_format="{:.2f}".format))
+        report_file.write("\n\nTotal time per plate\n")
+        report_file.write(
+            _summarize(times_df, ["Metadata_Plate"]).to_string(index=False, float_format="{:.2f}".format)
+        )
+        report_file.write("\n\nTotal time per cell line\n")
+        report_file.write(
+            _summarize(times_df, ["Metadata_cell_line"]).to_string(index=False, float_format="{:.2f}".format)
+        )
+        report_file.write("\n")
+
+    print(f"The runtime report has been saved to {output_dir}!")
+
+    return summaries
@@ -0,0 +1,245 @@
+"""
+This collection of functions merges the SQLite outputs from CellProfiler (ExportToDatabase with one table per
+object type) that were created per shard of a plate back into one SQLite file per plate.
+"""
+
+import os
+import pathlib
+import sqlite3
+from typing import Dict, List
+
+import run_manifest
+
+# SQLite only allows a small number of attached databases at once (default limit is 10)
+MAX_ATTACHED_SHARDS = 8
+
+# tables that describe the whole run and are the same in every shard, so they are only copied once
+RUN_LEVEL_TABLES = ["Experiment", "Experiment_Properties", "Per_Experiment", "Per_RelationshipTypes"]
+
+# columns that hold an image number in each table and need to be offset when merging
+IMAGE_NUMBER_COLUMNS = {"Per_Relationships": ["image_number1", "image_number2"]}
+
+
+def _quote(identifier: str) -> str:
+    """
+    Quote a table or column name for use in an SQL statement.
+
+    Args:
+        identifier (str): table or column name
+
+    Returns:
+        str: quoted identifier
+    """
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def _table_columns(connection: sqlite3.Connection, schema: str, table: str) -> List[str]:
+    """
+    Get the column names of a table in order.
+
+    Args:
+        connection (sqlite3.Connection): connection to the database
+        schema (str): name of the database schema (e.g., main or the alias of an attached database)
+        table (str): name of the table
+
+    Returns:
+        List[str]: column names
+    """
+    return [
+        row[1]
+        for row in connection.execute(f"PRAGMA {schema}.table_info({_quote(table)})")
+    ]
+
+
+def merge_shard_databases(
+    shard_db_paths: List[pathlib.Path], output_path: pathlib.Path
+) -> pathlib.Path:
+    """
+    This function merges SQLite files from CellProfiler runs on shards of the same plate into one SQLite file.
+
+    The `ImageNumber` of every shard is offset by the number of image sets in the shards before it so image sets
+    never collide. Object numbers are numbered per image set in CellProfiler, so the (`ImageNumber`, object number)
+    keys and parent/child links stay unique once the `ImageNumber` is offset. The tables are filled with
+    `INSERT ... SELECT` from attached shards (in batches of `MAX_ATTACHED_SHARDS`, one transaction per batch),
+    indexes and views are created at the end, and the file is only moved to `output_path` once the merge completes.
+
+    Args:
+        shard_db_paths (List[pathlib.Path]): paths to the shard SQLite files in the order the image sets should be numbered
+        output_path (pathlib.Path): path to the merged SQLite file
+
+    Raises:
+        FileNotFoundError: if any of the shard SQLite files do not exist
+        ValueError: if no shard SQLite files are given
+
+    Returns:
+        pathlib.Path: path to the merged SQLite file
+    """
+    if not shard_db_paths:
+        raise ValueError("No shard SQLite files were provided to merge.")
+
+    for shard_db_path in shard_db_paths:
+        if not pathlib.Path(shard_db_path).is_file():
+            raise FileNotFoundError(f"The file '{shard_db_path}' does not exist")
+
+    # write to a temporary file so a failed merge never leaves a partial database behind
+    temp_path = output_path.with_name(f"{output_path.name}.tmp")
+    if temp_path.exists():
+        temp_path.unlink()
+
+    # autocommit mode so transactions and attaching databases are controlled explicitly
+    connection = sqlite3.connect(temp_path, isolation_level=None)
+    try:
+        # the temporary file is discarded on failure, so journaling and syncing are not needed
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+
+        # copy the table definitions from the first shard, while indexes and views are created after the inserts
+        connection.execute("ATTACH DATABASE ? AS shard0", (str(shard_db_paths[0]),))
+        schema_rows = connection.execute(
+            "SELECT type, name, tbl_name, sql FROM shard0.sqlite_master "
+            "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()
+        connection.execute("DETACH DATABASE shard0")
+
+        tables = [name for obj_type, name, _, _ in schema_rows if obj_type == "table"]
+        for obj_type, _, _, sql in schema_rows:
+            if obj_type == "table":
+                connection.execute(sql)
+
+        # find the columns with image numbers in each table
+        table_columns = {table: _table_columns(connection, "main", table) for table in tables}
+        image_columns = {
+            table: IMAGE_NUMBER_COLUMNS.get(
+                table, ["ImageNumber"] if "ImageNumber" in columns else []
+            )
+            for table, columns in table_columns.items()
+        }
+
+        for batch_start in range(0, len(shard_db_paths), MAX_ATTACHED_SHARDS):
+            batch = shard_db_paths[batch_start : batch_start + MAX_ATTACHED_SHARDS]
+            aliases = [f"shard{index}" for index in range(len(batch))]
+
+            for alias, shard_db_path in zip(aliases, batch):
+                connection.execute(f"ATTACH DATABASE ? AS {alias}", (str(shard_db_path),))
+
+            connection.execute("BEGIN")
+            for shard_index, alias in enumerate(aliases, start=batch_start):
+                # offset by the largest image number merged so far
+                offset = connection.execute(
+                    'SELECT COALESCE(MAX("ImageNumber"), 0) FROM main."Per_Image"'
+                ).fetchone()[0]
+
+                for table in tables:
+                    is_run_level = table in RUN_LEVEL_TABLES or not image_columns[table]
+                    if is_run_level and shard_index > 0:
+                        continue
+
+                    shard_columns = set(_table_columns(connection, alias, table))
+                    columns = [col for col in table_columns[table] if col in shard_columns]
+                    select_columns = [
+                        f"{_quote(col)} + {offset}" if col in image_columns[table] else _quote(col)
+                        for col in columns
+                    ]
+                    connection.execute(
+                        f"INSERT INTO main.{_quote(table)} ({', '.join(map(_quote, columns))}) "
+                        f"SELECT {', '.join(select_columns)} FROM {alias}.{_quote(table)}"
+                    )
+            connection.execute("COMMIT")
+
+            for alias in aliases:
+                connection.execute(f"DETACH DATABASE {alias}")
+
+        # build the indexes and views once all rows are inserted
+        connection.execute("BEGIN")
+        for obj_type, _, _, sql in schema_rows:
+            if obj_type in ("index", "view"):
+                connection.execute(sql)
+        connection.execute("COMMIT")
+    except Exception:
+        connection.close()
+        temp_path.unlink()
+        raise
+
+    connection.close()
+    os.replace(temp_path, output_path)
+
+    return output_path
+
+
+def _get_latest_job_entries(manifest: dict) -> Dict[str, dict]:
+    """
+    Get the most recent manifest entry of each process by name.
+    """
+    entries = {}
+    for entry in sorted(manifest.values(), key=lambda entry: entry["finished_at"]):
+        entries[entry["job_name"]] = entry
+
+    return entries
+
+
+def merge_plate_shards(
+    plate_output_dir: pathlib.Path,
+    manifest_path: pathlib.Path,
+    db_name: str = "alsf_morphology_features.sqlite",
+    remove_shard_databases: bool = False,
+) -> pathlib.Path:
+    """
+    This function merges the SQLite files from all shards of a plate (as written by `cp_parallel` when sharding,
+    e.g., sqlite_outputs/<plate>/<plate>_shard0000/<db_name>) into one SQLite file in the plate folder
+    (e.g., sqlite_outputs/<plate>/<db_name>), which is the layout used when processing one plate per process.
+    Only shards with a LoadData CSV in the plate's loaddata_shards folder are merged, so outputs left from an
+    earlier split of the plate are ignored. The plate is only merged once every one of these shards has completed
+    according to the run manifest (see `run_manifest`) and has its SQLite file, so a partial run never replaces
+    the plate SQLite file.
+
+    Args:
+        plate_output_dir (pathlib.Path): plate output folder with the shard output folders
+        manifest_path (pathlib.Path): path to the manifest of the run (e.g., logs/<run_name>_manifest.json)
+        db_name (str, optional): name of the SQLite file from ExportToDatabase. Defaults to "alsf_morphology_features.sqlite".
+        remove_shard_databases (bool, optional): remove the shard SQLite files after merging so that tools that search
+            the plate folder recursively (e.g., CytoTable) only find the merged file. The shards can then not be
+            merged again. Defaults to False.
+
+    Raises:
+        FileNotFoundError: if there are no shard LoadData CSVs in the plate folder or a shard SQLite file is missing
+        RuntimeError: if a shard has not completed or its CellProfiler process failed
+
+    Returns:
+        pathlib.Path: path to the merged SQLite file
+    """
+    # only merge the shards from the latest split of the plate (the ones with a LoadData CSV in loaddata_shards)
+    shard_names = sorted(path.stem for path in (plate_output_dir / "loaddata_shards").glob("*_shard*.csv"))
+    if not shard_names:
+        raise FileNotFoundError(f"No shard LoadData CSVs were found in '{plate_output_dir / 'loaddata_shards'}'")
+
+    # check that every shard finished successfully before replacing the plate SQLite file
+    job_entries = _get_latest_job_entries(run_manifest.load_manifest(manifest_path))
+    failed_shards = [
+        f"{name} (return code {job_entries[name]['returncode']})"
+        for name in shard_names
+        if name in job_entries and job_entries[name]["status"] != "completed"
+    ]
+    if failed_shards:
+        raise RuntimeError(f"The CellProfiler processes of these shards failed: {', '.join(failed_shards)}")
+
+    unfinished_shards = [name for name in shard_names if name not in job_entries]
+    if unfinished_shards:
+        raise RuntimeError(
+            f"These shards have not completed according to '{manifest_path}': {', '.join(unfinished_shards)}"
+        )
+
+    shard_db_paths = [plate_output_dir / name / db_name for name in shard_names]
+    missing_db_paths = [str(path) for path in shard_db_paths if not path.is_file()]
+    if missing_db_paths:
+        raise FileNotFoundError(f"These shard SQLite files are missing: {', '.join(missing_db_paths)}")
+
+    output_path = merge_shard_databases(
+        shard_db_paths=shard_db_paths, output_path=plate_output_dir / db_name
+    )
+    print(f"{len(shard_db_paths)} shards have been merged into {output_path}!")
+
+    if remove_shard_databases:
+        for shard_db_path in shard_db_paths:
+            shard_db_path.unlink()
+
+    return output_path
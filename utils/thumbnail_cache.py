@@ -0,0 +1,369 @@
+"""
+This collection of functions builds a cache of downsampled images (thumbnails) at a few resolutions for every plate,
+well, site and channel, and renders contact sheets of QC outliers from it. The cache is built in one pass over the
+LoadData rows (each TIFF is read once) and is saved as one `.npy` array per resolution and plate, which is opened as a
+memory-mapped array so only the thumbnails that are shown are read from disk.
+"""
+
+import json
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import loaddata_store
+import zarr_store
+
+# metadata kept in the index of each plate to find the thumbnails of an image set
+INDEX_COLUMNS = [
+    "Metadata_Plate",
+    "Metadata_Well",
+    "Metadata_Site",
+    "Metadata_Row",
+    "Metadata_Col",
+    "Metadata_Reimaged",
+]
+
+# image sets written to the cache by one process at a time
+CHUNK_SIZE = 32
+
+
+def downsample(image: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Downsample an image by taking the mean of each factor x factor block (the edges that do not fill a block are
+    cropped).
+    """
+    height, width = (image.shape[0] // factor) * factor, (image.shape[1] // factor) * factor
+    blocks = image[:height, :width].reshape(height // factor, factor, width // factor, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+def get_level_shapes(shape: Tuple[int, int], base_factor: int, num_levels: int) -> List[Tuple[int, int]]:
+    """
+    Get the thumbnail shape of each resolution, where the first level is downsampled by the base factor and each
+    level after is half the size of the one before.
+    """
+    return [
+        (shape[0] // (base_factor * 2**level), shape[1] // (base_factor * 2**level)) for level in range(num_levels)
+    ]
+
+
+def _level_path(plate_dir: pathlib.Path, level: int) -> pathlib.Path:
+    """
+    Get the path to the thumbnails of one resolution of a plate.
+    """
+    return plate_dir / f"level_{level}.npy"
+
+
+def write_thumbnails(
+    plate_dir: pathlib.Path, rows: List[int], image_paths: List[List[str]], base_factor: int, num_levels: int
+) -> int:
+    """
+    This function reads the images of some image sets and writes their thumbnails at every resolution into the
+    memory-mapped arrays of the plate.
+
+    Args:
+        plate_dir (pathlib.Path): path to the thumbnail folder of the plate
+        rows (List[int]): positions of the image sets in the LoadData
+        image_paths (List[List[str]]): path to the image of each channel per image set
+        base_factor (int): downsampling factor of the first level
+        num_levels (int): number of resolutions
+
+    Returns:
+        int: number of image sets written
+    """
+    levels = [np.load(_level_path(plate_dir, level), mmap_mode="r+") for level in range(num_levels)]
+
+    for row, channel_paths in zip(rows, image_paths):
+        for channel_index, image_path in enumerate(channel_paths):
+            thumbnail = downsample(zarr_store.read_image(image_path).astype(np.float32), base_factor)
+            for level, level_array in enumerate(levels):
+                if level > 0:
+                    thumbnail = downsample(thumbnail, 2)
+                height, width = level_array.shape[2:]
+                level_array[row, channel_index] = np.rint(thumbnail[:height, :width])
+
+    for level_array in levels:
+        level_array.flush()
+
+    return len(rows)
+
+
+def build_thumbnail_cache(
+    plate_info_dictionary: dict,
+    thumbnail_dir: pathlib.Path,
+    base_factor: int = 4,
+    num_levels: int = 3,
+    max_workers: Optional[int] = None,
+) -> Dict[str, pathlib.Path]:
+    """
+    This function builds the thumbnail cache of every plate, reading each image once in a process pool. For each plate,
+    the folder thumbnail_dir/<plate> has:
+
+    - level_<n>.npy: thumbnails (uint16) of one resolution with the shape (image sets, channels, height, width)
+    - index.csv: the metadata of the image set in each position
+    - cache_info.json: the channels, downsampling factor of each level and the LoadData the cache was built from
+
+    Plates with a cache that is newer than their LoadData are skipped.
+
+    Args:
+        plate_info_dictionary (dict): dictionary with the LoadData ("path_to_loaddata") per plate
+        thumbnail_dir (pathlib.Path): path to the folder for the thumbnail cache
+        base_factor (int, optional): downsampling factor of the first (largest) level. Defaults to 4.
+        num_levels (int, optional): number of resolutions, each half the size of the one before. Defaults to 3.
+        max_workers (Optional[int], optional): number of processes. Defaults to None (the number of CPUs).
+
+    Returns:
+        Dict[str, pathlib.Path]: path to the thumbnail folder per plate
+    """
+    plate_dirs = {}
+    plate_image_paths = {}
+    cache_infos = {}
+    tasks = []
+
+    for plate_name, info in plate_info_dictionary.items():
+        path_to_loaddata = pathlib.Path(info["path_to_loaddata"])
+        plate_dir = pathlib.Path(thumbnail_dir) / plate_name
+        plate_dirs[plate_name] = plate_dir
+
+        info_path = plate_dir / "cache_info.json"
+        if info_path.exists() and info_path.stat().st_mtime > path_to_loaddata.stat().st_mtime:
+            print(f"The thumbnail cache for {plate_name} is up to date, skipping.")
+            continue
+
+        loaddata_df = loaddata_store.read_loaddata(path_to_loaddata)
+        channels = [col.replace("FileName_", "") for col in loaddata_df.columns if col.startswith("FileName_Orig")]
+        image_paths = pd.DataFrame(
+            {
+                channel: loaddata_df[f"PathName_{channel}"].astype(str)
+                + os.sep
+                + loaddata_df[f"FileName_{channel}"].astype(str)
+                for channel in channels
+            }
+        ).values.tolist()
+
+        # the thumbnail shapes are set from the header of the first image
+        level_shapes = get_level_shapes(zarr_store.get_image_shape(image_paths[0][0]), base_factor, num_levels)
+
+        plate_dir.mkdir(parents=True, exist_ok=True)
+        info_path.unlink(missing_ok=True)
+        for level, level_shape in enumerate(level_shapes):
+            np.lib.format.open_memmap(
+                _level_path(plate_dir, level),
+                mode="w+",
+                dtype=np.uint16,
+                shape=(len(loaddata_df), len(channels)) + level_shape,
+            ).flush()
+
+        loaddata_df[[col for col in INDEX_COLUMNS if col in loaddata_df.columns]].to_csv(
+            plate_dir / "index.csv", index_label="Thumbnail_Index"
+        )
+
+        tasks.extend(
+            (plate_name, list(range(start, min(start + CHUNK_SIZE, len(image_paths)))))
+            for start in range(0, len(image_paths), CHUNK_SIZE)
+        )
+        plate_image_paths[plate_name] = image_paths
+        cache_infos[plate_name] = {
+            "channels": channels,
+            "factors": [base_factor * 2**level for level in range(num_levels)],
+            "path_to_loaddata": str(path_to_loaddata),
+        }
+
+    if tasks:
+        print(f"Building thumbnails for {sum(len(rows) for _, rows in tasks)} image sets")
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    write_thumbnails,
+                    plate_dirs[plate_name],
+                    rows,
+                    [plate_image_paths[plate_name][row] for row in rows],
+                    base_factor,
+                    num_levels,
+                )
+                for plate_name, rows in tasks
+            ]
+            for future in futures:
+                future.result()
+
+    # the cache info is written last, so an interrupted build is not seen as complete
+    for plate_name, cache_info in cache_infos.items():
+        with open(plate_dirs[plate_name] / "cache_info.json", "w") as info_file:
+            json.dump(cache_info, info_file, indent=4)
+        print(f"The thumbnail cache for {plate_name} has been saved to {plate_dirs[plate_name]}!")
+
+    return plate_dirs
+
+
+def load_thumbnail_cache(plate_dir: pathlib.Path, level: int = 1) -> Tuple[np.ndarray, pd.DataFrame, dict]:
+    """
+    This function opens the thumbnails of one resolution of a plate as a memory-mapped array.
+
+    Args:
+        plate_dir (pathlib.Path): path to the thumbnail folder of the plate
+        level (int, optional): resolution to open (0 is the largest). Defaults to 1.
+
+    Raises:
+        FileNotFoundError: if the cache of the plate was not built (or the build did not finish)
+
+    Returns:
+        Tuple[np.ndarray, pd.DataFrame, dict]: thumbnails (image sets, channels, height, width), the index of the
+            image sets and the cache info
+    """
+    info_path = pathlib.Path(plate_dir) / "cache_info.json"
+    if not info_path.exists():
+        raise FileNotFoundError(f"There is no complete thumbnail cache in '{plate_dir}'")
+
+    with open(info_path) as info_file:
+        cache_info = json.load(info_file)
+
+    thumbnails = np.load(_level_path(pathlib.Path(plate_dir), level), mmap_mode="r")
+    index_df = pd.read_csv(pathlib.Path(plate_dir) / "index.csv")
+
+    return thumbnails, index_df, cache_info
+
+
+def rescale_intensity(
+    thumbnail: np.ndarray, lower_percentile: float = 0.5, upper_percentile: float = 99.5
+) -> np.ndarray:
+    """
+    Stretch the contrast of a thumbnail to 0-1 between two percentiles of its intensities, so dim and bright images
+    can both be reviewed.
+    """
+    lower, upper = np.percentile(thumbnail, [lower_percentile, upper_percentile])
+    if upper <= lower:
+        return np.zeros(thumbnail.shape, dtype=np.float32)
+    return np.clip((thumbnail.astype(np.float32) - lower) / (upper - lower), 0, 1)
+
+
+def render_contact_sheets(
+    outliers_df: pd.DataFrame,
+    thumbnail_dir: pathlib.Path,
+    output_dir: pathlib.Path,
+    sheet_name: str,
+    level: int = 1,
+    num_columns: int = 10,
+    tiles_per_sheet: int = 100,
+    value_column: Optional[str] = None,
+) -> List[pathlib.Path]:
+    """
+    This function renders contact sheets (grids of thumbnails with their plate, well, site and channel) of the
+    outlier images from the thumbnail cache, so the outliers can be reviewed without opening the full images.
+
+    The outliers are matched to the cache by plate, well and site (or by plate, row, column and site if there is no
+    well column), and by `Metadata_Reimaged` when both have it, so an original and a re-imaged image set of the same
+    site are not mixed up. The `Channel` column (e.g., "OrigDNA") selects the thumbnail of the image set.
+
+    Args:
+        outliers_df (pd.DataFrame): outlier images with the `Metadata_Plate`, `Metadata_Site`, `Channel` and
+            `Metadata_Well` (or `Metadata_Row` and `Metadata_Col`) columns
+        thumbnail_dir (pathlib.Path): path to the thumbnail cache with one folder per plate
+        output_dir (pathlib.Path): path to the folder to save the contact sheets
+        sheet_name (str): name of the contact sheets (e.g., "blur_outliers"), numbered if there is more than one
+        level (int, optional): resolution of the thumbnails (0 is the largest). Defaults to 1.
+        num_columns (int, optional): number of thumbnails per row. Defaults to 10.
+        tiles_per_sheet (int, optional): maximum number of thumbnails per contact sheet. Defaults to 100.
+        value_column (Optional[str], optional): column with a value to show in each label (e.g., the QC metric).
+            Defaults to None.
+
+    Raises:
+        ValueError: if outliers are not in the thumbnail cache, or the cache has more than one image set per key
+
+    Returns:
+        List[pathlib.Path]: paths to the contact sheets
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    key_columns = (
+        ["Metadata_Plate", "Metadata_Well", "Metadata_Site"]
+        if "Metadata_Well" in outliers_df.columns
+        else ["Metadata_Plate", "Metadata_Row", "Metadata_Col", "Metadata_Site"]
+    )
+
+    # find the position of each outlier in the cache of its plate
+    tiles = []
+    for plate_name, plate_outliers in outliers_df.groupby("Metadata_Plate", sort=False):
+        thumbnails, index_df, cache_info = load_thumbnail_cache(pathlib.Path(thumbnail_dir) / str(plate_name), level)
+        index_df["Metadata_Plate"] = str(plate_name)
+
+        plate_key_columns = key_columns + [
+            col for col in ["Metadata_Reimaged"] if col in plate_outliers.columns and col in index_df.columns
+        ]
+        duplicated = index_df.duplicated(plate_key_columns)
+        if duplicated.any():
+            raise ValueError(
+                f"{duplicated.sum()} image sets of {plate_name} in the thumbnail cache have the same "
+                f"{', '.join(plate_key_columns)} as another image set"
+            )
+
+        matched = plate_outliers.astype({col: str for col in plate_key_columns}).merge(
+            index_df.astype({col: str for col in plate_key_columns})[plate_key_columns + ["Thumbnail_Index"]],
+            on=plate_key_columns,
+            how="left",
+        )
+        missing = matched["Thumbnail_Index"].isna() | ~matched["Channel"].isin(cache_info["channels"])
+        if missing.any():
+            raise ValueError(f"{missing.sum()} outliers of {plate_name} are not in the thumbnail cache")
+
+        for outlier in matched.itertuples(index=False):
+            outlier = outlier._asdict()
+            label = " ".join(str(outlier[col]) for col in key_columns[1:]) + f" {outlier['Channel']}"
+            if value_column is not None:
+                label += f"\n{value_column.split('_')[-1]}: {outlier[value_column]:.3g}"
+            tiles.append(
+                (
+                    thumbnails,
+                    int(outlier["Thumbnail_Index"]),
+                    cache_info["channels"].index(outlier["Channel"]),
+                    f"{plate_name}\n{label}",
+                )
+            )
+
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    sheet_paths = []
+    for sheet_number, start in enumerate(range(0, len(tiles), tiles_per_sheet), start=1):
+        sheet_tiles = tiles[start : start + tiles_per_sheet]
+        num_rows = -(-len(sheet_tiles) // num_columns)
+        tile_height, tile_width = sheet_tiles[0][0].shape[2:]
+
+        # place the thumbnails in one image so the sheet is drawn with one call
+        mosaic = np.ones((num_rows * tile_height, num_columns * tile_width), dtype=np.float32)
+        for tile_number, (thumbnails, index, channel_index, _) in enumerate(sheet_tiles):
+            row, col = divmod(tile_number, num_columns)
+            mosaic[
+                row * tile_height : (row + 1) * tile_height, col * tile_width : (col + 1) * tile_width
+            ] = rescale_intensity(thumbnails[index, channel_index])
+
+        fig, ax = plt.subplots(figsize=(2 * num_columns, 2 * num_rows * tile_height / tile_width))
+        ax.imshow(mosaic, cmap="gray", vmin=0, vmax=1, interpolation="nearest")
+        for tile_number, (_, _, _, label) in enumerate(sheet_tiles):
+            row, col = divmod(tile_number, num_columns)
+            ax.text(
+                col * tile_width + 2,
+                row * tile_height + 2,
+                label,
+                color="yellow",
+                fontsize=5,
+                va="top",
+                ha="left",
+            )
+        ax.set_axis_off()
+        fig.tight_layout(pad=0)
+
+        suffix = f"_{sheet_number}" if len(tiles) > tiles_per_sheet else ""
+        sheet_path = output_dir / f"{sheet_name}{suffix}.png"
+        fig.savefig(sheet_path, dpi=150)
+        plt.close(fig)
+        sheet_paths.append(sheet_path)
+
+    print(f"Saved {len(sheet_paths)} contact sheets with {len(tiles)} outlier images to {output_dir}")
+
+    return sheet_paths
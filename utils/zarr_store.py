@@ -0,0 +1,313 @@
+"""
+This collection of functions converts the images of a plate (the `FileName_Orig*`/`PathName_Orig*` columns of its
+LoadData) into a compressed, chunked OME-Zarr store (the OME-NGFF high-content screening layout of
+<plate>.zarr/<row>/<column>/<site>), so later passes read one chunk per image instead of opening thousands of small
+TIFFs on the raw image drive. A LoadData file that points to the store is saved with each conversion, and
+`read_image` reads an image from either a TIFF path or a store path, so the Python passes (image QC, illumination
+functions and thumbnails) can use either LoadData file.
+
+Note: CellProfiler 4 can not load images from Zarr stores, so CellProfiler pipelines still use the TIFF LoadData.
+"""
+
+import functools
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+import loaddata_store
+
+OME_NGFF_VERSION = "0.4"
+
+# image sets written to the store by one process at a time
+CHUNK_SIZE = 16
+
+
+def _image_group_path(well: str, site: int) -> str:
+    """
+    Get the path of the image group of a site in the store (e.g., C/03/1 for well C03 and site 1).
+    """
+    return f"{well[0]}/{well[1:]}/{site}"
+
+
+def _get_compressor(compression_level: int):
+    """
+    Get the compressor for the image chunks (Zstandard with bit shuffling, which suits 16-bit images).
+    """
+    from numcodecs import Blosc
+
+    return Blosc(cname="zstd", clevel=compression_level, shuffle=Blosc.BITSHUFFLE)
+
+
+def write_image_sets(
+    path_to_zarr: pathlib.Path, image_sets: List[dict], channels: List[str]
+) -> int:
+    """
+    This function reads the TIFFs of some image sets and writes them into their arrays in the store. Each array has
+    one chunk per channel (or tile), so processes writing different image sets never write the same chunk.
+
+    Args:
+        path_to_zarr (pathlib.Path): path to the Zarr store of the plate
+        image_sets (List[dict]): image group path ("group") and path to the TIFF of each channel ("paths")
+        channels (List[str]): image names of the channels, in the order they are stored
+
+    Returns:
+        int: number of image sets written
+    """
+    import zarr
+
+    root = zarr.open_group(str(path_to_zarr), mode="r+")
+
+    for image_set in image_sets:
+        image_group = root[image_set["group"]]
+        image_array = image_group["0"]
+        for channel_index, image_path in enumerate(image_set["paths"]):
+            image_array[channel_index] = tifffile.imread(image_path)
+
+        # the source paths are written last, so an interrupted image set is written again on the next run
+        image_group.attrs["source_paths"] = dict(zip(channels, image_set["paths"]))
+
+    return len(image_sets)
+
+
+def convert_plate_to_zarr(
+    path_to_loaddata: pathlib.Path,
+    zarr_dir: pathlib.Path,
+    plate_name: Optional[str] = None,
+    tile_size: Optional[int] = None,
+    compression_level: int = 5,
+    max_workers: Optional[int] = None,
+) -> pathlib.Path:
+    """
+    This function converts the images of a plate into an OME-Zarr store (zarr_dir/<plate>.zarr) in a process pool
+    and saves a LoadData CSV (zarr_dir/<plate>_zarr.csv) with the same rows and columns, where the `PathName_Orig*`
+    columns are the store and the `FileName_Orig*` columns are <row>/<column>/<site>/<channel> (see `read_image`).
+
+    Each site is a (channel, y, x) array with one chunk per channel (or per tile of each channel) that is compressed
+    with Zstandard. Image sets that are already in the store with the same TIFF paths are skipped, so only new or
+    re-imaged sites are written when the LoadData changes.
+
+    Args:
+        path_to_loaddata (pathlib.Path): path to the LoadData CSV or Parquet file of the plate
+        zarr_dir (pathlib.Path): path to the folder for the Zarr stores
+        plate_name (Optional[str], optional): name of the store. Defaults to None (the `Metadata_Plate` of the plate).
+        tile_size (Optional[int], optional): size of the square chunks of each channel. Defaults to None (one chunk
+            per channel).
+        compression_level (int, optional): Zstandard compression level. Defaults to 5.
+        max_workers (Optional[int], optional): number of processes. Defaults to None (the number of CPUs).
+
+    Returns:
+        pathlib.Path: path to the LoadData CSV that points to the store
+    """
+    import zarr
+
+    loaddata_df = loaddata_store.read_loaddata(path_to_loaddata)
+    plate_name = plate_name or str(loaddata_df["Metadata_Plate"].iloc[0])
+    channels = [col.replace("FileName_", "") for col in loaddata_df.columns if col.startswith("FileName_Orig")]
+
+    zarr_dir = pathlib.Path(zarr_dir)
+    path_to_zarr = zarr_dir / f"{plate_name}.zarr"
+    root = zarr.open_group(str(path_to_zarr), mode="a")
+
+    wells = list(dict.fromkeys(loaddata_df["Metadata_Well"].astype(str)))
+    rows = sorted({well[0] for well in wells})
+    columns = sorted({well[1:] for well in wells})
+    root.attrs["plate"] = {
+        "version": OME_NGFF_VERSION,
+        "name": plate_name,
+        "rows": [{"name": row} for row in rows],
+        "columns": [{"name": column} for column in columns],
+        "wells": [
+            {"path": f"{well[0]}/{well[1:]}", "rowIndex": rows.index(well[0]), "columnIndex": columns.index(well[1:])}
+            for well in wells
+        ],
+        "field_count": int(loaddata_df.groupby("Metadata_Well", observed=True).size().max()),
+    }
+
+    for well, well_df in loaddata_df.groupby(loaddata_df["Metadata_Well"].astype(str), sort=False):
+        root.require_group(f"{well[0]}/{well[1:]}").attrs["well"] = {
+            "version": OME_NGFF_VERSION,
+            "images": [{"path": str(site)} for site in well_df["Metadata_Site"]],
+        }
+
+    image_paths = pd.DataFrame(
+        {
+            channel: loaddata_df[f"PathName_{channel}"].astype(str)
+            + os.sep
+            + loaddata_df[f"FileName_{channel}"].astype(str)
+            for channel in channels
+        }
+    )
+
+    image_sets = []
+    compressor = _get_compressor(compression_level)
+    for well, site, paths in zip(
+        loaddata_df["Metadata_Well"].astype(str), loaddata_df["Metadata_Site"], image_paths.values.tolist()
+    ):
+        group_path = _image_group_path(well, site)
+        image_group = root.require_group(group_path)
+        if image_group.attrs.get("source_paths") == dict(zip(channels, paths)):
+            continue
+
+        # the shape and type are read from the first TIFF header (the array is replaced, as the site is re-imaged)
+        with tifffile.TiffFile(paths[0]) as tiff:
+            height, width = tiff.pages[0].shape[:2]
+            dtype = tiff.pages[0].dtype
+        image_group.create_dataset(
+            "0",
+            shape=(len(channels), height, width),
+            chunks=(1, tile_size or height, tile_size or width),
+            dtype=dtype,
+            compressor=compressor,
+            overwrite=True,
+        )
+        image_group.attrs.put(
+            {
+                "multiscales": [
+                    {
+                        "version": OME_NGFF_VERSION,
+                        "name": group_path,
+                        "axes": [
+                            {"name": "c", "type": "channel"},
+                            {"name": "y", "type": "space"},
+                            {"name": "x", "type": "space"},
+                        ],
+                        "datasets": [
+                            {"path": "0", "coordinateTransformations": [{"type": "scale", "scale": [1, 1, 1]}]}
+                        ],
+                    }
+                ],
+                "omero": {"channels": [{"label": channel} for channel in channels]},
+            }
+        )
+        image_sets.append({"group": group_path, "paths": paths})
+
+    print(f"Writing {len(image_sets)} of {len(loaddata_df)} image sets of {plate_name} to {path_to_zarr}")
+    if image_sets:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(write_image_sets, path_to_zarr, image_sets[start : start + CHUNK_SIZE], channels)
+                for start in range(0, len(image_sets), CHUNK_SIZE)
+            ]
+            for future in futures:
+                future.result()
+
+    # LoadData with the same rows that points to the store
+    zarr_loaddata_df = loaddata_df.copy()
+    group_paths = [
+        _image_group_path(well, site)
+        for well, site in zip(loaddata_df["Metadata_Well"].astype(str), loaddata_df["Metadata_Site"])
+    ]
+    for channel in channels:
+        zarr_loaddata_df[f"FileName_{channel}"] = [f"{group_path}/{channel}" for group_path in group_paths]
+        zarr_loaddata_df[f"PathName_{channel}"] = str(path_to_zarr.resolve())
+
+    path_to_zarr_loaddata = zarr_dir / f"{plate_name}_zarr.csv"
+    zarr_loaddata_df.to_csv(path_to_zarr_loaddata, index=False)
+    print(f"The LoadData CSV for the Zarr store has been saved to {path_to_zarr_loaddata}!")
+
+    return path_to_zarr_loaddata
+
+
+def convert_plates_to_zarr(
+    plate_info_dictionary: dict, zarr_dir: pathlib.Path, max_workers: Optional[int] = None, **kwargs
+) -> Dict[str, pathlib.Path]:
+    """
+    This function converts every plate in the plate info dictionary (see `convert_plate_to_zarr`).
+
+    Args:
+        plate_info_dictionary (dict): dictionary with the LoadData ("path_to_loaddata") per plate
+        zarr_dir (pathlib.Path): path to the folder for the Zarr stores
+        max_workers (Optional[int], optional): number of processes. Defaults to None (the number of CPUs).
+        **kwargs: other arguments for `convert_plate_to_zarr` (e.g., tile_size)
+
+    Returns:
+        Dict[str, pathlib.Path]: path to the LoadData CSV that points to the store per plate
+    """
+    return {
+        plate_name: convert_plate_to_zarr(
+            path_to_loaddata=info["path_to_loaddata"],
+            zarr_dir=zarr_dir,
+            plate_name=plate_name,
+            max_workers=max_workers,
+            **kwargs,
+        )
+        for plate_name, info in plate_info_dictionary.items()
+    }
+
+
+@functools.lru_cache(maxsize=16)
+def _open_store(path_to_zarr: str):
+    """
+    Open a Zarr store to read (kept open for the next images of the same plate).
+    """
+    import zarr
+
+    return zarr.open_group(path_to_zarr, mode="r")
+
+
+@functools.lru_cache(maxsize=4096)
+def _channel_index(path_to_zarr: str, group_path: str, channel: str) -> int:
+    """
+    Get the position of a channel in the array of an image group from its OME metadata.
+    """
+    labels = [
+        channel_info["label"] for channel_info in _open_store(path_to_zarr)[group_path].attrs["omero"]["channels"]
+    ]
+    return labels.index(channel)
+
+
+def _split_store_path(image_path: str) -> Optional[Tuple[str, str, str]]:
+    """
+    Split the path to an image in a Zarr store into the store, the image group and the channel (None for a TIFF).
+    """
+    store_end = image_path.find(".zarr" + os.sep)
+    if store_end == -1:
+        return None
+
+    group_path, channel = image_path[store_end + len(".zarr" + os.sep) :].rsplit("/", 1)
+    return image_path[: store_end + len(".zarr")], group_path, channel
+
+
+def read_image(image_path: str) -> np.ndarray:
+    """
+    This function reads an image from a TIFF or from a Zarr store. Images in a store are given as the path to the
+    store followed by <row>/<column>/<site>/<channel> (the `PathName_*` and `FileName_*` columns of the LoadData from
+    `convert_plate_to_zarr`), and only the chunks of that channel are read.
+
+    Args:
+        image_path (str): path to the TIFF, or to the image in a Zarr store (e.g., BR00143976.zarr/C/03/1/OrigDNA)
+
+    Returns:
+        np.ndarray: the image
+    """
+    store_path = _split_store_path(str(image_path))
+    if store_path is None:
+        return tifffile.imread(image_path)
+
+    path_to_zarr, group_path, channel = store_path
+    return _open_store(path_to_zarr)[f"{group_path}/0"][_channel_index(path_to_zarr, group_path, channel)]
+
+
+def get_image_shape(image_path: str) -> Tuple[int, int]:
+    """
+    This function gets the height and width of an image in a TIFF (from its header) or in a Zarr store (from the
+    array metadata) without reading the pixel data.
+
+    Args:
+        image_path (str): path to the TIFF, or to the image in a Zarr store
+
+    Returns:
+        Tuple[int, int]: height and width of the image
+    """
+    store_path = _split_store_path(str(image_path))
+    if store_path is None:
+        with tifffile.TiffFile(image_path) as tiff:
+            return tuple(tiff.pages[0].shape[:2])
+
+    path_to_zarr, group_path, _ = store_path
+    return tuple(_open_store(path_to_zarr)[f"{group_path}/0"].shape[1:])